@@ -44,7 +44,7 @@ def load_version(v):
         return VERSION_LIST[VERSION_LIST.index(v)].load()
       sp = LIBCXX_VERSIONS_ROOT / tv / 'info.json'
       if sp.is_file():
-        return LibcxxInfo.create_from_path(sp)
+        return LIBCXX_INFO_REGISTRY.load(sp)
       return None
 
     try_formats = ['{v}', 'v{v}', '{v}.0.1', '{v}.0.0', '{v}.1.0', '{v}.0', '{v}.1']
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Run a sharded collection locally: one process per shard, each writing its own
+database, then merge the shard databases. On a fleet, run
+`python -m libcxx.graph --run --shard=I/K` on each host instead and merge the
+copied databases with `python -m libcxx.merge`.
+"""
+from pathlib import Path
+import argparse
+import os
+import subprocess
+import sys
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--shards', type=int, required=True)
+  parser.add_argument('--dir', type=str, required=True, help='Where to put the shard databases')
+  parser.add_argument('--out', type=str, required=True, help='The merged database')
+  parser.add_argument('--rerun', action='store_true')
+  args = parser.parse_args()
+
+  shard_dir = Path(args.dir).absolute()
+  shard_dir.mkdir(parents=True, exist_ok=True)
+  procs = []
+  paths = []
+  for i in range(args.shards):
+    path = shard_dir / f'shard-{i}-of-{args.shards}.db'
+    env = dict(os.environ, LIBCXX_METRICS_DB=str(path))
+    cmd = [sys.executable, '-m', 'libcxx.graph', '--rerun' if args.rerun else '--run',
+           f'--shard={i}/{args.shards}']
+    procs.append(subprocess.Popen(cmd, env=env))
+    paths.append(path)
+  failed = [i for i, p in enumerate(procs) if p.wait() != 0]
+  if failed:
+    print('Shards %s failed' % failed)
+    sys.exit(1)
+  subprocess.run([sys.executable, '-m', 'libcxx.merge', '--out', args.out] + [str(p) for p in paths],
+                 check=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -18,7 +18,7 @@ def upload_file(src, dst):
   print('Uploaded %s to %s' % (src, dst))
 
 def main():
-  init_db()
+  init_db(readonly=True)
   parser = argparse.ArgumentParser()
   parser.add_argument('--data', type=str, required=False, default=None)
   args = parser.parse_args()
@@ -0,0 +1,343 @@
+"""
+A pull-based work queue for running jobs on several machines.
+
+The broker owns the results database. It records a Lease for every job that
+needs rerunning and serves them over a multiprocessing.connection socket (TCP
+host:port or a Unix socket path). Workers ask for a job when they are idle,
+rebuild it with LibcxxJob.from_key(), run it and send back the Output, so
+fast machines simply take more jobs and no host is left with a long tail.
+Expensive jobs (Meta.cost) are handed out first.
+
+A lease expires unless the worker renews it while the job runs, and the leases
+of a worker whose connection drops are released at once, so the jobs of a
+dead or hung worker are issued again, up to max_attempts times in all.
+Results are stored through a ResultSink with the fingerprint the worker
+computed, as its compiler and headers may differ from the broker's.
+
+Every serve starts a new session, with a lease per stale key and no attempts;
+serve --resume continues the last one instead, so the jobs it already
+finished or gave up on are not handed out again.
+
+  python -m libcxx.broker serve --address 0.0.0.0:6000
+  python -m libcxx.broker work --address broker-host:6000 --processes 8
+
+Both sides need the shared secret, from --authkey or LIBCXX_BROKER_AUTHKEY,
+and refuse to start without one. Messages are JSON, keys and outputs in the
+form the database stores them, so nothing a peer sends is unpickled.
+"""
+from multiprocessing.connection import Listener, Client
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+
+import peewee as pw
+import rich
+
+import libcxx.db as db
+from libcxx.db import DATABASE, LibcxxDBModel, PydanticModelType, PydanticWrapper
+from libcxx.job import LibcxxJob, RERUN_REPEATABLE
+from libcxx.sink import ResultSink
+from libcxx.utils import ChildUsage
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+
+
+def parse_address(address):
+  """host:port for TCP, anything else is a Unix socket path."""
+  host, sep, port = address.rpartition(':')
+  if sep and port.isdigit() and '/' not in address:
+    return (host, int(port))
+  return address
+
+
+def _authkey(authkey=None):
+  authkey = authkey or os.environ.get('LIBCXX_BROKER_AUTHKEY')
+  if not authkey:
+    raise RuntimeError('No broker secret, set LIBCXX_BROKER_AUTHKEY or pass --authkey')
+  return authkey.encode('utf-8') if isinstance(authkey, str) else authkey
+
+
+def _send(conn, *msg):
+  conn.send_bytes(json.dumps(msg).encode('utf-8'))
+
+
+def _recv(conn):
+  return json.loads(conn.recv_bytes())
+
+
+class Lease(LibcxxDBModel):
+  job = pw.TextField()
+  digest = pw.IntegerField()
+  key = PydanticModelType()
+  cost = pw.FloatField()
+  worker = pw.TextField(null=True)
+  expires = pw.FloatField(null=True)
+  attempts = pw.IntegerField(default=0)
+  done = pw.BooleanField(default=False)
+
+  class Meta:
+    indexes = (
+      (('job', 'digest'), True),
+    )
+
+
+class Broker:
+  def __init__(self, plans, address, authkey=None, lease_seconds=LEASE_SECONDS,
+               max_attempts=MAX_ATTEMPTS, rerun_repeatable=RERUN_REPEATABLE, resume=False):
+    plans = [p.as_plan() for p in plans]
+    if any([p.dependencies() for p in plans]):
+      raise RuntimeError('The broker cannot run jobs with dependencies')
+    self.address = address
+    self.authkey = _authkey(authkey)
+    self.lease_seconds = lease_seconds
+    self.max_attempts = max_attempts
+    self.failed = []
+    self._lock = threading.Lock()
+    self._finished = threading.Event()
+    DATABASE.create_tables([Lease])
+    self._load(LibcxxJob.filter_should_rerun(plans, rerun_repeatable), resume)
+
+  def _load(self, stale, resume):
+    stale = {p.db_key(): p for p in stale}
+    with DATABASE.atomic():
+      if not resume:
+        # A new session hands out every stale key again, whatever the last one did with it.
+        Lease.delete().execute()
+      Lease.update(worker=None, expires=None).execute()
+      for lease in Lease.select(Lease.id, Lease.job, Lease.digest):
+        if stale.pop((lease.job, lease.digest), None) is None:
+          lease.delete_instance()
+      rows = [{'job': job, 'digest': digest, 'cost': p.meta().cost,
+               'key': p.job_type.create_key(**p.key_kwargs())}
+              for (job, digest), p in stale.items()]
+      for batch in pw.chunked(rows, 200):
+        Lease.insert_many(batch).execute()
+    rich.print(f'{self.remaining()} jobs to hand out')
+
+  def remaining(self):
+    return Lease.select().where(Lease.done == False).count()
+
+  def _give_up_exhausted(self, now):
+    """
+    Fail the leases that are free again, because they expired or their worker
+    went away, after max_attempts grants: their job kills or hangs workers.
+    """
+    exhausted = list(Lease.select().where((Lease.done == False) &
+                                          (Lease.attempts >= self.max_attempts) &
+                                          (Lease.expires.is_null() | (Lease.expires < now))))
+    for lease in exhausted:
+      rich.print(f'{lease.key.pathkey()} lost its worker {lease.attempts} times')
+      self.failed.append((lease.job, lease.key.pathkey(), 'lost its worker'))
+    if exhausted:
+      Lease.update(done=True, worker=None, expires=None).where(
+          Lease.id.in_([l.id for l in exhausted])).execute()
+
+  def _grant(self, worker):
+    now = time.time()
+    with self._lock:
+      self._give_up_exhausted(now)
+      query = Lease.select().where((Lease.done == False) & (Lease.attempts < self.max_attempts) &
+                                   (Lease.expires.is_null() | (Lease.expires < now)))
+      lease = query.order_by(Lease.cost.desc(), pw.fn.RANDOM()).first()
+      if lease is None:
+        self._check_finished()
+        return ('done',) if self.remaining() == 0 else ('wait', 1.0)
+      Lease.update(worker=worker, expires=now + self.lease_seconds,
+                   attempts=Lease.attempts + 1).where(Lease.id == lease.id).execute()
+    return ('job', lease.id, Lease.key.db_value(lease.key), self.lease_seconds / 3)
+
+  def _held(self, lease_id, worker):
+    lease = Lease.get_or_none(Lease.id == lease_id)
+    if lease is None or lease.done or lease.worker != worker:
+      return None
+    return lease
+
+  def _renew(self, lease_id, worker):
+    with self._lock:
+      if self._held(lease_id, worker) is None:
+        return ('lost',)
+      Lease.update(expires=time.time() + self.lease_seconds).where(Lease.id == lease_id).execute()
+    return ('ok',)
+
+  def _complete(self, lease_id, worker, output, usage, fingerprint, sink):
+    # A late result for a lease that expired and was handed to another worker is dropped.
+    if (lease := self._held(lease_id, worker)) is None:
+      return ('lost',)
+    try:
+      # The lease is only done once the result is known to be storable; a
+      # malformed one counts as a failed attempt.
+      try:
+        job = db.registry[lease.job].from_key(lease.key)
+        job.usage = ChildUsage(*usage) if usage is not None else None
+        job.computed_fingerprint = fingerprint
+        result = job.output_type().model_validate_json(output)
+      except Exception as E:
+        return self._fail(lease_id, worker, f'unusable result: {E!r}')
+      with self._lock:
+        if self._held(lease_id, worker) is None:
+          return ('lost',)
+        Lease.update(done=True, worker=None, expires=None).where(Lease.id == lease_id).execute()
+      sink.put(job, result)
+      return ('ok',)
+    finally:
+      self._check_finished()
+
+  def _fail(self, lease_id, worker, error):
+    with self._lock:
+      if (lease := self._held(lease_id, worker)) is None:
+        return ('lost',)
+      rich.print(f'{lease.key.pathkey()} failed on {worker}: {error}')
+      done = lease.attempts >= self.max_attempts
+      if done:
+        self.failed.append((lease.job, lease.key.pathkey(), error))
+      Lease.update(done=done, worker=None, expires=None).where(Lease.id == lease_id).execute()
+    self._check_finished()
+    return ('ok',)
+
+  def _release(self, worker):
+    with self._lock:
+      Lease.update(worker=None, expires=None).where(
+          (Lease.worker == worker) & (Lease.done == False)).execute()
+      self._give_up_exhausted(time.time())
+    self._check_finished()
+
+  def _check_finished(self):
+    if self.remaining() == 0:
+      self._finished.set()
+
+  def _serve(self, conn, sink):
+    worker = None
+    try:
+      while True:
+        msg = _recv(conn)
+        kind = msg[0]
+        if kind == 'get':
+          worker = msg[1]
+          reply = self._grant(worker)
+        elif kind == 'renew':
+          reply = self._renew(msg[1], worker)
+        elif kind == 'result':
+          reply = self._complete(msg[1], worker, msg[2], msg[3], msg[4], sink)
+        elif kind == 'fail':
+          reply = self._fail(msg[1], worker, msg[2])
+        else:
+          reply = ('error', 'unknown message %s' % kind)
+        _send(conn, *reply)
+    except (EOFError, OSError, ValueError):
+      # ValueError covers malformed JSON and outputs, the connection is dropped.
+      pass
+    finally:
+      conn.close()
+      if worker is not None:
+        # Re-issue whatever the worker was running.
+        self._release(worker)
+      DATABASE.close()
+
+  def _accept(self, listener, sink):
+    while not self._finished.is_set():
+      try:
+        conn = listener.accept()
+      except OSError:
+        return
+      threading.Thread(target=self._serve, args=(conn, sink), daemon=True).start()
+
+  def serve(self):
+    """Hand out jobs until every lease is done; return the jobs that failed too often."""
+    self._check_finished()
+    if self._finished.is_set():
+      return self.failed
+    with ResultSink() as sink, Listener(self.address, authkey=self.authkey) as listener:
+      rich.print(f'Serving jobs on {listener.address}')
+      threading.Thread(target=self._accept, args=(listener, sink), daemon=True).start()
+      self._finished.wait()
+    return self.failed
+
+
+def _heartbeat(call, lease_id, stop, interval):
+  while not stop.wait(interval):
+    if call('renew', lease_id)[0] == 'lost':
+      return
+
+
+def run_worker(address, authkey=None, name=None):
+  """Pull jobs from the broker at address and run them until it has none left."""
+  name = name or f'{socket.gethostname()}-{os.getpid()}'
+  lock = threading.Lock()
+  with Client(address, authkey=_authkey(authkey)) as conn:
+    def call(*msg):
+      with lock:
+        _send(conn, *msg)
+        return _recv(conn)
+    while True:
+      try:
+        reply = call('get', name)
+      except (EOFError, OSError):
+        return
+      if reply[0] == 'done':
+        return
+      if reply[0] == 'wait':
+        time.sleep(reply[1] * (1 + random.random()))
+        continue
+      _, lease_id, key, renew_interval = reply
+      stop = threading.Event()
+      heartbeat = threading.Thread(target=_heartbeat, args=(call, lease_id, stop, renew_interval),
+                                   daemon=True)
+      heartbeat.start()
+      res, error = None, 'no result'
+      try:
+        key = PydanticWrapper.model_validate_json(key).object()
+        job = db.registry[key.job_name()].from_key(key)
+        res = job.run_measured()
+        # The broker stores the result with the inputs of this host, not its own.
+        fingerprint = job.fingerprint()
+      except Exception as E:
+        error = repr(E)
+      finally:
+        stop.set()
+        heartbeat.join()
+      if res is None:
+        call('fail', lease_id, error)
+      else:
+        call('result', lease_id, res.model_dump_json(round_trip=True), job.usage, fingerprint)
+
+
+if __name__ == '__main__':
+  import libcxx.jobs
+  parser = argparse.ArgumentParser(description='Distribute jobs to workers that pull them')
+  parser.add_argument('mode', choices=['serve', 'work'])
+  parser.add_argument('--address', type=str, required=True, help='host:port or a Unix socket path')
+  parser.add_argument('--processes', type=int, default=os.cpu_count())
+  parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS)
+  parser.add_argument('--rerun', action='store_true')
+  parser.add_argument('--resume', action='store_true', help='continue the last serve session')
+  parser.add_argument('--authkey', type=str, default=None,
+                      help='the shared secret, LIBCXX_BROKER_AUTHKEY by default')
+  args = parser.parse_args()
+  address = parse_address(args.address)
+  try:
+    authkey = _authkey(args.authkey)
+  except RuntimeError as E:
+    parser.error(str(E))
+  if args.mode == 'serve':
+    db.init_db()
+    plans = LibcxxJob.all_plans()
+    dependent = [p for p in plans if p.dependencies()]
+    if dependent:
+      rich.print(f'Skipping {len(dependent)} jobs with dependencies, run them with libcxx.graph --run')
+    failed = Broker([p for p in plans if not p.dependencies()], address, authkey=authkey,
+                    lease_seconds=args.lease_seconds, rerun_repeatable=args.rerun,
+                    resume=args.resume).serve()
+    for job, key, error in failed:
+      rich.print(f'Gave up on {job} {key}: {error}')
+  else:
+    procs = [multiprocessing.Process(target=run_worker, args=(address, authkey)) for _ in range(args.processes)]
+    for p in procs:
+      p.start()
+    for p in procs:
+      p.join()
@@ -0,0 +1,263 @@
+"""
+A content-addressed cache for compiler artifacts.
+
+Artifacts are keyed by everything that determines their content: the compiler
+identity, the libc++ install, the dialect, the flags and a hash of the input.
+The preprocessed output of a (libcxx, standard, header) TU is produced once and
+shared by IncludeSizeJob (which only needs its line count) and StdSymbolsJob
+(which runs clang-query over it).
+"""
+from pathlib import Path
+from typing import Optional
+import argparse
+import asyncio
+import codecs
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from pydantic import BaseModel
+
+from libcxx.config import CACHE_ROOT
+from libcxx.header_index import HEADER_INDEX
+from libcxx.utils import pinned, wait
+
+
+@functools.lru_cache(maxsize=None)
+def _compiler_id(compiler, mtime_ns):
+  return subprocess.check_output([compiler, '--version']).decode('utf-8').strip()
+
+def compiler_id(compiler):
+  """The `--version` output of a compiler, computed once per binary per process."""
+  compiler = str(Path(compiler).resolve())
+  return _compiler_id(compiler, os.stat(compiler).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=None)
+def default_compiler_id():
+  """The compiler_id() of the clang++ on PATH, or None if there is none."""
+  compiler = shutil.which('clang++')
+  return compiler_id(compiler) if compiler else None
+
+
+def file_digest(p):
+  h = hashlib.sha256()
+  with open(p, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class HeaderTreeDigests:
+  """
+  Digests of the header trees of libc++ installs, computed from the persisted
+  HeaderIndex (see libcxx.header_index), so later processes only stat the
+  tree. A tree's digest is computed once per process.
+  """
+  def __init__(self, index=HEADER_INDEX):
+    self.index = index
+    self._digests = {}
+
+  def digest(self, tree):
+    tree = str(Path(tree).resolve())
+    if tree not in self._digests:
+      self._digests[tree] = self.index.tree(tree).digest()
+    return self._digests[tree]
+
+  def libcxx_digest(self, libcxx):
+    """The combined digest of the include directories of a LibcxxInfo."""
+    key = (str(libcxx.path), tuple(libcxx.include_paths))
+    if key not in self._digests:
+      trees = [p for p in libcxx.abs_include_paths() if p.is_dir()]
+      self._digests[key] = ArtifactCache.key(*[self.digest(t) for t in trees])
+    return self._digests[key]
+
+
+class ArtifactCache:
+  def __init__(self, root=CACHE_ROOT):
+    self.root = Path(root)
+
+  @staticmethod
+  def key(*parts):
+    return hashlib.sha256(json.dumps([str(p) for p in parts]).encode('utf-8')).hexdigest()
+
+  def path(self, kind, key, suffix=''):
+    return self.root / kind / key[:2] / (key + suffix)
+
+  def lookup(self, kind, key, suffix=''):
+    """Return (artifact path, metadata) or None."""
+    p = self.path(kind, key, suffix)
+    meta = self.path(kind, key, '.json')
+    if not p.is_file() or not meta.is_file():
+      return None
+    os.utime(p)
+    return p, json.loads(meta.read_text())
+
+  @contextlib.contextmanager
+  def create(self, kind, key, suffix=''):
+    """
+    Yield a temporary path to write the artifact to, and a dict to fill with
+    metadata. Both are published atomically when the body succeeds.
+    """
+    p = self.path(kind, key, suffix)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix='.tmp-', suffix=suffix)
+    os.close(fd)
+    tmp = Path(tmp)
+    metadata = {}
+    try:
+      yield tmp, metadata
+      os.replace(tmp, p)
+      meta_tmp = tmp.with_suffix('.json')
+      meta_tmp.write_text(json.dumps(metadata))
+      os.replace(meta_tmp, self.path(kind, key, '.json'))
+    finally:
+      tmp.unlink(missing_ok=True)
+
+  def prune(self, max_bytes):
+    """Remove the least recently used artifacts until the cache fits in max_bytes."""
+    files = [(p.stat(), p) for p in self.root.rglob('*') if p.is_file() and p.suffix != '.json']
+    files.sort(key=lambda x: x[0].st_mtime)
+    total = sum([st.st_size for st, _ in files])
+    for st, p in files:
+      if total <= max_bytes:
+        break
+      p.unlink(missing_ok=True)
+      p.with_suffix('.json').unlink(missing_ok=True)
+      total -= st.st_size
+    return total
+
+
+ARTIFACT_CACHE = ArtifactCache()
+HEADER_TREE_DIGESTS = HeaderTreeDigests()
+
+
+class Preprocessed(BaseModel):
+  path: Path
+  line_count: int
+  size_in_bytes: int
+
+
+# The characters str.splitlines() treats as line boundaries.
+LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
+CHUNK_SIZE = 1 << 16
+
+
+class PreprocessedCounter:
+  """
+  Incrementally computes the line count and size of preprocessor output fed
+  in chunks, using memory bounded by the longest line.
+
+  The result is identical to decoding the whole output, stripping it, and
+  counting the lines that are neither blank nor directives.
+  """
+  def __init__(self):
+    self._decoder = codecs.getincrementaldecoder('utf-8')()
+    self._partial = ''
+    self._started = False
+    self._pending_space = 0
+    self.line_count = 0
+    self.size_in_bytes = 0
+
+  def _count_size(self, text):
+    if not self._started:
+      text = text.lstrip()
+      if not text:
+        return
+      self._started = True
+    stripped = text.rstrip()
+    if not stripped:
+      self._pending_space += len(text)
+      return
+    self.size_in_bytes += self._pending_space + len(stripped)
+    self._pending_space = len(text) - len(stripped)
+
+  def _count_lines(self, lines):
+    for l in lines:
+      l = l.strip()
+      if l and not l.startswith('#'):
+        self.line_count += 1
+
+  def feed(self, data, final=False):
+    text = self._decoder.decode(data, final)
+    self._count_size(text)
+    lines = (self._partial + text).splitlines(keepends=True)
+    self._partial = ''
+    if lines and not final and lines[-1][-1] not in LINE_BREAKS:
+      self._partial = lines.pop()
+    self._count_lines(lines)
+    return self
+
+  def finish(self):
+    return self.feed(b'', final=True)
+
+
+def count_preprocessed(out):
+  """The (line_count, size_in_bytes) of preprocessor output, ignoring directives and blank lines."""
+  counter = PreprocessedCounter().feed(out, final=True)
+  return counter.line_count, counter.size_in_bytes
+
+
+def _preprocess_cmd(compiler, libcxx, standard, input_file, flags):
+  return [compiler, standard.flag(), '-E'] + libcxx.include_flags() + list(flags) + \
+      ['-xc++', str(input_file)]
+
+def _preprocess_key(compiler, libcxx, standard, input_file, flags):
+  # The header digest makes headers changed in place under the same path a miss.
+  return ArtifactCache.key(compiler_id(compiler), libcxx.path, HEADER_TREE_DIGESTS.libcxx_digest(libcxx),
+                           standard.flag(), *libcxx.include_flags(), *flags, file_digest(input_file))
+
+def _lookup_preprocessed(key, cache):
+  if hit := cache.lookup('preprocessed', key, '.ii'):
+    p, meta = hit
+    return Preprocessed(path=p, **meta)
+  return None
+
+def _check_preprocess(cmd, returncode, stderr):
+  if returncode != 0:
+    stderr.seek(0)
+    raise RuntimeError('Process %s failed with %s \nstderr:\n%s\n' % (cmd, returncode,
+    stderr.read().decode('utf-8')))
+
+
+def preprocess(libcxx, standard, input_file, flags=(), compiler=None, cache=ARTIFACT_CACHE):
+  """Return the cached preprocessed output of input_file, running `clang++ -E` on a miss."""
+  compiler = compiler or shutil.which('clang++')
+  key = _preprocess_key(compiler, libcxx, standard, input_file, flags)
+  if res := _lookup_preprocessed(key, cache):
+    return res
+  cmd = _preprocess_cmd(compiler, libcxx, standard, input_file, flags)
+  with cache.create('preprocessed', key, '.ii') as (tmp, metadata), \
+       open(tmp, 'wb') as out, tempfile.TemporaryFile() as stderr:
+    counter = PreprocessedCounter()
+    started = time.monotonic()
+    proc = subprocess.Popen(pinned(cmd), stdout=subprocess.PIPE, stderr=stderr)
+    with proc:
+      for chunk in iter(lambda: proc.stdout.read(CHUNK_SIZE), b''):
+        out.write(chunk)
+        counter.feed(chunk)
+      wait(proc, started)
+    _check_preprocess(cmd, proc.returncode, stderr)
+    counter.finish()
+    metadata.update({'line_count': counter.line_count, 'size_in_bytes': counter.size_in_bytes})
+  return _lookup_preprocessed(key, cache)
+
+
+async def apreprocess(libcxx, standard, input_file, flags=(), compiler=None, cache=ARTIFACT_CACHE):
+  # In a thread, so that preprocess() can reap clang with os.wait4, see libcxx.utils.wait.
+  return await asyncio.to_thread(preprocess, libcxx, standard, input_file, flags, compiler, cache)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--prune-mb', type=int, required=True)
+  args = parser.parse_args()
+  remaining = ARTIFACT_CACHE.prune(args.prune_mb * 1024 * 1024)
+  print('Cache size is now %d MB' % (remaining // (1024 * 1024)))
@@ -0,0 +1,346 @@
+"""
+Normalized, columnar storage for job results.
+
+Every job type gets its own table with one column per key field and one column
+per scalar output field (nested models are flattened, e.g.
+`total_execution_time_microseconds`). A `list[BaseModel]` output field, such as
+`CompilerMetricsList.runs`, is stored in a child table with one row per element.
+
+Graphs are generated from these tables with a single GROUP BY query instead of
+decoding every `DBDataPoint` blob, and percentiles of the runs with a window
+query that only reads back the samples around each percentile.
+"""
+from dataclasses import dataclass, field
+from typing import Any, Optional, Union, get_args, get_origin
+from pathlib import Path
+from enum import Enum
+import datetime
+import argparse
+import math
+import re
+import types
+
+import peewee as pw
+import pydantic
+import rich
+import tqdm
+
+import libcxx.db as db
+from libcxx.db import DATABASE, LibcxxDBModel, DBDataPoint
+from libcxx.registry import ClassRegistry
+
+columnar_registry = ClassRegistry()
+
+SCALAR_FIELDS = {
+    bool: pw.BooleanField,
+    int: pw.IntegerField,
+    float: pw.FloatField,
+    str: pw.TextField,
+    Path: pw.TextField,
+    datetime.datetime: pw.DateTimeField,
+}
+
+
+class UnsupportedShape(Exception):
+  pass
+
+
+def _table_name(name):
+  return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+def _unwrap_optional(annotation):
+  if get_origin(annotation) in (Union, types.UnionType):
+    args = [a for a in get_args(annotation) if a is not type(None)]
+    if len(args) == 1:
+      return args[0], True
+  return annotation, False
+
+
+def _flatten_fields(fields, prefix=(), nullable=False):
+  """Return a list of (column, path, peewee field) for the scalar leaves of (name, annotation) pairs."""
+  columns = []
+  for name, annotation in fields:
+    annotation, optional = _unwrap_optional(annotation)
+    path = prefix + (name,)
+    null = nullable or optional
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+      columns += [('_'.join(path), path, pw.TextField(null=null))]
+    elif annotation in SCALAR_FIELDS:
+      columns += [('_'.join(path), path, SCALAR_FIELDS[annotation](null=null))]
+    elif isinstance(annotation, type) and issubclass(annotation, pydantic.BaseModel):
+      columns += _flatten(annotation, path, null)
+    else:
+      raise UnsupportedShape('/'.join(path))
+  return columns
+
+
+def _flatten(model_type, prefix=(), nullable=False):
+  fields = [(name, info.annotation) for name, info in model_type.model_fields.items()]
+  return _flatten_fields(fields, prefix, nullable)
+
+
+def _as_column_value(obj):
+  if isinstance(obj, Enum):
+    return obj.value
+  if isinstance(obj, Path):
+    return str(obj)
+  return obj
+
+
+def _read(obj, path):
+  for p in path:
+    if obj is None:
+      return None
+    obj = getattr(obj, p)
+  return _as_column_value(obj)
+
+
+def _unflatten(columns, row):
+  result = {}
+  for column, path, _ in columns:
+    value = getattr(row, column)
+    if value is None:
+      continue
+    d = result
+    for p in path[:-1]:
+      d = d.setdefault(p, {})
+    d[path[-1]] = value
+  return result
+
+
+@dataclass
+class ColumnarSchema:
+  job_name: str
+  key_columns: list[str]
+  value_columns: list[tuple]
+  result_model: Any
+  list_field: Optional[str] = None
+  run_columns: list[tuple] = field(default_factory=list)
+  run_model: Any = None
+
+  def select_row(self, key):
+    M = self.result_model
+    query = M.select()
+    for c, v in zip(self.key_columns, key.key_values()):
+      query = query.where(getattr(M, c) == v)
+    return query.first()
+
+  def store(self, key, result, append=False):
+    with DATABASE.atomic():
+      values = {c: _read(result, path) for c, path, _ in self.value_columns}
+      row = self.select_row(key)
+      if row is None:
+        row = self.result_model.create(**dict(zip(self.key_columns, key.key_values())), **values)
+      else:
+        for k, v in values.items():
+          setattr(row, k, v)
+        row.save()
+      if self.list_field is not None:
+        if not append:
+          self.run_model.delete().where(self.run_model.parent == row).execute()
+        rows = [dict({c: _read(r, path) for c, path, _ in self.run_columns}, parent=row.id)
+                for r in getattr(result, self.list_field)]
+        for batch in pw.chunked(rows, 100):
+          self.run_model.insert_many(batch).execute()
+      return row
+
+  def load(self, output_type, key, since=None):
+    """Load the result for key. since, if given, is the first id of the runs table to include."""
+    row = self.select_row(key)
+    if row is None:
+      return None
+    obj = _unflatten(self.value_columns, row)
+    if self.list_field is not None:
+      runs = self.run_model.select().where(self.run_model.parent == row).order_by(self.run_model.id)
+      if since is not None:
+        runs = runs.where(self.run_model.id >= since)
+      obj[self.list_field] = [_unflatten(self.run_columns, r) for r in runs]
+    return output_type.model_validate(obj)
+
+  def next_run_id(self):
+    """A lower bound on the id of every run row stored from now on."""
+    return (self.run_model.select(pw.fn.MAX(self.run_model.id)).scalar() or 0) + 1
+
+  def column(self, name):
+    if name in [c for c, _, _ in self.run_columns]:
+      return getattr(self.run_model, name)
+    return getattr(self.result_model, name)
+
+  def has_column(self, col):
+    """
+    Whether the table of col has it. Tables created by older versions lack
+    the nullable columns added since, until init_db adds them in writable mode.
+    """
+    return col.column_name in [c.name for c in DATABASE.get_columns(col.model._meta.table_name)]
+
+  def aggregate(self, column, group_by, where=None, fn=pw.fn.AVG):
+    """
+    Return {group values: aggregated column} using a single GROUP BY query.
+    Columns of the runs child table are aggregated over all runs of a key.
+    """
+    M = self.result_model
+    col = self.column(column)
+    groups = [getattr(M, g) for g in group_by]
+    # A column the table lacks is NULL for every key.
+    value = fn(col) if self.has_column(col) else pw.SQL('NULL')
+    query = M.select(*groups, value.alias('value'))
+    if col.model is self.run_model:
+      query = query.join(self.run_model, on=(self.run_model.parent == M.id))
+    for k, v in (where or {}).items():
+      query = query.where(getattr(M, k) == _as_column_value(v))
+    query = query.group_by(*groups).tuples()
+    return {tuple(r[:-1]): r[-1] for r in query}
+
+  def percentile(self, column, q, group_by, where=None):
+    """
+    Return {group values: the q-th percentile (0-100) of column}, linearly
+    interpolated between the two closest samples like numpy's default. NULL
+    samples are ignored; a group with none has a None percentile.
+    """
+    M = self.result_model
+    col = self.column(column)
+    if not self.has_column(col):
+      return self.aggregate(column, group_by, where)
+    groups = [getattr(M, g) for g in group_by]
+    # NULLs sort last, so the samples are ranked 1..count.
+    query = M.select(*groups, col.alias('value'),
+                     pw.fn.ROW_NUMBER().over(partition_by=groups,
+                                             order_by=[col.is_null(), col]).alias('run_rank'),
+                     pw.fn.COUNT(col).over(partition_by=groups).alias('run_count'))
+    if col.model is self.run_model:
+      query = query.join(self.run_model, on=(self.run_model.parent == M.id))
+    for k, v in (where or {}).items():
+      query = query.where(getattr(M, k) == _as_column_value(v))
+    sql, params = query.sql()
+    # Keep the two samples around position (count - 1) * q / 100 of each group.
+    pos = 'CAST(MAX(run_count - 1, 0) * ? / 100.0 AS INTEGER)'
+    rows = DATABASE.execute_sql(
+        f'SELECT * FROM ({sql}) WHERE run_rank - 1 BETWEEN {pos} AND {pos} + 1',
+        params + [q, q])
+    samples = {}
+    for *group, value, rank, count in rows:
+      samples.setdefault(tuple(group), [count, {}])[1][rank - 1] = value
+    res = {}
+    for group, (count, values) in samples.items():
+      if count == 0:
+        res[group] = None
+        continue
+      pos = (count - 1) * q / 100.0
+      lo = math.floor(pos)
+      hi = values.get(lo + 1, values[lo])
+      res[group] = values[lo] + (hi - values[lo]) * (pos - lo)
+    return res
+
+
+def create_schema(job_type):
+  """Build the result (and runs) tables for a job type, or return None if its output cannot be flattened."""
+  job_name = job_type.job_name()
+  try:
+    key_columns = _flatten(job_type.key_type())
+    value_columns = []
+    list_field = None
+    run_columns = []
+    for name, info in job_type.output_type().model_fields.items():
+      annotation, _ = _unwrap_optional(info.annotation)
+      if get_origin(annotation) is list:
+        elem = get_args(annotation)[0]
+        if list_field is not None or not issubclass(elem, pydantic.BaseModel):
+          raise UnsupportedShape('%s.%s' % (job_name, name))
+        list_field = name
+        run_columns = _flatten(elem)
+      else:
+        value_columns += _flatten_fields([(name, info.annotation)])
+  except UnsupportedShape:
+    return None
+
+  key_names = [c for c, _, _ in key_columns]
+  if set(key_names) & set([c for c, _, _ in value_columns]):
+    return None
+  attrs = {c: f for c, _, f in key_columns + value_columns}
+  attrs['Meta'] = type('Meta', (), {
+      'table_name': _table_name(job_name),
+      'indexes': ((tuple(key_names), True),)
+  })
+  result_model = type(f'{job_name}Result', (LibcxxDBModel,), attrs)
+  schema = ColumnarSchema(job_name=job_name, key_columns=key_names,
+                          value_columns=value_columns, result_model=result_model)
+  if list_field is not None:
+    attrs = {c: f for c, _, f in run_columns}
+    attrs['parent'] = pw.ForeignKeyField(result_model, backref=list_field, on_delete='CASCADE')
+    attrs['Meta'] = type('Meta', (), {'table_name': _table_name(job_name) + f'_{list_field}'})
+    schema.list_field = list_field
+    schema.run_columns = run_columns
+    schema.run_model = type(f'{job_name}Run', (LibcxxDBModel,), attrs)
+  columnar_registry.add_as(job_name, schema)
+  if not DATABASE.is_closed():
+    db.ensure_tables([m for m in (schema.result_model, schema.run_model) if m is not None])
+  return schema
+
+
+def schema_for(job_type):
+  return columnar_registry.get(job_type.job_name(), None)
+
+
+def store(job, result, append=False):
+  if schema := schema_for(type(job)):
+    schema.store(job.key, result, append=append)
+
+
+def without_runs(job, result):
+  """A copy of result with its list field emptied."""
+  schema = schema_for(type(job))
+  assert schema is not None and schema.list_field is not None
+  return result.model_copy(update={schema.list_field: []})
+
+
+def load(job, since=None):
+  if schema := schema_for(type(job)):
+    return schema.load(job.output_type(), job.key, since)
+  return None
+
+
+def migrate():
+  """
+  Copy every DBDataPoint row into the columnar tables of the current
+  database. Running it again is harmless.
+  """
+  rows = DBDataPoint.select()
+  skipped = set()
+  with DATABASE.atomic():
+    for row in tqdm.tqdm(rows, total=rows.count()):
+      job_type = db.registry.get(row.job, None)
+      schema = job_type and schema_for(job_type)
+      if schema is None:
+        skipped.add(row.job)
+        continue
+      if schema.list_field is not None and not getattr(row.value, schema.list_field):
+        # The row of a key appended to by db_append is an empty marker, its
+        # samples are already in the runs table.
+        continue
+      schema.store(row.key, row.value)
+  for s in skipped:
+    rich.print(f'Skipped {s}: no columnar schema')
+
+
+def needs_migration():
+  """Whether DBDataPoint holds results but no columnar table does, as in a database written before them."""
+  if not DBDataPoint.table_exists() or not DBDataPoint.select().exists():
+    return False
+  for _, schema in columnar_registry.items():
+    if schema.result_model.table_exists() and schema.result_model.select().exists():
+      return False
+  return True
+
+
+if __name__ == '__main__':
+  # Run as a script, this module is __main__ while the job modules register
+  # their schemas in libcxx.columnar, so migrate through the latter.
+  import libcxx.columnar
+  import libcxx.jobs
+  import libcxx.jobs.git_stats
+  parser = argparse.ArgumentParser(description='Convert JSON DBDataPoint rows into the columnar tables')
+  parser.add_argument('--db', type=str, default=str(db.DATABASE_PATH))
+  args = parser.parse_args()
+  db.init_db(path=args.db)
+  libcxx.columnar.migrate()
@@ -5,6 +5,7 @@ LIBCXX_METRICS_ROOT =  Path(__file__).absolute().parent.parent.parent
 assert LIBCXX_METRICS_ROOT.is_dir()
 LIBCXX_VERSIONS_ROOT = LIBCXX_METRICS_ROOT / 'libcxx-versions'
 LIBCXX_INPUTS_ROOT = LIBCXX_METRICS_ROOT / 'inputs'
+CACHE_ROOT = Path(os.environ.get('LIBCXX_METRICS_CACHE', os.path.expanduser('~/.cache/libcxx-metrics')))
 assert LIBCXX_VERSIONS_ROOT.is_dir()
 
 LLVM_PROJECT_ROOT = Path(os.path.expanduser('~/llvm-project/'))
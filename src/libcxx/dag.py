@@ -0,0 +1,197 @@
+"""
+Runs jobs that consume the results and artifacts of other jobs.
+
+A job type declares its upstream jobs by overriding LibcxxJob.depends_on(),
+which maps a name to a Dependency on the plan of another job. Before a job
+runs, job.upstream[name] holds an Upstream with the upstream result and the
+artifacts the consumer asked for (files such as object files or time traces,
+see LibcxxJob.artifacts()).
+
+JobDAG runs the graph in topological order with as many jobs in flight as the
+JobScheduler admits. An upstream job whose stored result is fresh is not rerun
+unless a consumer needs its artifacts, which are never persisted; its result
+is read from the database in a thread, off the event loop. Artifacts are
+reference counted and released, and results dropped, as soon as the last
+consumer that reads them has finished.
+"""
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+import asyncio
+import random
+
+import rich
+import tqdm
+
+from libcxx.job import LibcxxJob, Upstream, RERUN_REPEATABLE
+from libcxx.scheduler import JobScheduler
+from libcxx.sink import ResultSink
+
+
+@dataclass(eq=False)
+class _Node:
+  plan: Any
+  # name -> (upstream node, requested artifact names)
+  deps: dict = field(default_factory=dict)
+  consumers: list = field(default_factory=list)
+  root: bool = False
+  run: bool = False
+  # Upstream nodes that have not finished yet.
+  waiting: int = 0
+  # Running consumers that still need the artifacts of this node.
+  refs: int = 0
+  # Running consumers that still need the result of this node.
+  pending: int = 0
+  job: Any = None
+  result: Any = None
+  # The read of the stored result of a node that does not run.
+  loading: Any = None
+  failed: bool = False
+
+
+class JobDAG:
+  def __init__(self, jobs, rerun_repeatable=RERUN_REPEATABLE):
+    self.nodes = {}
+    # Upstream nodes come before their consumers.
+    self.order = []
+    self.errors = []
+    for j in jobs:
+      self._add(j.as_plan(), ()).root = True
+    stale = LibcxxJob.filter_should_rerun([n.plan for n in self.order], rerun_repeatable)
+    self._select(set([p.db_key() for p in stale]))
+
+  def _add(self, plan, visiting):
+    key = plan.db_key()
+    if key in visiting:
+      raise RuntimeError('Dependency cycle through %s' % (plan,))
+    if node := self.nodes.get(key):
+      return node
+    node = _Node(plan)
+    for name, dep in plan.dependencies().items():
+      upstream = self._add(dep.plan, visiting + (key,))
+      node.deps[name] = (upstream, tuple(dep.artifacts))
+      upstream.consumers.append(node)
+    self.nodes[key] = node
+    self.order.append(node)
+    return node
+
+  def _select(self, stale):
+    """Decide which nodes run, visiting consumers before the jobs they depend on."""
+    for node in reversed(self.order):
+      node.run = node.run or (node.root and node.plan.db_key() in stale)
+      if not node.run:
+        continue
+      for upstream, artifacts in node.deps.values():
+        if artifacts:
+          upstream.refs += 1
+        upstream.run = upstream.run or bool(artifacts) or upstream.plan.db_key() in stale
+
+  def jobs_to_run(self):
+    return [n for n in self.order if n.run]
+
+  async def _load(self, node):
+    """The stored result of a node that does not run, read once for all its consumers."""
+    if node.loading is None:
+      node.job = node.plan.materialize()
+      node.loading = asyncio.ensure_future(asyncio.to_thread(node.job.db_get))
+    return await node.loading
+
+  async def _upstream(self, node):
+    res = {}
+    for name, (upstream, artifacts) in node.deps.items():
+      result = upstream.result if upstream.run else await self._load(upstream)
+      available = upstream.job.artifacts() if artifacts else {}
+      res[name] = Upstream(result, {a: available[a] for a in artifacts})
+    return res
+
+  async def _run_node(self, node, scheduler, sink):
+    if any([upstream.failed for upstream, _ in node.deps.values()]):
+      node.failed = True
+      return
+    try:
+      async with scheduler.reserve(node.plan):
+        node.job = node.plan.materialize()
+        node.job.upstream = await self._upstream(node)
+        node.result = await node.job.arun_measured()
+    except Exception as E:
+      rich.print(f'Job {node.plan.job_name()} {node.plan.values} failed: {E}')
+      self.errors.append(E)
+      node.result = None
+    if node.result is None:
+      node.failed = True
+      return
+    sink.put(node.job, node.result)
+
+  def _release(self, node):
+    if node.job is not None and node.run and node.refs == 0:
+      node.job.release_artifacts()
+
+  @staticmethod
+  def _drop(node):
+    if node.pending == 0:
+      node.job = node.result = node.loading = None
+
+  def _finish(self, node, queue):
+    for upstream, artifacts in node.deps.values():
+      if artifacts:
+        upstream.refs -= 1
+        self._release(upstream)
+      upstream.pending -= 1
+      self._drop(upstream)
+    self._release(node)
+    self._drop(node)
+    for consumer in node.consumers:
+      if not consumer.run:
+        continue
+      consumer.waiting -= 1
+      if consumer.waiting == 0:
+        queue.put_nowait(consumer)
+
+  async def _worker(self, queue, scheduler, sink, pbar, state):
+    while True:
+      node = await queue.get()
+      if node is None:
+        return
+      await self._run_node(node, scheduler, sink)
+      self._finish(node, queue)
+      pbar.update(1)
+      state['remaining'] -= 1
+      if state['remaining'] == 0:
+        for _ in range(state['workers']):
+          queue.put_nowait(None)
+
+  async def run(self, scheduler=None):
+    """Run every selected job. Raises the first job error after the whole graph has run."""
+    todo = self.jobs_to_run()
+    if not todo:
+      return
+    if scheduler is None:
+      scheduler = JobScheduler()
+    ready = []
+    for n in todo:
+      n.waiting = len([u for u, _ in n.deps.values() if u.run])
+      for u, _ in n.deps.values():
+        u.pending += 1
+      if n.waiting == 0:
+        ready.append(n)
+    random.shuffle(ready)
+    queue = asyncio.Queue()
+    for n in ready:
+      queue.put_nowait(n)
+    num_workers = min(scheduler.max_concurrency([n.plan for n in todo]), len(todo))
+    # Jobs wait for their commands (libcxx.utils.arun) in threads of the default
+    # executor, which holds at most min(32, CPUs + 4) threads; give every worker
+    # one, and a few more for the results read by _load.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(num_workers + 4))
+    state = {'remaining': len(todo), 'workers': num_workers}
+    with tqdm.tqdm(total=len(todo)) as pbar, ResultSink() as sink:
+      await asyncio.gather(*[asyncio.create_task(self._worker(queue, scheduler, sink, pbar, state))
+                             for _ in range(num_workers)])
+    if self.errors:
+      raise self.errors[0]
+
+
+async def async_run_dag(jobs, scheduler=None, rerun_repeatable=RERUN_REPEATABLE):
+  dag = JobDAG(jobs, rerun_repeatable)
+  await dag.run(scheduler)
+  return dag
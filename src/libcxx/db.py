@@ -9,6 +9,10 @@ from dataclasses import dataclass, field
 from typing import Any
 from threading import RLock
 import rich
+import json
+import hashlib
+import uuid
+from playhouse.migrate import SqliteMigrator, migrate
 from libcxx.registry import ClassRegistry
 
 registry = ClassRegistry()
@@ -48,9 +52,32 @@ class PydanticModelType(pw.TextField):
 
 
 DATABASE = pw.SqliteDatabase(None)
-DATABASE_PATH = Path(os.path.expanduser('~/.database/libcxx-info.db'))
+DATABASE_PATH = Path(os.environ.get('LIBCXX_METRICS_DB', os.path.expanduser('~/.database/libcxx-info.db')))
 DATABASE_TEST_PATH = Path(os.path.expanduser('~/.database/test/libcxx-info.db'))
 
+# WAL lets graph generation read while a collection run is writing. Every
+# process (and thread) opens its own connection with these pragmas.
+DATABASE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 60 * 1000,
+    'foreign_keys': 1,
+}
+
+_FORKED_CONNECTIONS = []
+
+def _reset_after_fork():
+  # The parent's sqlite3 connection must never be used (or closed, which can
+  # checkpoint the WAL) from the child. Drop it and let peewee reconnect lazily.
+  if DATABASE._state.conn is not None:
+    _FORKED_CONNECTIONS.append(DATABASE._state.conn)
+  DATABASE._state.reset()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
 class LibcxxDBModel(pw.Model):
   def __init_subclass__(cls, **kwargs):
     super().__init_subclass__(**kwargs)
@@ -59,22 +86,95 @@ class LibcxxDBModel(pw.Model):
   class Meta:
     database = DATABASE
 
+def key_digest(job, values):
+  """A signed 64-bit digest of the canonical (job, *key values) tuple."""
+  canonical = json.dumps([job] + list(values), separators=(',', ':'))
+  h = hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).digest()
+  return int.from_bytes(h, 'little', signed=True)
+
 class DBDataPoint(LibcxxDBModel):
   key = PydanticModelType()
   value = PydanticModelType()
   job = pw.TextField()
+  digest = pw.IntegerField(null=True)
+  # Identifies the inputs the value was computed from, see LibcxxJob.fingerprint().
+  fingerprint = pw.TextField(null=True)
 
   class Meta:
     database = DATABASE
     primary_key = pw.CompositeKey('key', 'job')
-
-def init_db(path=DATABASE_PATH):
+    indexes = (
+      (('job', 'digest'), True),
+    )
+
+class DatabaseInfo(LibcxxDBModel):
+  """A single row naming the database, so that libcxx.merge can tell databases apart."""
+  uuid = pw.TextField()
+
+def database_id():
+  if (row := DatabaseInfo.get_or_none()) is None:
+    row = DatabaseInfo.create(uuid=uuid.uuid4().hex)
+  return row.uuid
+
+def existing_fingerprints(jobs=None):
+  """
+  Map each (job, digest) pair stored in the database to its fingerprint,
+  loaded in a single scan over the (job, digest) index.
+  """
+  query = DBDataPoint.select(DBDataPoint.job, DBDataPoint.digest, DBDataPoint.fingerprint)
+  if jobs is not None:
+    query = query.where(DBDataPoint.job.in_(list(jobs)))
+  return {(job, digest): fingerprint for job, digest, fingerprint in DATABASE.execute(query)}
+
+def backfill_digests():
+  """Compute the digest of rows written before the column existed."""
+  rows = DATABASE.execute_sql('SELECT job, key FROM dbdatapoint WHERE digest IS NULL').fetchall()
+  with DATABASE.atomic():
+    for job, raw_key in rows:
+      wrapper = PydanticWrapper.model_validate_json(raw_key)
+      if wrapper.registry_key not in registry:
+        continue
+      digest = wrapper.object().digest()
+      DATABASE.execute_sql('UPDATE dbdatapoint SET digest = ? WHERE job = ? AND key = ?',
+                           (digest, job, raw_key))
+
+def _add_missing_columns(models):
+  """Add the nullable columns that existing tables of models were created without."""
+  migrator = SqliteMigrator(DATABASE)
+  for model in models:
+    if not model.table_exists():
+      continue
+    table = model._meta.table_name
+    present = [c.name for c in DATABASE.get_columns(table)]
+    for f in model._meta.sorted_fields:
+      if f.column_name not in present and f.null:
+        migrate(migrator.add_column(table, f.column_name, f))
+
+def ensure_tables(models):
+  _add_missing_columns(models)
+  DATABASE.create_tables(models)
+
+def init_db(path=DATABASE_PATH, readonly=False, pragmas=None):
+  """
+  Open the results database. With readonly=True the file is opened with
+  SQLite's mode=ro and no schema changes are made, which is what graph
+  generation uses while a collection run writes to the same file.
+  """
   if not DATABASE.is_closed():
     return
-  DATABASE.init(path)
+  pragmas = dict(DATABASE_PRAGMAS, **(pragmas or {}))
+  if readonly:
+    del pragmas['journal_mode']
+    DATABASE.init(f'file:{Path(path).absolute()}?mode=ro', pragmas=pragmas, uri=True)
+    DATABASE.connect()
+    return
+  Path(path).parent.mkdir(parents=True, exist_ok=True)
+  DATABASE.init(path, pragmas=pragmas)
   if DATABASE.is_closed():
     DATABASE.connect()
-    DATABASE.create_tables([v for k,v in db_types_registry.items()])
+    ensure_tables([v for k,v in db_types_registry.items()])
+    backfill_digests()
+    database_id()
 
 
 if __name__ == '__main__':
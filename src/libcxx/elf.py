@@ -0,0 +1,175 @@
+"""
+Section and symbol sizes of ELF64 files, read in process.
+
+ElfFile maps the file and unpacks the section headers and .symtab straight
+out of the mapping, so nothing but the names is copied and no tool has to be
+started per file. demangle() demangles the names of any number of files with
+a single llvm-cxxfilt (or c++filt) process.
+"""
+from pathlib import Path
+from typing import NamedTuple
+import mmap
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+from libcxx.utils import wait
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_SYMTAB_SHNDX = 18
+
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+STT_SECTION = 3
+STT_FILE = 4
+
+
+class ElfError(Exception):
+  pass
+
+
+class Section(NamedTuple):
+  name: str
+  type: int
+  offset: int
+  size: int
+  link: int
+
+  @property
+  def file_size(self):
+    return 0 if self.type == SHT_NOBITS else self.size
+
+
+class Symbol(NamedTuple):
+  name: str
+  section: int
+  value: int
+  size: int
+
+
+class ElfFile:
+  """The sections and sized symbols of the ELF64 file at path. Use as a context manager."""
+  def __init__(self, path):
+    self.path = Path(path)
+    with open(self.path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._data = memoryview(self._map)
+    try:
+      self._read_header()
+      self.sections = self._read_sections()
+    except (struct.error, ValueError) as E:
+      self.close()
+      raise ElfError(f'{self.path}: truncated ELF file ({E})')
+
+  def close(self):
+    self._data.release()
+    self._map.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @property
+  def file_size(self):
+    return len(self._map)
+
+  def _read_header(self):
+    ident = bytes(self._data[:16])
+    if ident[:4] != b'\x7fELF':
+      raise ElfError(f'{self.path}: not an ELF file')
+    if ident[4] != 2:
+      raise ElfError(f'{self.path}: not an ELF64 file')
+    self._order = {1: '<', 2: '>'}.get(ident[5])
+    if self._order is None:
+      raise ElfError(f'{self.path}: unknown ELF data encoding {ident[5]}')
+    (self._shoff, self._shentsize, self._shnum, self._shstrndx) = \
+        [struct.unpack_from(self._order + fmt, self._data, off)[0]
+         for fmt, off in [('Q', 0x28), ('H', 0x3a), ('H', 0x3c), ('H', 0x3e)]]
+
+  def _shdr(self, index):
+    name, type, _, _, offset, size, link, _, _, _ = struct.unpack_from(
+        self._order + 'IIQQQQIIQQ', self._data, self._shoff + index * self._shentsize)
+    return name, type, offset, size, link
+
+  def _string(self, table_offset, offset):
+    start = table_offset + offset
+    end = self._map.find(b'\0', start)
+    if end < 0:
+      raise ElfError(f'{self.path}: unterminated string')
+    return self._map[start:end].decode('utf-8', errors='replace')
+
+  def _read_sections(self):
+    if self._shoff == 0:
+      return []
+    # With more sections than fit the header, their number and the index of
+    # the name table are in section 0.
+    _, _, _, size0, link0 = self._shdr(0)
+    num = self._shnum or size0
+    shstrndx = link0 if self._shstrndx == SHN_XINDEX else self._shstrndx
+    headers = [self._shdr(i) for i in range(num)]
+    names_offset = headers[shstrndx][2]
+    return [Section(self._string(names_offset, name), type, offset, size, link)
+            for name, type, offset, size, link in headers]
+
+  def symbols(self):
+    """The symbols of .symtab that have a size and are defined in a section."""
+    symtab = [i for i, s in enumerate(self.sections) if s.type == SHT_SYMTAB]
+    if not symtab:
+      return []
+    index = symtab[0]
+    table = self.sections[index]
+    strings = self.sections[table.link].offset
+    # The section indices that do not fit st_shndx, one 32-bit word per symbol.
+    xindex = None
+    for s in self.sections:
+      if s.type == SHT_SYMTAB_SHNDX and s.link == index:
+        xindex = s.offset
+    res = []
+    entries = struct.iter_unpack(self._order + 'IBBHQQ', self._data[table.offset:table.offset + table.size])
+    for i, (name, info, _, shndx, value, size) in enumerate(entries):
+      if size == 0 or (info & 0xf) in (STT_SECTION, STT_FILE):
+        continue
+      if shndx == SHN_XINDEX and xindex is not None:
+        shndx = struct.unpack_from(self._order + 'I', self._data, xindex + 4 * i)[0]
+      elif shndx == SHN_UNDEF or shndx >= SHN_LORESERVE:
+        continue
+      res.append(Symbol(self._string(strings, name), shndx, value, size))
+    return res
+
+
+def find_demangler():
+  return shutil.which('llvm-cxxfilt') or shutil.which('c++filt')
+
+
+def demangle(names):
+  """{name: demangled name} with one demangler process, or the names themselves if there is none."""
+  names = list(set(names))
+  demangler = find_demangler()
+  if demangler is None or not names:
+    return {n: n for n in names}
+  # The demangler prints a line per name on stdout; its warnings go to a
+  # separate file, so they cannot shift the lines.
+  with tempfile.TemporaryFile() as f, tempfile.TemporaryFile() as err:
+    f.write('\n'.join(names).encode('utf-8') + b'\n')
+    f.seek(0)
+    started = time.monotonic()
+    proc = subprocess.Popen([demangler], stdin=f, stdout=subprocess.PIPE, stderr=err)
+    with proc:
+      out = proc.stdout.read()
+      wait(proc, started)
+    err.seek(0)
+    if proc.returncode != 0:
+      raise RuntimeError(f'{demangler} failed with code {proc.returncode}:\n{err.read().decode("utf-8", errors="replace")}')
+  demangled = out.decode('utf-8', errors='replace').split('\n')
+  if demangled[-1] == '':
+    demangled.pop()
+  if len(demangled) != len(names):
+    raise RuntimeError(f'{demangler} printed {len(demangled)} lines for {len(names)} names')
+  return dict(zip(names, demangled))
@@ -12,6 +12,7 @@ import asyncio
 from libcxx.job import *
 from libcxx.jobs.git_stats import *
 from libcxx.db import init_db
+import libcxx.columnar as columnar
 from jinja2 import Environment, FileSystemLoader
 
 from libcxx.registry import ClassRegistry
@@ -25,13 +26,20 @@ jinja_env = Environment(loader=file_loader)
 graph_register = ClassRegistry()
 
 def prepopulate():
-  jobs = LibcxxJob.all_jobs()
-  prepopulate_jobs_by_running_threaded(jobs)
+  plans = LibcxxJob.all_plans()
+  # Jobs that read the artifacts of other jobs run in a DAG together with those
+  # jobs, so that the artifacts are produced once.
+  in_dag = set()
+  for p in plans:
+    if deps := p.dependencies():
+      in_dag |= set([p.db_key()] + [d.plan.db_key() for d in deps.values()])
+  prepopulate_jobs_by_running_threaded([p for p in plans if p.db_key() not in in_dag])
+  asyncio.run(async_run_jobs([p for p in plans if p.db_key() in in_dag]))
 
 
 def aprepopulate():
-  jobs = LibcxxJob.all_jobs()
-  asyncio.run(async_run_jobs(jobs))
+  plans = LibcxxJob.all_plans()
+  asyncio.run(async_run_jobs(plans))
 
 
 class GraphDefinition(BaseModel):
@@ -42,19 +50,30 @@ class GraphDefinition(BaseModel):
   model_config = {'arbitrary_types_allowed': True}
 
 
-def generate_json(cls, *, x_key, x_label, x_values, key_parts, getter, y_label,
-    title):
+def generate_json(cls, *, x_key, x_label, x_values, key_parts, column, y_label,
+    title, scale=1, percentile=None):
+  """Graph the average of column for each x value and plotkey, or the given percentile of its runs."""
   x_values.sort()
   plotkeys = cls.plotkeys()
+  plot_fields = list(cls.plotkey_inputs().keys())
   data = {
       x_label: [x.value for x in x_values]
   }
-  dp = lambda **kwargs: getter(
-      cls.create_job(**kwargs).db_get(allow_missing=False))
+  as_value = lambda v: v.value if isinstance(v, Enum) else v
+  schema = columnar.schema_for(cls)
+  if percentile is None:
+    values = schema.aggregate(column, group_by=[x_key] + plot_fields, where=key_parts)
+  else:
+    values = schema.percentile(column, percentile, group_by=[x_key] + plot_fields, where=key_parts)
+  def dp(x, h):
+    group = (as_value(x),) + tuple([as_value(h.key_parts[f]) for f in plot_fields])
+    if group not in values:
+      raise RuntimeError("Cache entry missing for %s %s" % (cls.job_name(), group))
+    # Optional columns, such as perf counters, are NULL for keys measured without them.
+    return None if values[group] is None else values[group] * scale
 
   for h in plotkeys:
-    data[h.name] = list(
-        [dp(**{x_key: v}, **key_parts, **h.key_parts) for v in x_values])
+    data[h.name] = list([dp(v, h) for v in x_values])
 
   # Convert data to DataFrame
   df = pd.DataFrame(data)
@@ -105,56 +124,71 @@ class ArgPack:
 def generate_json_file(output_path):
 
   all_data = GraphStore()
-  def mk_data(name_prefix, cls,standard, getter, y_label, title):
+  def mk_data(name_prefix, cls,standard, column, y_label, title, scale=1, percentile=None):
       title = title + f' {standard.value}'
       key_name = f'{name_prefix}/{standard.value}'
       ret = generate_json(cls, x_label='version', x_key='libcxx',
                           x_values=cls.job_inputs()['libcxx'],
-                          key_parts={'standard': standard}, getter=getter,
-                          y_label=y_label,
-                          title=title)
+                          key_parts={'standard': standard}, column=column,
+                          scale=scale, y_label=y_label,
+                          title=title, percentile=percentile)
       all_data[key_name] = ret
   to_do = []
   for s in STD_DIALECTS:
     to_do += [
-      ArgPack('include/time', CompilerMetricsJob, s, lambda
-          x: x.compute_average().total_execution_time.milliseconds,
+      ArgPack('include/time', CompilerMetricsJob, s,
+              'total_execution_time_microseconds', scale=1e-3,
               y_label='milliseconds',
               title='Total Time'),
-      ArgPack('include/usr-time', CompilerMetricsJob,
-              s, lambda
-                  x: x.compute_average().user_execution_time.milliseconds,
+      ArgPack('include/time-p90', CompilerMetricsJob, s,
+              'total_execution_time_microseconds', scale=1e-3,
+              y_label='milliseconds', percentile=90,
+              title='Total Time (90th percentile)'),
+      ArgPack('include/usr-time', CompilerMetricsJob, s,
+              'user_execution_time_microseconds', scale=1e-3,
               y_label='milliseconds',
               title='User Time'),
-      ArgPack('include/memory', CompilerMetricsJob, s, lambda
-          x: x.compute_average().peak_memory_usage.kilobytes,
+      ArgPack('include/memory', CompilerMetricsJob, s,
+              'peak_memory_usage_kilobytes',
               y_label='Kilobytes',
               title='Peak Memory Usage'),
-      ArgPack('instantiate/time',
-              CompilerMetricsTestSourceJob, s, lambda
-                  x: x.compute_average().total_execution_time.milliseconds,
+      ArgPack('include/instructions', CompilerMetricsJob, s,
+              'perf_instructions', scale=1e-6,
+              y_label='millions of instructions',
+              title='Instructions Retired'),
+      ArgPack('instantiate/time', CompilerMetricsTestSourceJob, s,
+              'total_execution_time_microseconds', scale=1e-3,
               y_label='milliseconds', title='Total Time'),
-      ArgPack('instantiate/usr-time',
-              CompilerMetricsTestSourceJob, s, lambda
-                  x: x.compute_average().user_execution_time.milliseconds,
+      ArgPack('instantiate/time-p90', CompilerMetricsTestSourceJob, s,
+              'total_execution_time_microseconds', scale=1e-3,
+              y_label='milliseconds', percentile=90,
+              title='Total Time (90th percentile)'),
+      ArgPack('instantiate/usr-time', CompilerMetricsTestSourceJob, s,
+              'user_execution_time_microseconds', scale=1e-3,
               y_label='milliseconds', title='User Time'),
-      ArgPack('instantiate/memory',
-              CompilerMetricsTestSourceJob, s, lambda
-                  x: x.compute_average().peak_memory_usage.kilobytes,
+      ArgPack('instantiate/memory', CompilerMetricsTestSourceJob, s,
+              'peak_memory_usage_kilobytes',
               y_label='Kilobytes',
               title='Peak Memory Usage'),
-      ArgPack('include_size', IncludeSizeJob,
-              s, lambda x: x.line_count,
+      ArgPack('instantiate/instructions', CompilerMetricsTestSourceJob, s,
+              'perf_instructions', scale=1e-6,
+              y_label='millions of instructions',
+              title='Instructions Retired'),
+      ArgPack('include_size', IncludeSizeJob, s, 'line_count',
               y_label='LOC',
               title='Preprocessed LOC'),
-      ArgPack('symbol_count', StdSymbolsJob,
-              s, lambda x: x.symbol_count,
+      ArgPack('symbol_count', StdSymbolsJob, s, 'symbol_count',
               y_label='# Symbols',
               title='Visible Symbols'),
-      ArgPack('binary_size', BinarySizeJob,
-              s, lambda x: x.bytes,
+      ArgPack('binary_size', BinarySizeJob, s, 'bytes',
               y_label='bytes',
-              title='Object Size')
+              title='Object Size'),
+      ArgPack('binary_size/text', BinarySectionsJob, s, 'text_bytes',
+              y_label='bytes',
+              title='Code Size (.text)'),
+      ArgPack('binary_size/debug', BinarySectionsJob, s, 'debug_bytes',
+              y_label='bytes',
+              title='Debug Info Size (.debug_*)')
     ]
   for a in rich.progress.track(to_do, description='Generating graphs...'):
     a(mk_data)
@@ -167,7 +201,19 @@ def generate_json_file(output_path):
 
 
 if __name__ == '__main__':
-  init_db()
-  if '--run' in sys.argv or '--rerun' in sys.argv:
+  collect = '--run' in sys.argv or '--rerun' in sys.argv
+  if SHARD is not None:
+    # A shard only holds part of the results; graphs are generated after libcxx.merge.
+    init_db(path=SHARD.database_path())
+    prepopulate()
+    sys.exit(0)
+  init_db(readonly=not collect)
+  if columnar.needs_migration():
+    # The graphs only read the columnar tables.
+    if not collect:
+      rich.print('The results have not been migrated to the columnar tables, run python -m libcxx.columnar')
+      sys.exit(1)
+    columnar.migrate()
+  if collect:
     prepopulate()
   generate_json_file('/tmp/data.json')
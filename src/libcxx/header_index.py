@@ -0,0 +1,172 @@
+"""
+A persisted index of the headers of libc++ installs.
+
+For every include tree the index records each file's relative path, mtime,
+size, content digest and whether it is a libc++ header (mentions _LIBCPP).
+It is stored under the cache root and refreshed at most once per process:
+the tree is stat'ed, and only new or changed files are read, in parallel.
+Lookups of a header by name are dict lookups, and classifying an absolute
+path walks a trie of the tree roots, so neither touches the file system.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from libcxx.config import CACHE_ROOT
+
+INDEX_VERSION = 1
+
+
+class HeaderEntry(NamedTuple):
+  mtime_ns: int
+  size: int
+  digest: str
+  is_libcxx: bool
+
+
+def _read_entry(path, stamp):
+  h = hashlib.sha256()
+  is_libcxx = False
+  tail = b''
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+      # Keep the end of the previous chunk so a marker split across chunks is found.
+      is_libcxx = is_libcxx or b'_LIBCPP' in tail + chunk
+      tail = chunk[-7:]
+  return HeaderEntry(*stamp, h.hexdigest(), is_libcxx)
+
+
+class TreeIndex:
+  def __init__(self, root, files):
+    self.root = Path(root)
+    self.files = files
+
+  def digest(self):
+    """A digest of the relative path and content of every file in the tree."""
+    h = hashlib.sha256()
+    for rel in sorted(self.files):
+      h.update(('%s\0%s\0' % (rel, self.files[rel].digest)).encode('utf-8'))
+    return h.hexdigest()
+
+  def headers(self):
+    return [self.root / rel for rel, e in self.files.items() if e.is_libcxx]
+
+
+class HeaderIndex:
+  def __init__(self, root=CACHE_ROOT / 'header-index', workers=None):
+    self.root = Path(root)
+    self.workers = workers or min(32, os.cpu_count() or 1)
+    self._trees = {}
+    self._lock = threading.Lock()
+
+  def _index_path(self, tree):
+    key = hashlib.sha256(tree.encode('utf-8')).hexdigest()
+    return self.root / (key + '.json')
+
+  def _load(self, tree):
+    try:
+      data = json.loads(self._index_path(tree).read_text())
+    except (OSError, ValueError):
+      return {}
+    if data.get('version') != INDEX_VERSION:
+      return {}
+    return {rel: HeaderEntry(*e) for rel, e in data['files'].items()}
+
+  def _save(self, tree, files):
+    p = self._index_path(tree)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix='.tmp-', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+      json.dump({'version': INDEX_VERSION, 'tree': tree, 'files': files}, f)
+    os.replace(tmp, p)
+
+  @staticmethod
+  def _walk(tree):
+    # Symlinked directories are followed after the real ones, so files are
+    # listed under their real path, and each directory is read once, so a
+    # link back up the tree cannot loop.
+    seen = set()
+    dirs, links = [tree], []
+    while dirs or links:
+      path = dirs.pop() if dirs else links.pop()
+      st = os.stat(path)
+      if (st.st_dev, st.st_ino) in seen:
+        continue
+      seen.add((st.st_dev, st.st_ino))
+      with os.scandir(path) as it:
+        for e in it:
+          if e.is_dir():
+            (links if e.is_symlink() else dirs).append(e.path)
+          elif e.is_file():
+            st = e.stat()
+            yield os.path.relpath(e.path, tree), (st.st_mtime_ns, st.st_size)
+
+  def refresh(self, tree):
+    """Bring the persisted index of tree up to date, reading only new or changed files."""
+    tree = str(Path(tree).resolve())
+    old = self._load(tree)
+    files = {}
+    stale = []
+    for rel, stamp in self._walk(tree):
+      entry = old.get(rel)
+      if entry is not None and (entry.mtime_ns, entry.size) == stamp:
+        files[rel] = entry
+      else:
+        stale.append((rel, stamp))
+    if stale:
+      with ThreadPoolExecutor(self.workers) as pool:
+        entries = pool.map(lambda s: _read_entry(os.path.join(tree, s[0]), s[1]), stale)
+        files.update(zip([rel for rel, _ in stale], entries))
+    if stale or len(files) != len(old):
+      self._save(tree, files)
+    return TreeIndex(tree, files)
+
+  def tree(self, tree):
+    """The index of tree, refreshed the first time it is used in this process."""
+    key = str(Path(tree).resolve())
+    with self._lock:
+      if key not in self._trees:
+        self._trees[key] = self.refresh(key)
+      return self._trees[key]
+
+
+def _split(p):
+  return os.path.abspath(p).split(os.sep)
+
+
+class PathTrie:
+  """Maps an absolute path to the registered root it is under and the path relative to it."""
+  def __init__(self, roots):
+    self._root = {}
+    for r in roots:
+      node = self._root
+      for part in _split(r):
+        node = node.setdefault(part, {})
+      node.setdefault(None, Path(r))
+
+  def lookup(self, p):
+    """(root, relative path) for the deepest root p is under, or None."""
+    parts = _split(p)
+    node = self._root
+    found = None
+    for i, part in enumerate(parts):
+      if None in node:
+        found = (node[None], i)
+      if (node := node.get(part)) is None:
+        break
+    else:
+      if None in node:
+        found = (node[None], len(parts))
+    if found is None:
+      return None
+    root, i = found
+    return root, Path(*parts[i:]) if i < len(parts) else Path('.')
+
+
+HEADER_INDEX = HeaderIndex()
@@ -1,10 +1,17 @@
 from libcxx.types import *
 from pydantic import BaseModel, Field, model_validator
+from typing import NamedTuple
 import multiprocessing
 from pathlib import Path
-import os, re, sys, rich, tempfile, json,  asyncio, random
+import os, re, sys, rich, tempfile, json,  asyncio, random, hashlib
 import libcxx.db as db
+import libcxx.columnar as columnar
+import libcxx.cache as cache
 from libcxx.db import DBDataPoint, init_db
+from libcxx.sink import ResultSink
+from libcxx.scheduler import JobScheduler
+from libcxx.shard import SHARD
+from libcxx.utils import ChildUsage, measure_usage
 import itertools
 import tqdm
 import random
@@ -48,6 +55,9 @@ class PlotKey(BaseModel):
     return PlotKey.model_validate({'name': '/'.join([as_key(o) for k,o in kwargs.items()]), 'key_parts': dict(kwargs)})
 
 
+def _as_key_value(obj):
+  return obj.value if isinstance(obj, Enum) else obj
+
 class JobKey(BaseModel):
   @classmethod
   def job_name(cls):
@@ -66,6 +76,13 @@ class JobKey(BaseModel):
       parts += [getattr(self, f)]
     return tuple(parts)
 
+  def key_values(self):
+    """The key fields as plain JSON values, in the order they are stored."""
+    return tuple([_as_key_value(getattr(self, f)) for f in self.key_fields()])
+
+  def digest(self):
+    return db.key_digest(self.job_name(), self.key_values())
+
 
   def __hash__(self):
     return hash(self.key())
@@ -86,22 +103,87 @@ class JobKey(BaseModel):
 class JobOutput(BaseModel):
   hash_value : int
 
+
+class JobPlan(NamedTuple):
+  """
+  A lightweight, hashable stand-in for a job: its type and key field values.
+  Plans can be pruned against the database before anything is validated or
+  any directory is created; materialize() builds the real job.
+  """
+  job_type: type
+  values: tuple
+
+  def job_name(self):
+    return self.job_type.job_name()
+
+  def meta(self):
+    return self.job_type.meta()
+
+  def key_kwargs(self):
+    return dict(zip(self.job_type.key_type().key_fields(), self.values))
+
+  def db_key(self):
+    values = tuple([_as_key_value(v) for v in self.values])
+    return (self.job_name(), db.key_digest(self.job_type.key_type().job_name(), values))
+
+  def fingerprint(self, memo=None):
+    return self.job_type.key_fingerprint(self.key_kwargs(), memo)
+
+  def materialize(self):
+    return self.job_type.create_job(**self.key_kwargs())
+
+  def as_plan(self):
+    return self
+
+  def dependencies(self):
+    return self.job_type.depends_on(self.key_kwargs())
+
+
+class Dependency(NamedTuple):
+  """An upstream job, and the names of the artifacts of it the consumer reads."""
+  plan: JobPlan
+  artifacts: tuple = ()
+
+
+class Upstream(NamedTuple):
+  """What a consumer sees of a Dependency once the upstream job has finished."""
+  result: Any
+  artifacts: dict
+
+
+def materialize(job):
+  return job.materialize() if isinstance(job, JobPlan) else job
+
 JOBS_REGISTRY = set()
 
 class LibcxxJob(BaseModel):
   root_path : Optional[Path] = None
   key : Any
   libcxx: Optional[LibcxxInfo]
+  # Set by the DAG runner before the job runs, see depends_on().
+  upstream : dict[str, Any] = Field(exclude=True, default_factory=dict)
+  # What the child processes of the last run_measured() used, see libcxx.usage.
+  usage : Optional[ChildUsage] = Field(exclude=True, default=None)
+  # The fingerprint of the host that computed the result, when that is not
+  # this one (see libcxx.broker); db_store() records it instead of fingerprint().
+  computed_fingerprint : Optional[str] = Field(exclude=True, default=None)
 
   class Meta:
     repeatable = False
     runs_per_repeat = 50
+    # Samples a sweep measures per task for repeatable jobs, see libcxx.sweep.
+    runs_per_chunk = 10
+    # Resources used by the scheduler, see libcxx.scheduler.
+    cost = 1.0
+    memory_mb = 512
+    exclusive = False
 
   def __init_subclass__(cls, **kwargs):
     super().__init_subclass__(**kwargs)
     db.registry.add(cls.key_type())
     db.registry.add(cls.output_type())
     db.registry.add(cls)
+    columnar.create_schema(cls)
     global JOBS_REGISTRY
     JOBS_REGISTRY.add(cls)
 
@@ -111,13 +193,20 @@ class LibcxxJob(BaseModel):
     return list([j for j in JOBS_REGISTRY])
 
   @staticmethod
-  def all_jobs():
-    jobs = []
+  def all_plans(shard=SHARD):
+    """Every plan, or only those of shard (see libcxx.shard), shuffled."""
+    plans = []
     for jt in LibcxxJob.all_job_types():
-      jobs += jt.jobs()
+      plans += list(jt.plan())
+    if shard is not None:
+      plans = shard.select(plans)
+
+    random.shuffle(plans)
+    return plans
 
-    random.shuffle(jobs)
-    return jobs
+  @staticmethod
+  def all_jobs(shard=SHARD):
+    return [p.materialize() for p in LibcxxJob.all_plans(shard)]
 
   @classmethod
   def meta(cls):
@@ -137,19 +226,45 @@ class LibcxxJob(BaseModel):
     return {k: v for k,v in possible.items() if k in kf}
 
   @classmethod
-  def jobs(cls):
-    jlist = []
+  def plan(cls):
+    """Yield a JobPlan for every key of this job type without creating any job."""
+    fields = list(cls.key_type().key_fields())
     for k in cross_product(**cls.job_inputs()):
-      new_j = cls.create_job(**k)
-      jlist += [new_j]
-    if cls.meta().repeatable and RERUN_REPEATABLE:
-      new_jobs = []
-      for j in jlist:
-        for i in range(0, cls.meta().runs_per_repeat):
-          new_jobs += [j]
-      random.shuffle(new_jobs)
-      jlist = new_jobs
-    return list(jlist)
+      yield JobPlan(cls, tuple([k[f] for f in fields]))
+
+  @classmethod
+  def jobs(cls):
+    return [p.materialize() for p in cls.plan()]
+
+  @classmethod
+  def plan_for(cls, key_fields):
+    """The plan of this job type for the matching fields of another job's key."""
+    return JobPlan(cls, tuple([key_fields[f] for f in cls.key_type().key_fields()]))
+
+  def as_plan(self):
+    return self.plan_for({f: getattr(self.key, f) for f in self.key.key_fields()})
+
+  @classmethod
+  def depends_on(cls, key_fields):
+    """
+    The upstream jobs a job with these key fields consumes, as a dict of
+    name -> Dependency. Before the job runs, self.upstream[name] is an
+    Upstream holding the upstream result and requested artifacts. See
+    libcxx.dag.
+    """
+    return {}
+
+  def dependencies(self):
+    return self.as_plan().dependencies()
+
+  def artifacts(self):
+    """Files produced by the last run that consumers may request, by name."""
+    return {}
+
+  def release_artifacts(self):
+    """Called once no consumer needs the artifacts any more."""
+    for p in self.artifacts().values():
+      Path(p).unlink(missing_ok=True)
 
   @classmethod
   def plotkey_inputs(cls):
@@ -255,15 +370,69 @@ class LibcxxJob(BaseModel):
     job =  cls.model_validate({'key': key, 'libcxx': key.libcxx.load()})
     return job
 
+  @staticmethod
+  def _fingerprint_part(value):
+    if isinstance(value, TestInputs):
+      return value.digest()
+    if isinstance(value, LibcxxVersion):
+      info = value.load()
+      return [str(info.path), cache.HEADER_TREE_DIGESTS.libcxx_digest(info), info.flags()]
+    return _as_key_value(value)
+
+  @classmethod
+  def key_fingerprint(cls, key_fields, memo=None):
+    """
+    A digest of what a result for these key fields is computed from: the
+    resolved libc++ install, the digest of its headers and its flags, the
+    compiler version, and the content of the test inputs. It is stored with
+    every result, and a stored result whose fingerprint differs from the
+    current one is stale.
+
+    memo caches the parts per key value, for fingerprinting many keys at once.
+    """
+    memo = {} if memo is None else memo
+    parts = {'compiler': cache.default_compiler_id(), 'key': {}}
+    for k, v in key_fields.items():
+      if (type(v), v) not in memo:
+        memo[(type(v), v)] = LibcxxJob._fingerprint_part(v)
+      parts['key'][k] = memo[(type(v), v)]
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+  def fingerprint(self, memo=None):
+    return self.key_fingerprint({f: getattr(self.key, f) for f in self.key.key_fields()}, memo)
+
+  def run_measured(self, **kwargs):
+    """run(), adding up the rusage of the processes it starts into self.usage."""
+    with measure_usage() as meter:
+      res = self.run(**kwargs)
+    self.usage = meter.total
+    return res
+
+  async def arun_measured(self, **kwargs):
+    with measure_usage() as meter:
+      res = await self.arun(**kwargs)
+    self.usage = meter.total
+    return res
+
   def run_internal(self):
     raise NotImplementedError()
 
+  def want_more_runs(self, output, runs=None):
+    """Whether a repeatable job that measured output should keep measuring."""
+    return len(output) < (runs or self.meta().runs_per_repeat)
+
   def db_get(self, allow_missing=True):
-      obj = DBDataPoint.get_or_none(key=self.key, job=self.job_name())
+      obj = DBDataPoint.get_or_none(job=self.job_name(), digest=self.key.digest())
+      if obj and obj.fingerprint != self.fingerprint():
+        obj = None
       if obj:
         if isinstance(obj, tuple):
           assert False
-        return obj.value
+        value = obj.value
+        if self.meta().repeatable and not len(value):
+          # The samples live in the append-only runs table, see db_append.
+          value = columnar.load(self) or value
+        return value
       if not allow_missing:
         raise RuntimeError("Cache entry missing for %s" % self.key)
       return None
@@ -272,27 +441,54 @@ class LibcxxJob(BaseModel):
       assert not isinstance(result, tuple)
       assert isinstance(result, self.output_type())
 
-      obj, created = DBDataPoint.get_or_create(key=self.key, job=self.job_name(), defaults={'value': result})
+      if self.meta().repeatable:
+        return self.db_append(result)
+      fingerprint = self.computed_fingerprint or self.fingerprint()
+      obj, created = DBDataPoint.get_or_create(job=self.job_name(), digest=self.key.digest(),
+                                               defaults={'key': self.key, 'value': result,
+                                                         'fingerprint': fingerprint})
       if not created:
-        if self.meta().repeatable:
-          obj.value.extend(result)
-        else:
-          obj.value = result
+        obj.value = result
+        obj.fingerprint = fingerprint
         obj.save()
+      columnar.store(self, result)
       return obj
 
   def db_append(self, result):
+      """
+      Append the samples in result. The DBDataPoint row only records that the
+      key exists; each sample is a row in the columnar runs table, so storing
+      is O(len(result)) however many samples the key already has.
+      """
       assert self.meta().repeatable
-      obj, created = DBDataPoint.get_or_create(key=self.key, job=self.job_name(), defaults={'value': result})
-      if not created:
-        obj.value.extend(result)
-        obj.save()
+      marker = columnar.without_runs(self, result)
+      with db.DATABASE.atomic():
+        fingerprint = self.computed_fingerprint or self.fingerprint()
+        obj, created = DBDataPoint.get_or_create(job=self.job_name(), digest=self.key.digest(),
+                                                 defaults={'key': self.key, 'value': marker,
+                                                           'fingerprint': fingerprint})
+        # Samples computed from different inputs are replaced rather than extended.
+        # Rows written before fingerprints existed have none: their inputs are
+        # unknown, so their samples are kept.
+        append = created or obj.fingerprint in (None, fingerprint)
+        if append and len(obj.value):
+          # Move samples stored inline by older versions into the runs table.
+          columnar.store(self, obj.value)
+        if not created:
+          obj.value = marker
+          obj.fingerprint = fingerprint
+          obj.save()
+        columnar.store(self, result, append=append)
       return obj
 
   @classmethod
   def db_clear(cls):
       query = DBDataPoint.delete().where(DBDataPoint.job == cls.job_name())
       query.execute()
+      if schema := columnar.schema_for(cls):
+        if schema.run_model is not None:
+          schema.run_model.delete().execute()
+        schema.result_model.delete().execute()
 
   def should_rerun(self, rerun_repeatable=RERUN_REPEATABLE):
     if rerun_repeatable and self.meta().repeatable:
@@ -300,7 +496,29 @@ class LibcxxJob(BaseModel):
     return not self.db_contains()
 
   def db_contains(self):
-    return DBDataPoint.get_or_none(DBDataPoint.key == self.key) is not None
+    query = DBDataPoint.select(DBDataPoint.digest).where(
+        (DBDataPoint.job == self.job_name()) & (DBDataPoint.digest == self.key.digest()) &
+        (DBDataPoint.fingerprint == self.fingerprint()))
+    return query.exists()
+
+  def db_key(self):
+    return (self.job_name(), self.key.digest())
+
+  @staticmethod
+  def filter_should_rerun(jobs, rerun_repeatable=RERUN_REPEATABLE):
+    """
+    Bulk version of should_rerun() using a single scan of the database.
+    Accepts jobs or JobPlans. Results stored with a different fingerprint,
+    including rows written before fingerprints existed, are rerun.
+    """
+    missing = object()
+    existing = db.existing_fingerprints(set([j.job_name() for j in jobs]))
+    memo = {}
+    def want(j):
+      if rerun_repeatable and j.meta().repeatable:
+        return True
+      return existing.get(j.db_key(), missing) != j.fingerprint(memo)
+    return [j for j in jobs if want(j)]
 
   def __call__(self, rerun_repeatable=RERUN_REPEATABLE, cache=True):
     if cache and (not self.meta().repeatable or not rerun_repeatable):
@@ -328,7 +546,8 @@ def cross_product(**job_inputs):
 
 def run_return_job(job):
   try:
-    res = job.run()
+    job = materialize(job)
+    res = job.run_measured()
     return job, res
   except Exception as E:
     print(f'ERROR: \n{E}')
@@ -339,69 +558,40 @@ def run_return_job(job):
 def prepopulate_jobs_shuffeled(jobs):
   random.shuffle(jobs)
 
+def _check_no_dependencies(jobs):
+  if any([j.dependencies() for j in jobs]):
+    raise RuntimeError('Jobs with dependencies must be run with async_run_jobs')
+
 def prepopulate_jobs_by_running_threaded(jobs):
+  """Run the jobs in a process pool as a resumable sweep, see libcxx.sweep."""
+  from libcxx.sweep import run_sweep
   jobs = list(jobs)
   print('Have %d jobs' % len(jobs))
-  jobs = list([j for j in jobs if j.should_rerun()])
-  prepopulate_jobs_shuffeled(jobs)
-  if len(jobs) == 0:
-    return
-  with multiprocessing.Pool() as pool:
-    for job,res in tqdm.tqdm(pool.imap(run_return_job, jobs, chunksize=64), total=len(list(jobs))):
-      if res is None:
-        pass
-      job.db_store(res)
+  _check_no_dependencies(jobs)
+  run_sweep(jobs)
 
 def prepopulate_jobs_by_running_singlethread(jobs):
   if len(jobs) == 0:
     return
-  jobs = [j for j in jobs if j.should_rerun()]
-  for job in jobs:
-      res = job.run()
-      if res is None:
-        raise RuntimeError("IDK")
-      job.db_store(res)
+  jobs = LibcxxJob.filter_should_rerun(jobs)
+  _check_no_dependencies(jobs)
+  with ResultSink() as sink:
+    for job in jobs:
+        job = materialize(job)
+        res = job.run_measured()
+        if res is None:
+          raise RuntimeError("IDK")
+        sink.put(job, res)
 
 
 import asyncio
 from asyncio import Queue, Semaphore
 
 
-async def run_command_queue(done_event, queue, pbar):
-    while not done_event.is_set():
-          try:
-            job = await queue.get()
-            if job is None:
-                return
-            res = await job.arun()
-            job.db_store(res)
-          finally:
-            pbar.update(1)
-            queue.task_done()
-
-
-async def async_run_jobs(jobs):
+async def async_run_jobs(jobs, scheduler=None):
+  """Run the jobs that need rerunning and the upstream jobs they depend on, see libcxx.dag."""
+  from libcxx.dag import JobDAG
   print('Pruning the jobs')
-  jobs = [j for j in jobs if j.should_rerun()]
-  print('Shuffling the jobs')
-  random.seed(random.getrandbits(256))
-  random.shuffle(jobs)
-  NUM_THREADS = 64
-  with tqdm.tqdm(total=len(jobs)) as pbar:
-    done_event = asyncio.Event()
-    queue = asyncio.Queue()
-    workers = [run_command_queue(done_event, queue, pbar) for _ in range(NUM_THREADS)]
-    producer = [await queue.put(j) for j in jobs]
-
-
-    print('Stopping the workers')
-
-
-    print('Joining the queue')
-
-    await queue.join()
-    done_event.set()
-    await asyncio.gather(*workers)
-    print('done joining')
-  pbar.close()
-
+  dag = JobDAG(jobs)
+  print('Running %d jobs' % len(dag.jobs_to_run()))
+  await dag.run(scheduler)
@@ -4,6 +4,10 @@ from .symbols_count import StdSymbolsJob
 from .compiler_metrics import CompilerMetricsJob, CompilerMetricsList,\
   CompilerMetrics, CompilerMetricsTestSourceJob
 from .binary_size import BinarySizeJob
+from .binary_sections import BinarySectionsJob
+from .time_trace import TimeTraceJob, TimeTraceTestSourceJob
+from .include_graph import IncludeGraphJob
 
 __all__ = ["IncludeSizeJob", "StdSymbolsJob", "CompilerMetricsJob",
-           "CompilerMetricsList", "CompilerMetrics", "BinarySizeJob", "CompilerMetricsTestSourceJob"]
+           "CompilerMetricsList", "CompilerMetrics", "BinarySizeJob", "CompilerMetricsTestSourceJob",
+           "BinarySectionsJob", "TimeTraceJob", "TimeTraceTestSourceJob", "IncludeGraphJob"]
@@ -0,0 +1,145 @@
+"""
+Where the bytes of an object file go, by section and by symbol.
+
+BinarySizeJob only records the size of the object file, which debug info
+dominates when compiling with -g. BinarySectionsJob reads the object file
+BinarySizeJob compiled for the same (libcxx, standard, input, debug, optimize)
+key, as a libcxx.dag artifact, with the in-process ELF reader of libcxx.elf.
+It stores the file size of the sections by group (code, read-only data,
+unwind tables, debug info, ...) as columns, so code size and debug size graph
+separately, and the top Meta.top_n symbols by size. Symbols are grouped by
+their demangled name, so the complete and base object variants of a
+constructor or destructor count as one.
+
+  python -m libcxx.report sections [--top 20] a.o b.o ...
+
+breaks down any object files, demangling all their symbols in one process.
+"""
+from collections import defaultdict
+import asyncio
+
+from rich.table import Table
+
+from libcxx.types import *
+from libcxx.job import *
+from libcxx.elf import ElfFile, demangle
+from libcxx.jobs.binary_size import BinarySizeJob
+
+# The section groups stored as <group>_bytes columns, by the prefixes of their
+# section names. The sections of COMDAT groups, such as
+# .text._ZNSt6vectorIiSaIiEE9push_backEOi, count with their group. Anything
+# else, including the ELF and section headers and the symbol tables, counts as
+# other_bytes.
+SECTION_GROUPS = {
+    'text': ('.text', '.init', '.fini'),
+    'rodata': ('.rodata',),
+    'data': ('.data', '.tdata', '.init_array', '.fini_array'),
+    'eh_frame': ('.eh_frame', '.gcc_except_table'),
+    'debug': ('.debug_', '.zdebug_'),
+    'relocations': ('.rela.', '.rel.'),
+}
+
+MAX_NAME_LENGTH = 1024
+
+
+def section_group(name):
+  for group, prefixes in SECTION_GROUPS.items():
+    if name.startswith(prefixes):
+      return group
+  return 'other'
+
+
+class SymbolSize(BaseModel):
+  name: str
+  group: str
+  bytes: int
+
+
+class SectionSizes(BaseModel):
+  file_bytes: int = 0
+  text_bytes: int = 0
+  rodata_bytes: int = 0
+  data_bytes: int = 0
+  eh_frame_bytes: int = 0
+  debug_bytes: int = 0
+  relocations_bytes: int = 0
+  other_bytes: int = 0
+  symbols: list[SymbolSize] = Field(default_factory=list)
+
+
+def section_sizes(file_size, sections, symbols, top_n, demangled):
+  """Reduce the sections and symbols read by an ElfFile to SectionSizes."""
+  res = SectionSizes(file_bytes=file_size)
+  groups = [section_group(s.name) for s in sections]
+  for s, group in zip(sections, groups):
+    if group != 'other':
+      setattr(res, group + '_bytes', getattr(res, group + '_bytes') + s.file_size)
+  res.other_bytes = file_size - sum([getattr(res, g + '_bytes') for g in SECTION_GROUPS])
+  by_name = defaultdict(int)
+  seen = set()
+  for sym in symbols:
+    # A section index past the headers, read from a corrupt st_shndx or
+    # SHT_SYMTAB_SHNDX entry, has no group to count in.
+    if sym.section >= len(groups):
+      continue
+    # Aliases, such as the complete and base object constructors, share their bytes.
+    if (sym.section, sym.value) in seen:
+      continue
+    seen.add((sym.section, sym.value))
+    by_name[(demangled[sym.name][:MAX_NAME_LENGTH], groups[sym.section])] += sym.size
+  top = sorted(by_name.items(), key=lambda kv: -kv[1])[:top_n]
+  res.symbols = [SymbolSize(name=name, group=group, bytes=size) for (name, group), size in top]
+  return res
+
+
+def read_objects(paths, top_n):
+  """The SectionSizes of each object file, demangling the symbols of all of them at once."""
+  read = []
+  for p in paths:
+    with ElfFile(p) as elf:
+      read.append((elf.file_size, elf.sections, elf.symbols()))
+  demangled = demangle([s.name for _, _, symbols in read for s in symbols])
+  return [section_sizes(*r, top_n, demangled) for r in read]
+
+
+class BinarySectionsJob(LibcxxJob):
+  class Meta(LibcxxJob.Meta):
+    cost = 0.1
+    memory_mb = 128
+    # Symbols kept per object file.
+    top_n = 50
+
+  class Key(JobKey):
+    libcxx: LibcxxVersion
+    standard: Standard
+    input: TestInputs
+    debug: DebugOpts
+    optimize: OptimizerOpts
+
+  class Output(SectionSizes):
+    pass
+
+  @classmethod
+  def depends_on(cls, key_fields):
+    return {'object': Dependency(BinarySizeJob.plan_for(key_fields), artifacts=('object',))}
+
+  def run(self):
+    res = read_objects([self.upstream['object'].artifacts['object']], self.meta().top_n)[0]
+    return self.output_type().model_validate(res.model_dump())
+
+  async def arun(self):
+    return await asyncio.to_thread(self.run)
+
+
+def print_section_sizes(paths, top):
+  objects = read_objects(paths, top)
+  columns = list(SECTION_GROUPS) + ['other', 'file']
+  table = Table('object', *columns, title='Bytes by section group')
+  for p, res in zip(paths, objects):
+    table.add_row(str(p), *[str(getattr(res, c + '_bytes')) for c in columns])
+  rich.print(table)
+  for p, res in zip(paths, objects):
+    symbols = Table('symbol', 'group', 'bytes', title=f'Largest symbols of {p}')
+    for s in res.symbols:
+      symbols.add_row(s.name, s.group, str(s.bytes))
+    rich.print(symbols)
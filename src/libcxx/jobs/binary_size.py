@@ -1,13 +1,17 @@
 import asyncio
 
 from libcxx.types import *
+from libcxx.utils import run, arun
 from libcxx.job import LibcxxJob, JobKey
-import subprocess
 import shutil
 from types import SimpleNamespace
 import asyncio
 
 class BinarySizeJob(LibcxxJob):
+  class Meta(LibcxxJob.Meta):
+    cost = 2.0
+    memory_mb = 2048
+
   class Key(JobKey):
     libcxx: LibcxxVersion
     standard: Standard
@@ -22,30 +26,28 @@ class BinarySizeJob(LibcxxJob):
 
   def setup_state(self):
     self.state.input_file = self.key.input.path()
-    self.state.object_file = self.tmp_file('test.o')
+    self.state.object_file = self.artifacts()['object']
     flags = [self.key.debug.value, self.key.optimize.value]
     self.state.cmd = [shutil.which('clang++'), '-c',  self.key.standard.flag()] \
       + self.libcxx.include_flags() + flags  \
       + ['-I', str(LIBCXX_INPUTS_ROOT / 'include')] \
       + ['-o', str(self.state.object_file), '-xc++', str(self.state.input_file)]
 
+  def artifacts(self):
+    return {'object': self.tmp_file('test.o')}
+
   def run(self):
     self.setup_state()
-    proc = subprocess.Popen(self.state.cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    out,err = proc.communicate()
-    assert proc.poll() is not None
-    return self.postprocess_output(proc, out)
+    return self.postprocess_output(*run(self.state.cmd, check=False))
 
-  async def asrun(self):
+  async def arun(self):
     self.setup_state()
-    proc = await asyncio.create_subprocess_exec(*self.state.cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
-    out, _ = await proc.communicate()
-    return  self.postprocess_output(proc, out)
-
-  def postprocess_output(self, proc, out):
-    if proc.returncode != 0:
-      rich.print(f'Compilation failed for {self.state.input_file}.name with code {proc.returncode} for invocation:\n  {" ".join(self.state.cmd)}')
-      rich.print(out.decode('utf-8'))
+    return self.postprocess_output(*await arun(self.state.cmd, check=False))
+
+  def postprocess_output(self, returncode, out):
+    if returncode != 0:
+      rich.print(f'Compilation failed for {self.state.input_file}.name with code {returncode} for invocation:\n  {" ".join(self.state.cmd)}')
+      rich.print(out)
       return None
 
     stat = os.stat(self.state.object_file)
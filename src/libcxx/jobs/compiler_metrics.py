@@ -3,11 +3,64 @@ import asyncio
 from pydantic import BaseModel
 from libcxx.types import *
 from libcxx.job import *
+from libcxx.utils import arun, run
 import shutil
-import subprocess
 from types import SimpleNamespace as Namespace
 import asyncio
-import aiofiles
+import math
+import statistics
+import contextlib
+
+# Measure under `perf stat` as well, see PerfCounters.
+PERF_COUNTERS = '--perf-counters' in sys.argv
+
+PERF_EVENTS = ['instructions:u', 'cycles:u', 'task-clock', 'page-faults', 'context-switches']
+
+
+class PerfCounters(BaseModel):
+  instructions: Optional[int] = None
+  cycles: Optional[int] = None
+  task_clock_msec: Optional[float] = None
+  page_faults: Optional[int] = None
+  context_switches: Optional[int] = None
+
+  @staticmethod
+  def perf_stat_cmd(output_file):
+    return ['perf', 'stat', '-x,', '-o', str(output_file), '-e', ','.join(PERF_EVENTS), '--']
+
+  @staticmethod
+  def parse(content):
+    """
+    Parse the CSV written by `perf stat -x,`. Counts of the same event on
+    several PMUs (hybrid CPUs report cpu_core/... and cpu_atom/...) are summed;
+    events that were not counted or not supported are None.
+    """
+    fields = {
+        'instructions': 'instructions',
+        'cycles': 'cycles',
+        'task-clock': 'task_clock_msec',
+        'page-faults': 'page_faults',
+        'context-switches': 'context_switches',
+    }
+    values = {}
+    for line in content.splitlines():
+      parts = line.split(',')
+      if line.startswith('#') or len(parts) < 3:
+        continue
+      event = re.sub(r'^\w+/(.*)/$', r'\1', parts[2]).split(':')[0]
+      if event not in fields:
+        continue
+      try:
+        value = float(parts[0])
+      except ValueError:
+        continue
+      values[fields[event]] = values.get(fields[event], 0) + value
+    return PerfCounters.model_validate(values)
+
+
+def perf_instructions(r):
+  return r.perf.instructions if r.perf is not None else None
+
 
 class CompilerMetrics(BaseModel):
   filename: str
@@ -15,6 +68,7 @@ class CompilerMetrics(BaseModel):
   total_execution_time: Duration
   user_execution_time: Duration
   peak_memory_usage: MemoryUsage
+  perf: Optional[PerfCounters] = None
 
   @staticmethod
   def create_empty():
@@ -36,6 +90,19 @@ class CompilerMetricsList(JobOutput):
       raise RuntimeError("Bad type: %s" % type(other))
     self.runs.extend(other.runs)
 
+  def relative_confidence_interval(self, z=1.96, metric=lambda r: r.total_execution_time.microseconds):
+    """
+    Half-width of the confidence interval of the mean of a metric (total time
+    by default), relative to the mean. Runs where the metric is None are ignored.
+    """
+    times = [v for v in [metric(r) for r in self.runs] if v is not None]
+    if len(times) < 2:
+      return math.inf
+    mean = statistics.fmean(times)
+    if mean == 0:
+      return 0.0
+    return z * statistics.stdev(times) / math.sqrt(len(times)) / mean
+
   def compute_average(self):
     runs = self.runs
     N = len(self.runs)
@@ -61,9 +128,18 @@ class CompilerMetricsList(JobOutput):
 
 
 class CompilerMetricsJob(LibcxxJob):
-  class Meta:
+  class Meta(LibcxxJob.Meta):
     repeatable : bool = True
+    # A single job measures back to back, stopping after min_runs once the
+    # confidence interval is tight enough, and always after runs_per_repeat.
     runs_per_repeat : int = 250
+    min_runs : int = 10
+    # With perf counters the stop rule uses retired instructions, which
+    # barely vary between runs.
+    perf_min_runs : int = 3
+    max_relative_ci : float = 0.01
+    exclusive : bool = True
+    memory_mb : int = 1024
 
   class Key(JobKey):
     libcxx: LibcxxVersion
@@ -76,6 +152,7 @@ class CompilerMetricsJob(LibcxxJob):
 
   input_file : Path = Field(exclude=True, default_factory=Path)
   compiler: str = Field(exclude=True, default_factory=lambda: shutil.which('clang++'))
+  perf_counters: bool = Field(exclude=True, default_factory=lambda: PERF_COUNTERS)
 
   @model_validator(mode='after')
   def validate_state(self):
@@ -85,69 +162,92 @@ class CompilerMetricsJob(LibcxxJob):
     elif hasattr(self.key, 'input'):
       self.input_file = Path(self.key.input.path())
     assert self.compiler == shutil.which('clang++')
+    if self.perf_counters and shutil.which('perf') is None:
+      raise RuntimeError('--perf-counters requires perf')
     return self
 
 
-  def make_cmd(self, output_file):
-     return [self.compiler, '-o', '/dev/null', '-c'] + \
+  def make_cmd(self, output_file, perf_file=None):
+     perf = PerfCounters.perf_stat_cmd(perf_file) if perf_file is not None else []
+     return perf + [self.compiler, '-o', '/dev/null', '-c'] + \
           [self.key.standard.flag()] + self.libcxx.include_flags() + \
           ['-I', LIBCXX_INPUTS_ROOT / 'include'] + \
           [f'-fproc-stat-report={output_file}'] + \
           ['-xc++', str(self.input_file)]
 
 
-  def run(self, runs=1):
+  def want_more_runs(self, output, runs=None):
+    """
+    Keep measuring until the 95% confidence interval of the mean total time
+    (or of the retired instructions, with perf counters) is within
+    max_relative_ci of the mean, bounded by [min_runs, runs_per_repeat].
+    """
+    if runs is not None:
+      return len(output) < runs
+    meta = self.meta()
+    if self.perf_counters:
+      min_runs, ci = meta.perf_min_runs, output.relative_confidence_interval(metric=perf_instructions)
+    else:
+      min_runs, ci = meta.min_runs, output.relative_confidence_interval()
+    if len(output) < min_runs:
+      return True
+    if len(output) >= meta.runs_per_repeat:
+      return False
+    return ci > meta.max_relative_ci
+
+  @staticmethod
+  def parse_stat_report(content):
+    csv = [p.strip() for p in content.strip().splitlines()[0].split(',') if p.strip()]
+    return CompilerMetrics.model_validate({
+        'filename': csv[0],
+        'output_filename': csv[1],
+        'total_execution_time': {
+            'microseconds': int(csv[2])
+        },
+        'user_execution_time': {
+            'microseconds': int(csv[3])
+        },
+        'peak_memory_usage': {
+            'kilobytes': int(csv[4])
+        }
+    })
+
+  def parse_reports(self, content, perf_file):
+    """
+    The metrics of one compile, as clang reports them for its own process, so
+    perf stat running around it does not count. The rusage of the run,
+    perf included, is recorded separately as the job's usage (libcxx.usage).
+    """
+    metrics = self.parse_stat_report(content)
+    if perf_file is not None:
+      metrics.perf = PerfCounters.parse(perf_file.read_text())
+    return metrics
+
+  def perf_file_guard(self):
+    if not self.perf_counters:
+      return contextlib.nullcontext(None)
+    return self.tmp_file_guard('perf.txt')
+
+  def run(self, runs=None):
     output = self.output_type().model_validate({'hash_value': self.hash_value()})
-    with self.tmp_file_guard('results.txt') as output_filename:
-      cmd = self.make_cmd(output_filename)
-      for i in range(0, runs):
-        out = subprocess.check_output(cmd).decode('utf-8').strip()
-        csv = [p.strip() for p in output_filename.read_text().strip().splitlines()[0].split(',') if p.strip()]
-        tmp_out = CompilerMetrics.model_validate({
-            'filename': csv[0],
-            'output_filename': csv[1],
-            'total_execution_time': {
-                'microseconds': int(csv[2])
-            },
-            'user_execution_time': {
-                'microseconds': int(csv[3])
-            },
-            'peak_memory_usage': {
-                'kilobytes': int(csv[4])
-            }
-        })
-        output.append(tmp_out)
+    with self.tmp_file_guard('results.txt') as output_filename, self.perf_file_guard() as perf_file:
+      cmd = self.make_cmd(output_filename, perf_file)
+      while self.want_more_runs(output, runs):
+        # clang appends to the report, so start each run from an empty file.
+        output_filename.write_text('')
+        run(cmd)
+        output.append(self.parse_reports(output_filename.read_text(), perf_file))
     return output
 
 
-  async def arun(self, runs=1):
+  async def arun(self, runs=None):
     output = self.output_type().model_validate({'hash_value': self.hash_value()})
-    with self.tmp_file_guard('results.txt') as output_filename:
-      cmd = self.make_cmd(output_filename)
-      for i in range(0, runs):
-        process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
-        stdout, _ = await process.communicate()
-        out = stdout.decode('utf-8').strip()
-        if process.returncode != 0:
-          raise RuntimeError('Process %s failed with return code %s and output: %s' % (cmd, process.returncode, out))
-        assert process.returncode == 0
-        async with aiofiles.open(output_filename, mode='r') as f:
-          content = await f.read()
-        csv = [p.strip() for p in content.splitlines()[0].split(',') if p.strip()]
-        tmp_out = CompilerMetrics.model_validate({
-            'filename': csv[0],
-            'output_filename': csv[1],
-            'total_execution_time': {
-                'microseconds': int(csv[2])
-            },
-            'user_execution_time': {
-                'microseconds': int(csv[3])
-            },
-            'peak_memory_usage': {
-                'kilobytes': int(csv[4])
-            }
-        })
-        output.append(tmp_out)
+    with self.tmp_file_guard('results.txt') as output_filename, self.perf_file_guard() as perf_file:
+      cmd = self.make_cmd(output_filename, perf_file)
+      while self.want_more_runs(output, runs):
+        output_filename.write_text('')
+        await arun(cmd)
+        output.append(self.parse_reports(output_filename.read_text(), perf_file))
     return output
 
 
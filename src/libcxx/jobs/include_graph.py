@@ -0,0 +1,211 @@
+"""
+The include graph of every public header, and what each internal header costs.
+
+IncludeGraphJob reads the linemarkers of the preprocessed TU of a (libcxx,
+standard, header), the same .ii IncludeSizeJob counts (see
+libcxx.cache.preprocess), so no extra compile is needed. It stores the
+inclusion tree: each file that was entered, the file that first included it,
+and the preprocessed lines it contributes by itself and with everything first
+included through it. Lines are counted like IncludeSizeJob counts them. libc++
+headers are named relative to the include directory (`vector`,
+`__algorithm/find.h`) so that versions compare.
+
+  python -m libcxx.report includes --libcxx 16.0.0 --standard c++20
+  python -m libcxx.report includes --old 15.0.0 --new 16.0.0 --standard c++20 --header vector
+
+The first lists the internal `__*` headers by how many public headers pull them
+in and how many lines they bring. The second shows which files account for
+the growth of one header's TU.
+"""
+from collections import defaultdict
+import re
+
+from rich.table import Table
+
+from libcxx.types import *
+from libcxx.job import *
+from libcxx.cache import preprocess, apreprocess
+import libcxx.columnar as columnar
+
+TU_NAME = '<input>'
+
+_LINEMARKER = re.compile(r'# (\d+) "((?:[^"\\]|\\.)*)"((?: \d+)*)\s*$')
+
+
+class IncludedFile(BaseModel):
+  path: str
+  # The index of the file that first included this one, -1 for the TU.
+  includer: int
+  lines: int
+  total_lines: int
+
+
+class IncludeGraph(BaseModel):
+  line_count: int
+  files: list[IncludedFile] = Field(default_factory=list)
+
+
+def read_include_tree(f, rename=lambda path: path):
+  """
+  Build the inclusion tree from the linemarkers of the preprocessed output in
+  the text file f. Files are listed in the order they were first entered, so
+  an includer always comes before the files it included.
+  """
+  files = []
+  index = {}
+  stack = []
+
+  def enter(path, includer):
+    if path not in index:
+      index[path] = len(files)
+      files.append(IncludedFile(path=path, includer=includer, lines=0, total_lines=0))
+    stack.append(index[path])
+
+  for line in f:
+    if line.startswith('# ') and (m := _LINEMARKER.match(line)):
+      path = re.sub(r'\\(.)', r'\1', m.group(2))
+      flags = m.group(3).split()
+      if path.startswith('<'):
+        # <built-in> and <command line> only hold directives.
+        continue
+      if not files:
+        tu = path
+      path = TU_NAME if path == tu else rename(path)
+      if '1' in flags or not stack:
+        enter(path, stack[-1] if stack else -1)
+      elif path in index and index[path] in stack:
+        # Back in an includer: flag 2, or gcc's bare marker for the TU after <command-line>.
+        while stack[-1] != index[path]:
+          stack.pop()
+      continue
+    l = line.strip()
+    if l and not l.startswith('#') and stack:
+      files[stack[-1]].lines += 1
+
+  for f in files:
+    f.total_lines = f.lines
+  for f in reversed(files):
+    if f.includer >= 0:
+      files[f.includer].total_lines += f.total_lines
+  return files
+
+
+def is_internal_header(path):
+  return any([p.startswith('__') for p in Path(path).parts])
+
+
+class IncludeGraphJob(LibcxxJob):
+  class Meta(LibcxxJob.Meta):
+    cost = 0.5
+    memory_mb = 256
+
+  class Key(JobKey):
+    libcxx: LibcxxVersion
+    standard: Standard
+    header: STLHeader
+
+  class Output(IncludeGraph):
+    pass
+
+  def input_file(self):
+    return self.tmp_file('input.cpp',
+                         '#include <%s>\nint main() {\n}\n' % self.key.header.value)
+
+  def rename(self, path):
+    if self.libcxx.is_libcxx_header(path):
+      return str(self.libcxx.relative_header_path(path))
+    return path
+
+  def postprocess_output(self, preprocessed):
+    with open(preprocessed.path, 'r', encoding='utf-8') as f:
+      files = read_include_tree(f, self.rename)
+    return self.output_type().model_validate({'line_count': files[0].total_lines if files else 0,
+                                              'files': files})
+
+  def run(self):
+    return self.postprocess_output(preprocess(self.libcxx, self.key.standard, self.input_file()))
+
+  async def arun(self):
+    return self.postprocess_output(await apreprocess(self.libcxx, self.key.standard, self.input_file()))
+
+
+def load_include_trees(libcxx, standard):
+  """{public header: [IncludedFile]} for every stored IncludeGraphJob result of (libcxx, standard)."""
+  schema = columnar.schema_for(IncludeGraphJob)
+  R, F = schema.result_model, schema.run_model
+  query = F.select(R.header, F.path, F.includer, F.lines, F.total_lines).join(R, on=(F.parent == R.id)) \
+      .where((R.libcxx == libcxx.value) & (R.standard == standard.value)).order_by(F.id)
+  res = defaultdict(list)
+  for header, path, includer, lines, total_lines in query.tuples():
+    res[header].append(IncludedFile(path=path, includer=includer, lines=lines, total_lines=total_lines))
+  return res
+
+
+def include_dag(trees):
+  """
+  The union of the inclusion trees as a networkx DiGraph of includer -> included
+  file, without the TUs. Nodes carry their 'lines'. Merging the trees recovers
+  include edges that a single TU hides because the file was already included.
+  """
+  import networkx as nx
+  G = nx.DiGraph()
+  for files in trees.values():
+    for f in files:
+      if f.includer < 0:
+        continue
+      G.add_node(f.path, lines=f.lines)
+      if files[f.includer].includer >= 0:
+        G.add_edge(files[f.includer].path, f.path)
+  return G
+
+
+def internal_header_costs(libcxx, standard):
+  """
+  For each internal header of (libcxx, standard): (path, number of public
+  headers that transitively include it, its own lines, its lines plus those of
+  every file it transitively includes), most expensive first.
+  """
+  import networkx as nx
+  trees = load_include_trees(libcxx, standard)
+  G = include_dag(trees)
+  public = set(trees.keys())
+  res = []
+  for node in G:
+    if not is_internal_header(node):
+      continue
+    pulled_in_by = len(nx.ancestors(G, node) & public)
+    transitive = G.nodes[node]['lines'] + sum([G.nodes[d]['lines'] for d in nx.descendants(G, node)])
+    res.append((node, pulled_in_by, G.nodes[node]['lines'], transitive))
+  return sorted(res, key=lambda r: -r[1] * r[3])
+
+
+def header_growth(old, new, standard, header):
+  """(path, first includer in new, lines in old and new, total lines in old and new) for header's TU."""
+  trees = [load_include_trees(v, standard).get(header.value, []) for v in (old, new)]
+  by_path = [{f.path: f for f in files} for files in trees]
+  res = []
+  for path in set(by_path[0]) | set(by_path[1]):
+    a, b = by_path[0].get(path), by_path[1].get(path)
+    f, files = (b, trees[1]) if b else (a, trees[0])
+    includer = files[f.includer].path if f.includer >= 0 else ''
+    res.append((path, includer, a and a.lines, b and b.lines, a and a.total_lines, b and b.total_lines))
+  return sorted(res, key=lambda r: -((r[3] or 0) - (r[2] or 0)))
+
+
+def print_internal_header_costs(libcxx, standard, top):
+  table = Table('internal header', 'public headers', 'lines', 'transitive lines',
+                title=f'Internal headers of {libcxx.value} in {standard.value}')
+  for path, pulled_in_by, lines, transitive in internal_header_costs(libcxx, standard)[:top]:
+    table.add_row(path, str(pulled_in_by), str(lines), str(transitive))
+  rich.print(table)
+
+
+def print_header_growth(old, new, standard, header, top):
+  fmt = lambda v: '-' if v is None else str(v)
+  table = Table('file', 'first included by', f'lines {old.value}', f'lines {new.value}',
+                f'total {old.value}', f'total {new.value}',
+                title=f'<{header.value}> in {standard.value}, by growth of the lines of each file')
+  for path, includer, *counts in header_growth(old, new, standard, header)[:top]:
+    table.add_row(path, includer, *[fmt(c) for c in counts])
+  rich.print(table)
+
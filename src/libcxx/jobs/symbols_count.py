@@ -2,9 +2,11 @@ import asyncio
 
 from libcxx.job import *
 from libcxx.types import *
-import subprocess
+from libcxx.utils import run, arun
+from libcxx.cache import preprocess, apreprocess
 import re
 import shutil
+from rich.table import Table
 from libcxx.db import registry
 from types import SimpleNamespace
 
@@ -16,6 +18,8 @@ QUERY_STR = \
   '''.strip() + '\n'
 
 class StdSymbolsJob(LibcxxJob):
+  class Meta(LibcxxJob.Meta):
+    memory_mb = 1024
 
   class Key(JobKey):
     libcxx: LibcxxVersion
@@ -25,18 +29,22 @@ class StdSymbolsJob(LibcxxJob):
   class Output(BaseModel):
     symbol_count: int
 
-  state : Any = Field(exclude=True, default=SimpleNamespace)
+  state : Any = Field(exclude=True, default_factory=SimpleNamespace)
 
-  def setup_state(self):
-    self.state.input_file = self.tmp_file('input.cpp',
-                               '#include <%s>\nint main() {\n}\n' % self.key.header.value)
+  def input_file(self):
+    return self.tmp_file('input.cpp',
+                         '#include <%s>\nint main() {\n}\n' % self.key.header.value)
 
+  def setup_state(self, preprocessed):
+    # clang-query runs over the cached preprocessed TU shared with IncludeSizeJob.
+    # Line markers keep the system header regions, so the AST is unchanged.
+    self.state.input_file = preprocessed.path
 
     self.state.db_file = self.tmp_file('compile_commands.json',
                             CompilationDatabaseEntry.model_validate({
                                 'directory': self.tmp_path,
                                 'file': self.state.input_file,
-                                'arguments': [shutil.which('clang++'),  self.key.standard.flag(), '-c'] + self.libcxx.include_flags() + ['-xc++', str(input_file)]
+                                'arguments': [shutil.which('clang++'),  self.key.standard.flag(), '-c'] + ['-xc++-cpp-output', str(self.state.input_file)]
                             }).as_database().model_dump_json(indent=2))
 
 
@@ -45,8 +53,23 @@ class StdSymbolsJob(LibcxxJob):
                  '-p', self.state.db_file] + [self.state.input_file]
 
 
-  def postprocess_output(self, output):
-    out = output.decode('utf-8').strip()
+  def source_query_cmd(self):
+    """The query over the source TU, compiled with the include flags, as before the .ii was shared."""
+    input_file = self.input_file()
+    db_file = self.tmp_file('source/compile_commands.json',
+                            CompilationDatabaseEntry.model_validate({
+                                'directory': self.tmp_path,
+                                'file': input_file,
+                                'arguments': [shutil.which('clang++'),  self.key.standard.flag(), '-c'] + self.libcxx.include_flags() + ['-xc++', str(input_file)]
+                            }).as_database().model_dump_json(indent=2))
+    return [shutil.which('clang-query'), '-f', self.tmp_file('matcher.txt', QUERY_STR),
+            '-p', db_file, input_file]
+
+  def source_count(self):
+    """The symbol count of the query over the source TU, see check_symbol_counts()."""
+    return self.postprocess_output(run(self.source_query_cmd())[1]).symbol_count
+
+  def postprocess_output(self, out):
     last_line_re = re.compile('(?P<COUNT>\d+) matches.')
     m = last_line_re.match(out.splitlines()[-1])
     return StdSymbolsJob.Output.model_validate({
@@ -54,17 +77,29 @@ class StdSymbolsJob(LibcxxJob):
     })
 
   def run(self):
-    self.setup_state()
-    out = subprocess.check_output(self.state.query_cmd)
+    self.setup_state(preprocess(self.libcxx, self.key.standard, self.input_file()))
+    _, out = run(self.state.query_cmd)
     return self.postprocess_output(out)
 
   async def arun(self):
-    self.setup_state()
-    process = await asyncio.create_subprocess_exec(*self.state.query_cmd,
-      stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
-    stdout, _ = await process.communicate()
-    if process.returncode != 0:
-      raise RuntimeError('Process %s failed with %s \nstdout:\n%s\n' % (self.cmd, process.returncode,
-      stdout.decode('utf-8')))
-    return self.postprocess_output(stdout)
+    self.setup_state(await apreprocess(self.libcxx, self.key.standard, self.input_file()))
+    _, out = await arun(self.state.query_cmd)
+    return self.postprocess_output(out)
+
 
+def check_symbol_counts(libcxx, standard, headers):
+  """
+  Compare the count StdSymbolsJob gets from the shared preprocessed TU with
+  the query over the source TU, which needs the install's include flags.
+  Prints a table and returns the (header, preprocessed, source) that differ.
+  """
+  table = Table('header', 'preprocessed', 'source', title=f'Symbols of {libcxx.value} {standard.value}')
+  mismatches = []
+  for header in headers:
+    job = StdSymbolsJob.create_job(libcxx=libcxx, standard=standard, header=header)
+    counts = (job.run().symbol_count, job.source_count())
+    table.add_row(header.value, *[str(c) for c in counts])
+    if counts[0] != counts[1]:
+      mismatches.append((header, *counts))
+  rich.print(table)
+  return mismatches
@@ -0,0 +1,258 @@
+"""
+Where the compile time of a TU goes, from clang's -ftime-trace.
+
+TimeTraceJob compiles a (libcxx, standard, header) TU, and TimeTraceTestSourceJob
+a TestInputs TU, with -ftime-trace. It stream-parses the Chrome trace and keeps
+clang's per-phase totals, plus the top Meta.top_n Source (the parsing of one
+included file), InstantiateClass and InstantiateFunction hot spots by self time.
+Self time excludes the nested events of the same kind, so a header is not
+charged for the headers it includes. libc++ headers are named relative to the
+include directory, like IncludeGraphJob does, and inputs relative to <inputs>,
+so that versions compare.
+
+  python -m libcxx.report time-trace --old 15.0.0 --new 16.0.0 [--standard c++20] [--inputs]
+
+reports what got slower between two versions, see diff_report().
+"""
+from collections import defaultdict
+import asyncio
+import json
+import re
+
+import peewee as pw
+from rich.table import Table
+
+from libcxx.types import *
+from libcxx.job import *
+from libcxx.utils import run, arun
+import libcxx.columnar as columnar
+
+HOT_SPOT_KINDS = ['Source', 'InstantiateClass', 'InstantiateFunction']
+
+# The "Total <name>" events clang emits, by output field.
+TOTALS = {
+    'execute_compiler_usec': 'Total ExecuteCompiler',
+    'frontend_usec': 'Total Frontend',
+    'backend_usec': 'Total Backend',
+    'source_usec': 'Total Source',
+    'instantiate_class_usec': 'Total InstantiateClass',
+    'instantiate_function_usec': 'Total InstantiateFunction',
+}
+
+MAX_NAME_LENGTH = 1024
+
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_trace_events(f, chunk_size=1 << 20):
+  """
+  Yield the events of the traceEvents array of the Chrome trace JSON in the
+  text file f one at a time, so only a chunk of the file is held in memory.
+  """
+  decoder = json.JSONDecoder()
+  buf = ''
+  while (start := buf.find('"traceEvents"')) < 0 or buf.find('[', start) < 0:
+    chunk = f.read(chunk_size)
+    if not chunk:
+      raise ValueError('No traceEvents array in the trace')
+    buf += chunk
+  pos = buf.find('[', start) + 1
+  eof = False
+  while True:
+    pos = _SEPARATORS.match(buf, pos).end()
+    if pos < len(buf) and buf[pos] == ']':
+      return
+    try:
+      event, pos = decoder.raw_decode(buf, pos)
+    except json.JSONDecodeError:
+      if eof:
+        raise
+      chunk = f.read(chunk_size)
+      eof = not chunk
+      buf = buf[pos:] + chunk
+      pos = 0
+      continue
+    yield event
+
+
+class HotSpot(BaseModel):
+  kind: str
+  name: str
+  count: int
+  self_usec: int
+  total_usec: int
+
+
+class TimeTraceSummary(BaseModel):
+  execute_compiler_usec: int = 0
+  frontend_usec: int = 0
+  backend_usec: int = 0
+  source_usec: int = 0
+  instantiate_class_usec: int = 0
+  instantiate_function_usec: int = 0
+  hot_spots: list[HotSpot] = Field(default_factory=list)
+
+
+def _self_times(events):
+  """The self time of each (ts, dur) event: its duration minus that of the events directly nested in it."""
+  order = sorted(range(len(events)), key=lambda i: (events[i][0], -events[i][1]))
+  res = [dur for _, dur in events]
+  stack = []
+  for i in order:
+    ts, dur = events[i]
+    while stack and events[stack[-1]][0] + events[stack[-1]][1] <= ts:
+      stack.pop()
+    if stack:
+      res[stack[-1]] -= dur
+    stack.append(i)
+  return res
+
+
+def summarize_trace(f, top_n, rename=lambda name: name):
+  """Reduce the trace in the text file f to a TimeTraceSummary."""
+  totals = {}
+  wanted = {name: field for field, name in TOTALS.items()}
+  spans = defaultdict(list)
+  names = defaultdict(list)
+  for e in iter_trace_events(f):
+    name = e.get('name')
+    if name in wanted:
+      totals[wanted[name]] = int(e.get('dur', 0))
+    elif name in HOT_SPOT_KINDS and e.get('ph') == 'X':
+      group = (name, e.get('tid'))
+      spans[group].append((e['ts'], e['dur']))
+      names[group].append(e.get('args', {}).get('detail', ''))
+  by_name = defaultdict(lambda: [0, 0, 0])
+  for group, events in spans.items():
+    for (_, dur), self_usec, name in zip(events, _self_times(events), names[group]):
+      acc = by_name[(group[0], rename(name)[:MAX_NAME_LENGTH])]
+      acc[0] += 1
+      acc[1] += self_usec
+      acc[2] += dur
+  hot_spots = []
+  for kind in HOT_SPOT_KINDS:
+    spots = [HotSpot(kind=kind, name=name, count=c, self_usec=round(s), total_usec=round(t))
+             for (k, name), (c, s, t) in by_name.items() if k == kind]
+    hot_spots += sorted(spots, key=lambda h: -h.self_usec)[:top_n]
+  return TimeTraceSummary(hot_spots=hot_spots, **totals)
+
+
+class TimeTraceJob(LibcxxJob):
+  class Meta(LibcxxJob.Meta):
+    memory_mb = 1024
+    # Events shorter than this are left out of the trace.
+    granularity_usec = 100
+    # Hot spots kept per kind.
+    top_n = 25
+
+  class Key(JobKey):
+    libcxx: LibcxxVersion
+    standard: Standard
+    header: STLHeader
+
+  class Output(TimeTraceSummary):
+    pass
+
+  input_file : Path = Field(exclude=True, default_factory=Path)
+  compiler: str = Field(exclude=True, default_factory=lambda: shutil.which('clang++'))
+
+  @model_validator(mode='after')
+  def validate_state(self):
+    if hasattr(self.key, 'header'):
+      self.input_file = Path(self.tmp_file('input.cpp',
+                               '#include <%s>\nint main() {\n}\n' % self.key.header.value))
+    elif hasattr(self.key, 'input'):
+      self.input_file = Path(self.key.input.path())
+    return self
+
+  def make_cmd(self, object_file):
+    return [self.compiler, '-c', '-o', str(object_file), '-ftime-trace',
+            f'-ftime-trace-granularity={self.meta().granularity_usec}', self.key.standard.flag()] + \
+        self.libcxx.include_flags() + ['-I', str(LIBCXX_INPUTS_ROOT / 'include')] + \
+        ['-xc++', str(self.input_file)]
+
+  def rename(self, name):
+    if name.startswith('/') and self.libcxx.is_libcxx_header(name):
+      return str(self.libcxx.relative_header_path(name))
+    for root, alias in [(LIBCXX_INPUTS_ROOT, '<inputs>'), (self.tmp_path, '<tmp>')]:
+      if name.startswith(str(root)):
+        return alias + name[len(str(root)):]
+    return name
+
+  def summarize(self, trace):
+    try:
+      with open(trace, 'r') as f:
+        return self.output_type().model_validate(
+            summarize_trace(f, self.meta().top_n, self.rename).model_dump())
+    finally:
+      trace.unlink(missing_ok=True)
+
+  def run(self):
+    # clang writes the trace next to the object file.
+    with self.tmp_file_guard('trace.o') as object_file:
+      run(self.make_cmd(object_file))
+      return self.summarize(object_file.with_suffix('.json'))
+
+  async def arun(self):
+    with self.tmp_file_guard('trace.o') as object_file:
+      await arun(self.make_cmd(object_file))
+      return await asyncio.to_thread(self.summarize, object_file.with_suffix('.json'))
+
+
+class TimeTraceTestSourceJob(TimeTraceJob):
+  class Key(JobKey):
+    libcxx: LibcxxVersion
+    standard: Standard
+    input: TestInputs
+
+  class Output(TimeTraceSummary):
+    pass
+
+
+def _sums(job_type, group_by, column, old, new, standard=None, kind=None):
+  """
+  {group: {libcxx version: sum of column}} for the results of job_type, or of
+  their hot spots of the given kind, with the libcxx versions old and new.
+  """
+  schema = columnar.schema_for(job_type)
+  R, H = schema.result_model, schema.run_model
+  groups = [schema.column(g) for g in group_by]
+  query = R.select(*groups, R.libcxx, pw.fn.SUM(schema.column(column)))
+  if kind is not None:
+    query = query.join(H, on=(H.parent == R.id)).where(H.kind == kind)
+  query = query.where(R.libcxx.in_([old.value, new.value]))
+  if standard is not None:
+    query = query.where(R.standard == standard.value)
+  res = defaultdict(dict)
+  for *group, libcxx, value in query.group_by(*groups, R.libcxx).tuples():
+    res[tuple(group)][libcxx] = value
+  return res
+
+
+def _print_diff(title, columns, sums, old, new, top, scale=1e-3, unit='ms'):
+  """Print the top groups of sums by increase from old to new."""
+  delta = lambda v: v.get(new.value, 0) - v.get(old.value, 0)
+  fmt = lambda v: '-' if v is None else '%.1f' % (v * scale)
+  table = Table(*columns, f'{old.value} ({unit})', f'{new.value} ({unit})', f'delta ({unit})', title=title)
+  for group, values in sorted(sums.items(), key=lambda kv: -delta(kv[1]))[:top]:
+    table.add_row(*[str(g) for g in group], fmt(values.get(old.value)), fmt(values.get(new.value)),
+                  fmt(delta(values)))
+  rich.print(table)
+
+
+def diff_report(job_type, old, new, standard=None, top=20):
+  """
+  Print the TUs whose frontend time grew the most from old to new, and the hot
+  spots whose self time, summed over the TUs, grew the most. A '-' means there
+  is no result, or the hot spot was not among the top_n of any TU.
+  """
+  tu = [c for c in columnar.schema_for(job_type).key_columns if c != 'libcxx']
+  sums = _sums(job_type, tu, 'frontend_usec', old, new, standard)
+  if not sums:
+    rich.print(f'No {job_type.job_name()} results for {old.value} or {new.value}')
+    return
+  _print_diff('Frontend time by TU', tu, sums, old, new, top)
+  for kind in HOT_SPOT_KINDS:
+    _print_diff(f'{kind} self time', ['name'], _sums(job_type, ['name'], 'self_usec', old, new, standard, kind),
+                old, new, top)
+
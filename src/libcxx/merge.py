@@ -0,0 +1,155 @@
+"""
+Merge shard databases (see libcxx.shard) into one results database.
+
+Samples of repeatable jobs found in several databases are concatenated.
+A non-repeatable result stored in more than one database must be identical
+everywhere; otherwise, as when fingerprints differ, the first one is kept and
+the key is reported as a conflict.
+
+Merging is idempotent: MergedRuns records, per source database (see
+libcxx.db.database_id) and key, the last sample merged, and merging the same
+database again only adds the samples stored in it since.
+"""
+from pathlib import Path
+from typing import NamedTuple
+import argparse
+import sys
+
+import peewee as pw
+import rich
+import tqdm
+
+import libcxx.db as db
+import libcxx.columnar as columnar
+from libcxx.db import DATABASE, DBDataPoint, DATABASE_PRAGMAS, DatabaseInfo, LibcxxDBModel
+
+
+class Conflict(NamedTuple):
+  job: str
+  key: str
+  reason: str
+  source: str
+
+
+class MergedRuns(LibcxxDBModel):
+  """The id of the last run of a repeatable key merged from a source database, 0 for inline samples."""
+  source = pw.TextField()
+  job = pw.TextField()
+  digest = pw.IntegerField()
+  last_run = pw.IntegerField()
+
+  class Meta:
+    indexes = (
+      (('source', 'job', 'digest'), True),
+    )
+
+
+def _models():
+  return [m for _, m in db.db_types_registry.items()]
+
+
+def _read(job, digest, merged):
+  """
+  (job type, key, value, fingerprint, last run) of a row of the source. The
+  value of a repeatable job only holds the runs after merged, the last run
+  merged before, if any.
+  """
+  row = DBDataPoint.get(job=job, digest=digest)
+  job_type = db.registry.get(job, None)
+  if job_type is None:
+    rich.print(f'Skipping unknown job {job}')
+    return None
+  value = row.value
+  last_run = None
+  schema = columnar.schema_for(job_type)
+  if job_type.meta().repeatable and schema is not None and schema.list_field is not None:
+    if len(value):
+      # Samples stored inline by older versions have no ids, so they are merged once.
+      last_run = 0
+      if merged is not None:
+        value = value.model_copy(update={schema.list_field: []})
+    elif (result_row := schema.select_row(row.key)) is not None:
+      R = schema.run_model
+      value = schema.load(job_type.output_type(), row.key, since=(merged or 0) + 1)
+      last_run = R.select(pw.fn.MAX(R.id)).where(R.parent == result_row).scalar() or 0
+  return job_type, row.key, value, row.fingerprint, last_run
+
+
+def _source_id(source, path):
+  with source.bind_ctx([DatabaseInfo]):
+    if DatabaseInfo.table_exists() and (row := DatabaseInfo.get_or_none()) is not None:
+      return row.uuid
+  # Databases written before they had an id are told apart by their path.
+  return str(Path(path).resolve())
+
+
+def _read_batches(path, batch_size=256):
+  """Yield the source id and lists of (job type, key, value, fingerprint, last run) read from the database at path."""
+  source = pw.SqliteDatabase(f'file:{path}?mode=ro', uri=True,
+                             pragmas={k: v for k, v in DATABASE_PRAGMAS.items() if k != 'journal_mode'})
+  # bind_ctx rebinds the models for every thread, so only hold it while reading.
+  try:
+    source_id = _source_id(source, path)
+    merged = {(m.job, m.digest): m.last_run for m in MergedRuns.select().where(MergedRuns.source == source_id)}
+    with source.bind_ctx(_models()):
+      keys = list(DBDataPoint.select(DBDataPoint.job, DBDataPoint.digest).tuples())
+    for batch in pw.chunked(keys, batch_size):
+      with source.bind_ctx(_models()):
+        res = [r for r in [_read(job, digest, merged.get((job, digest))) for job, digest in batch]
+               if r is not None]
+      yield source_id, res
+  finally:
+    source.close()
+
+
+def _store(job_type, key, value, fingerprint, source):
+  """Write one result into the output database; return a Conflict or None."""
+  schema = columnar.schema_for(job_type)
+  repeatable = job_type.meta().repeatable and schema is not None and schema.list_field is not None
+  existing = DBDataPoint.get_or_none(job=job_type.job_name(), digest=key.digest())
+  if existing is None:
+    marker = value.model_copy(update={schema.list_field: []}) if repeatable else value
+    DBDataPoint.create(key=key, value=marker, job=job_type.job_name(), digest=key.digest(),
+                       fingerprint=fingerprint)
+    if schema is not None:
+      schema.store(key, value)
+    return None
+  if existing.fingerprint != fingerprint:
+    return Conflict(job_type.job_name(), key.pathkey(), 'fingerprint', source)
+  if repeatable:
+    schema.store(key, value, append=True)
+    return None
+  if existing.value != value:
+    return Conflict(job_type.job_name(), key.pathkey(), 'value', source)
+  return None
+
+
+def merge(sources):
+  """Merge the databases at the paths in sources into the open database; return the conflicts."""
+  db.ensure_tables([MergedRuns])
+  conflicts = []
+  for source in sources:
+    rich.print(f'Merging {source}')
+    for source_id, batch in tqdm.tqdm(_read_batches(source)):
+      with DATABASE.atomic():
+        for job_type, key, value, fingerprint, last_run in batch:
+          if c := _store(job_type, key, value, fingerprint, str(source)):
+            conflicts.append(c)
+          elif last_run is not None:
+            MergedRuns.insert(source=source_id, job=job_type.job_name(), digest=key.digest(),
+                              last_run=last_run).on_conflict_replace().execute()
+  return conflicts
+
+
+if __name__ == '__main__':
+  import libcxx.jobs
+  import libcxx.jobs.git_stats
+  parser = argparse.ArgumentParser(description='Merge shard databases into one results database')
+  parser.add_argument('--out', type=str, default=str(db.DATABASE_PATH))
+  parser.add_argument('shards', nargs='+')
+  args = parser.parse_args()
+  db.init_db(path=args.out)
+  conflicts = merge(args.shards)
+  for c in conflicts:
+    rich.print(f'Conflicting {c.reason} for {c.job} {c.key} in {c.source}')
+  sys.exit(1 if conflicts else 0)
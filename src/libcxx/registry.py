@@ -17,6 +17,12 @@ class ClassRegistry:
       self.mapping[name] = obj_type
     return obj_type
 
+  def add_as(self, name, obj):
+    with self._lock:
+      assert name not in self.mapping
+      self.mapping[name] = obj
+    return obj
+
   def get(self, key, default=Tombstone):
     with self._lock:
       if obj := self.mapping.get(key, None):
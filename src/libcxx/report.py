@@ -0,0 +1,64 @@
+"""
+Reports over stored results that explain a change between libc++ versions.
+
+  python -m libcxx.report time-trace --old 15.0.0 --new 16.0.0 [--standard c++20] [--inputs]
+  python -m libcxx.report includes --libcxx 16.0.0 [--standard c++20]
+  python -m libcxx.report includes --old 15.0.0 --new 16.0.0 --header vector [--standard c++20]
+  python -m libcxx.report sections [--top 20] a.o b.o ...
+  python -m libcxx.report symbols-check --libcxx 16.0.0 [--standard c++20] [--header vector ...]
+
+The job modules define the reports; they live here because a module of
+libcxx.jobs cannot also run as __main__ without registering its jobs twice.
+"""
+import argparse
+from pathlib import Path
+import sys
+
+import libcxx.db as db
+from libcxx.types import LibcxxVersion, Standard, STLHeader
+from libcxx.jobs.time_trace import TimeTraceJob, TimeTraceTestSourceJob, diff_report
+from libcxx.jobs.include_graph import print_internal_header_costs, print_header_growth
+from libcxx.jobs.binary_sections import print_section_sizes
+from libcxx.jobs.symbols_count import check_symbol_counts
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Explain what changed between libc++ versions')
+  sub = parser.add_subparsers(dest='report', required=True)
+  tt = sub.add_parser('time-trace', help='What got slower to compile, from -ftime-trace')
+  tt.add_argument('--old', type=LibcxxVersion, required=True)
+  tt.add_argument('--new', type=LibcxxVersion, required=True)
+  tt.add_argument('--standard', type=Standard, default=None)
+  tt.add_argument('--inputs', action='store_true', help='Compare the TestInputs TUs instead of the headers')
+  tt.add_argument('--top', type=int, default=20)
+  inc = sub.add_parser('includes', help='Which headers the preprocessed lines come from')
+  inc.add_argument('--libcxx', type=LibcxxVersion, default=LibcxxVersion.trunk)
+  inc.add_argument('--old', type=LibcxxVersion, default=None)
+  inc.add_argument('--new', type=LibcxxVersion, default=None)
+  inc.add_argument('--standard', type=Standard, default=Standard.Cpp20)
+  inc.add_argument('--header', type=STLHeader, default=None)
+  inc.add_argument('--top', type=int, default=30)
+  sec = sub.add_parser('sections', help='Where the bytes of object files go, without running any job')
+  sec.add_argument('objects', type=Path, nargs='+')
+  sec.add_argument('--top', type=int, default=20)
+  sym = sub.add_parser('symbols-check',
+                       help='Check that the symbols counted in the preprocessed TU match the source')
+  sym.add_argument('--libcxx', type=LibcxxVersion, default=LibcxxVersion.trunk)
+  sym.add_argument('--standard', type=Standard, default=Standard.Cpp20)
+  sym.add_argument('--header', type=STLHeader, nargs='*', default=None)
+  args = parser.parse_args()
+  if args.report == 'sections':
+    print_section_sizes(args.objects, args.top)
+    sys.exit(0)
+  if args.report == 'symbols-check':
+    sys.exit(1 if check_symbol_counts(args.libcxx, args.standard, args.header or list(STLHeader)) else 0)
+  db.init_db(readonly=True)
+  if args.report == 'time-trace':
+    diff_report(TimeTraceTestSourceJob if args.inputs else TimeTraceJob, args.old, args.new,
+                args.standard, args.top)
+  elif args.header is not None:
+    if args.old is None or args.new is None:
+      parser.error('--header needs --old and --new')
+    print_header_growth(args.old, args.new, args.standard, args.header, args.top)
+  else:
+    print_internal_header_costs(args.libcxx, args.standard, args.top)
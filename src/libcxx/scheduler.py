@@ -0,0 +1,121 @@
+"""
+CPU- and memory-aware admission control for the asyncio runner.
+
+Each job type declares its cost in its Meta:
+
+  cost       -- CPUs the job keeps busy (fractional for cheap jobs)
+  memory_mb  -- rough peak memory of the job
+  exclusive  -- the job measures time and must not share its CPU
+
+The scheduler never reserves more than the available CPUs or memory. When
+CPUs are isolated (--isolate-cpus=N), exclusive jobs run one per isolated CPU
+and are pinned to it, and all other jobs are pinned to the remaining CPUs.
+Otherwise an exclusive job reserves every CPU and so runs alone; while one
+waits, no other job is admitted ahead of it.
+"""
+import asyncio
+import contextlib
+import os
+import re
+import shutil
+import sys
+
+from libcxx.utils import CPU_AFFINITY
+
+
+def _isolate_cpus_from_argv():
+  for a in sys.argv:
+    if m := re.match(r'--isolate-cpus=(\d+)$', a):
+      return int(m.group(1))
+  return 0
+
+ISOLATE_CPUS = _isolate_cpus_from_argv()
+
+
+def available_memory_mb():
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) // 1024
+  except OSError:
+    pass
+  return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+
+
+def usable_cpus():
+  return sorted(os.sched_getaffinity(0))
+
+
+class JobScheduler:
+  def __init__(self, cpus=None, memory_mb=None, isolate=ISOLATE_CPUS):
+    cpus = list(cpus or usable_cpus())
+    if isolate:
+      if isolate >= len(cpus):
+        raise RuntimeError('Cannot isolate %d of %d CPUs' % (isolate, len(cpus)))
+      if shutil.which('taskset') is None:
+        raise RuntimeError('--isolate-cpus requires taskset')
+    self.isolated = cpus[len(cpus) - isolate:]
+    self.shared = cpus[:len(cpus) - isolate]
+    self.capacity = float(len(self.shared))
+    self.memory_mb = memory_mb or int(available_memory_mb() * 0.8)
+    self.used = 0.0
+    self.used_memory_mb = 0
+    self.free_isolated = list(self.isolated)
+    # Exclusive jobs waiting for the shared CPUs to drain.
+    self.exclusive_waiting = 0
+    self._cond = asyncio.Condition()
+
+  @staticmethod
+  def job_resources(job):
+    meta = job.meta()
+    return meta.cost, meta.memory_mb, meta.exclusive
+
+  def max_concurrency(self, jobs):
+    """An upper bound on the number of jobs that can ever be admitted together."""
+    costs = [self.job_resources(j)[0] for j in jobs] or [1]
+    return max(1, int(self.capacity / max(min(costs), 0.01))) + len(self.isolated)
+
+  def _fits(self, cost, memory_mb, exclusive):
+    if self.used_memory_mb and self.used_memory_mb + memory_mb > self.memory_mb:
+      return False
+    if exclusive and self.isolated:
+      return bool(self.free_isolated)
+    if exclusive:
+      return self.used == 0
+    if self.exclusive_waiting and not self.isolated:
+      return False
+    return self.used == 0 or self.used + cost <= self.capacity
+
+  @contextlib.asynccontextmanager
+  async def reserve(self, job):
+    """Wait until the job fits, then run the body with its CPUs reserved."""
+    cost, memory_mb, exclusive = self.job_resources(job)
+    isolated = exclusive and bool(self.isolated)
+    cost = self.capacity if exclusive and not isolated else min(cost, self.capacity)
+    drain = exclusive and not isolated
+    async with self._cond:
+      self.exclusive_waiting += drain
+      try:
+        await self._cond.wait_for(lambda: self._fits(cost, memory_mb, exclusive))
+      finally:
+        self.exclusive_waiting -= drain
+        self._cond.notify_all()
+      self.used_memory_mb += memory_mb
+      if isolated:
+        cpus = {self.free_isolated.pop()}
+      else:
+        self.used += cost
+        cpus = set(self.shared) if self.isolated else None
+    token = CPU_AFFINITY.set(cpus)
+    try:
+      yield cpus
+    finally:
+      CPU_AFFINITY.reset(token)
+      async with self._cond:
+        self.used_memory_mb -= memory_mb
+        if isolated:
+          self.free_isolated += list(cpus)
+        else:
+          self.used -= cost
+        self._cond.notify_all()
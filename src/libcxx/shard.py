@@ -0,0 +1,75 @@
+"""
+Splitting a collection run across processes or hosts.
+
+With --shard=I/K, LibcxxJob.all_plans() keeps only the plans whose key digest
+is I modulo K. A plan that other plans depend on (see LibcxxJob.depends_on)
+goes to the shard of its consumer instead, so that its DAG produces it and
+its artifacts there only. Running the K shards I = 0..K-1, on any hosts,
+covers every key exactly once. Each shard writes its own database, see Shard.database_path(),
+and libcxx.merge combines the shard databases into one.
+"""
+from pathlib import Path
+from typing import NamedTuple
+import os
+import re
+import sys
+
+from libcxx.db import DATABASE_PATH
+
+
+class Shard(NamedTuple):
+  index: int
+  count: int
+
+  @staticmethod
+  def parse(s):
+    m = re.match(r'(\d+)/(\d+)$', s)
+    if m is None:
+      raise ValueError('Expected a shard as I/K, got %s' % s)
+    shard = Shard(int(m.group(1)), int(m.group(2)))
+    if not 0 <= shard.index < shard.count:
+      raise ValueError('Shard index %d out of range for %d shards' % shard)
+    return shard
+
+  @staticmethod
+  def owners(plans):
+    """
+    {db key: the db key whose digest picks its shard}: the plan itself, or the
+    consumer of an upstream plan, following chains of dependencies. An
+    upstream plan with several consumers goes with the lowest of them.
+    """
+    consumer = {}
+    for p in plans:
+      for d in p.dependencies().values():
+        key = d.plan.db_key()
+        consumer[key] = min(consumer.get(key, p.db_key()), p.db_key(), key=lambda k: k[1])
+    def owner(key):
+      seen = set()
+      while key in consumer and key not in seen:
+        seen.add(key)
+        key = consumer[key]
+      return key
+    return {p.db_key(): owner(p.db_key()) for p in plans}
+
+  def select(self, plans):
+    owners = Shard.owners(plans)
+    return [p for p in plans if owners[p.db_key()][1] % self.count == self.index]
+
+  def database_path(self):
+    """LIBCXX_METRICS_DB if set, otherwise a per-shard file next to the default database."""
+    if 'LIBCXX_METRICS_DB' in os.environ:
+      return DATABASE_PATH
+    p = Path(DATABASE_PATH)
+    return p.with_name(f'{p.stem}.shard-{self.index}-of-{self.count}{p.suffix}')
+
+  def __str__(self):
+    return f'{self.index}/{self.count}'
+
+
+def _shard_from_argv():
+  for a in sys.argv:
+    if a.startswith('--shard='):
+      return Shard.parse(a[len('--shard='):])
+  return None
+
+SHARD = _shard_from_argv()
@@ -0,0 +1,103 @@
+"""
+A single writer for job results.
+
+Runners hand finished (job, result) pairs to a ResultSink, which commits them
+and the job's usage (see libcxx.usage) in batched transactions from a
+dedicated thread. Workers and the asyncio event loop never block on SQLite.
+"""
+import queue
+import threading
+import time
+import rich
+
+from libcxx.db import DATABASE
+from libcxx.usage import record_usage
+
+# Take the write lock when the transaction begins. A deferred transaction that
+# reads first cannot wait for another writer in WAL mode: it fails with
+# "database is locked" at its first write, whatever busy_timeout says.
+WRITE_LOCK = 'IMMEDIATE'
+
+
+class ResultSink:
+  _STOP = object()
+
+  def __init__(self, batch_size=256, flush_interval=0.5):
+    self.batch_size = batch_size
+    self.flush_interval = flush_interval
+    self.queue = queue.Queue()
+    self.errors = []
+    self.stored = 0
+    self._thread = threading.Thread(target=self._run, name='libcxx-result-sink', daemon=True)
+    self._thread.start()
+
+  def put(self, job, result, then=None):
+    """Store result for job. then() is called in the transaction that stores it."""
+    self.queue.put((job, result, then))
+
+  def close(self):
+    self.queue.put(ResultSink._STOP)
+    self._thread.join()
+    if self.errors:
+      raise self.errors[0]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _next_batch(self):
+    batch = []
+    deadline = None
+    while len(batch) < self.batch_size:
+      timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+      try:
+        item = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if item is ResultSink._STOP:
+        return batch, True
+      batch.append(item)
+      if deadline is None:
+        deadline = time.monotonic() + self.flush_interval
+    return batch, False
+
+  @staticmethod
+  def _apply(job, result, then):
+    job.db_store(result)
+    if job.usage is not None:
+      record_usage(job, job.usage)
+    if then is not None:
+      then()
+
+  def _store(self, job, result, then):
+    try:
+      with DATABASE.atomic(WRITE_LOCK):
+        self._apply(job, result, then)
+      self.stored += 1
+    except Exception as E:
+      rich.print(f'Failed to store result for {job.key}: {E}')
+      self.errors.append(E)
+
+  def _commit(self, batch):
+    try:
+      with DATABASE.atomic(WRITE_LOCK):
+        for item in batch:
+          self._apply(*item)
+      self.stored += len(batch)
+    except Exception:
+      # Retry one at a time so a single bad result doesn't lose the batch.
+      for item in batch:
+        self._store(*item)
+
+  def _run(self):
+    try:
+      done = False
+      while not done:
+        batch, done = self._next_batch()
+        if batch:
+          self._commit(batch)
+    finally:
+      if not DATABASE.is_closed():
+        DATABASE.close()
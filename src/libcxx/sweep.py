@@ -0,0 +1,235 @@
+"""
+Checkpointed, resumable sweeps.
+
+Before running anything, a sweep records in the database every key it has to
+compute: a SweepEntry with its target (one result, or runs_per_repeat samples
+for repeatable jobs), how much of it is completed, and whether it is done.
+Each result is committed in the same transaction as the update of its entry,
+so an interrupted sweep started again with the same name (--sweep=NAME, by
+default 'default') resumes exactly where it stopped. Resuming adds an entry for
+every stale key the interrupted sweep did not have, and restarts the entries
+whose fingerprint (see LibcxxJob.fingerprint) has changed since.
+
+Repeatable jobs are measured in chunks of Meta.runs_per_chunk samples.
+want_more_runs() is applied to every sample of the current sweep, including
+the ones measured before a restart, so a resumed key neither overshoots nor
+undershoots its target.
+
+Sending SIGUSR1 to the sweep process pauses it once the chunks in flight have
+finished; sending it again resumes it.
+"""
+import datetime
+import multiprocessing
+import os
+import queue
+import random
+import re
+import signal
+import sys
+
+import peewee as pw
+import rich
+import tqdm
+
+import libcxx.columnar as columnar
+from libcxx.db import DATABASE, LibcxxDBModel, ensure_tables
+from libcxx.job import LibcxxJob, RERUN_REPEATABLE
+from libcxx.sink import ResultSink
+from libcxx.types import LIBCXX_INFO_REGISTRY
+
+
+def _sweep_name_from_argv():
+  for a in sys.argv:
+    if m := re.match(r'--sweep=(.+)$', a):
+      return m.group(1)
+  return 'default'
+
+SWEEP_NAME = _sweep_name_from_argv()
+
+
+class SweepManifest(LibcxxDBModel):
+  name = pw.TextField(unique=True)
+  rerun_repeatable = pw.BooleanField()
+  created = pw.DateTimeField(default=datetime.datetime.now)
+  finished = pw.DateTimeField(null=True)
+
+
+class SweepEntry(LibcxxDBModel):
+  sweep = pw.ForeignKeyField(SweepManifest, backref='entries', on_delete='CASCADE')
+  job = pw.TextField()
+  digest = pw.IntegerField()
+  target = pw.IntegerField()
+  completed = pw.IntegerField(default=0)
+  # The first id of the runs table that belongs to this sweep, for repeatable jobs.
+  first_run = pw.IntegerField(null=True)
+  done = pw.BooleanField(default=False)
+  fingerprint = pw.TextField(null=True)
+
+  class Meta:
+    indexes = (
+      (('sweep', 'job', 'digest'), True),
+    )
+
+
+def _ignore_pause_signal():
+  signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+
+def run_sweep_chunk(plan, runs):
+  job = plan.materialize()
+  if runs is None:
+    return job, job.run_measured()
+  return job, job.run_measured(runs=runs)
+
+
+class Sweep:
+  def __init__(self, plans, name=SWEEP_NAME, rerun_repeatable=RERUN_REPEATABLE):
+    ensure_tables([SweepManifest, SweepEntry])
+    self.plans = {p.db_key(): p for p in [j.as_plan() for j in plans]}
+    self.paused = False
+    self.errors = []
+    self.manifest = SweepManifest.get_or_none(name=name)
+    if self.manifest is not None and (self.manifest.finished is not None or
+                                      self.manifest.rerun_repeatable != rerun_repeatable):
+      self.manifest.delete_instance()
+      self.manifest = None
+    if self.manifest is None:
+      self.manifest = SweepManifest.create(name=name, rerun_repeatable=rerun_repeatable)
+    else:
+      rich.print(f'Resuming sweep {name} started {self.manifest.created}')
+    self._add_stale(rerun_repeatable)
+
+  def _add_stale(self, rerun_repeatable):
+    """Add an entry for every stale plan without one, and restart the entries whose fingerprint changed."""
+    stale = LibcxxJob.filter_should_rerun(list(self.plans.values()), rerun_repeatable)
+    entries = {(e.job, e.digest): e for e in self.manifest.entries}
+    memo = {}
+    first_runs = {}
+    rows = []
+    restart = []
+    for p in stale:
+      fingerprint = p.fingerprint(memo)
+      entry = entries.get(p.db_key())
+      # Entries written before they had a fingerprint are resumed as they are.
+      if entry is not None and entry.fingerprint in (None, fingerprint):
+        continue
+      meta = p.meta()
+      first_run = None
+      if meta.repeatable:
+        if p.job_type not in first_runs:
+          first_runs[p.job_type] = columnar.schema_for(p.job_type).next_run_id()
+        first_run = first_runs[p.job_type]
+      if entry is not None:
+        restart.append((entry.id, first_run, fingerprint))
+        continue
+      job, digest = p.db_key()
+      rows += [{'job': job, 'digest': digest, 'first_run': first_run, 'fingerprint': fingerprint,
+                'target': meta.runs_per_repeat if meta.repeatable else 1}]
+    with DATABASE.atomic():
+      for batch in pw.chunked(rows, 500):
+        SweepEntry.insert_many([dict(r, sweep=self.manifest) for r in batch]).execute()
+      for id, first_run, fingerprint in restart:
+        SweepEntry.update(completed=0, done=False, first_run=first_run, fingerprint=fingerprint) \
+            .where(SweepEntry.id == id).execute()
+
+  def pending(self):
+    """(entry, plan) for every entry that is not done and was requested."""
+    res = []
+    for e in self.manifest.entries.where(SweepEntry.done == False):
+      if (plan := self.plans.get((e.job, e.digest))) is not None:
+        res.append((e, plan))
+    return res
+
+  def _toggle_pause(self, signum, frame):
+    self.paused = not self.paused
+    rich.print('Sweep paused, send SIGUSR1 again to resume' if self.paused else 'Sweep resumed')
+
+  def _next_runs(self, entry, plan):
+    if not plan.meta().repeatable:
+      return None
+    return max(1, min(plan.meta().runs_per_chunk, entry.target - entry.completed))
+
+  def _measured(self, entry, job):
+    """The samples of this sweep for a repeatable job stored before a restart."""
+    if entry.completed == 0:
+      return None
+    return columnar.load(job, since=entry.first_run)
+
+  def _update(self, entry, completed, done):
+    def then():
+      SweepEntry.update(completed=completed, done=done).where(SweepEntry.id == entry.id).execute()
+    return then
+
+  def _finish_chunk(self, entry, job, res, measured, sink):
+    """Hand the result to the sink; return True if the entry needs another chunk."""
+    if res is None:
+      rich.print(f'No result for {job.key}')
+      SweepEntry.update(done=True).where(SweepEntry.id == entry.id).execute()
+      return False
+    if not job.meta().repeatable:
+      sink.put(job, res, then=self._update(entry, 1, True))
+      return False
+    key = job.db_key()
+    if key not in measured:
+      measured[key] = self._measured(entry, job)
+      if measured[key] is None:
+        measured[key] = job.output_type().model_validate({'hash_value': job.hash_value()})
+    measured[key].extend(res)
+    entry.completed += len(res)
+    more = entry.completed < entry.target and job.want_more_runs(measured[key])
+    sink.put(job, res, then=self._update(entry, entry.completed, not more))
+    return more
+
+  def run(self, processes=None):
+    pending = self.pending()
+    if not pending:
+      self._mark_finished()
+      return
+    rich.print(f'{len(pending)} keys left in sweep {self.manifest.name}')
+    random.shuffle(pending)
+    processes = processes or os.cpu_count()
+    # Workers inherit the loaded libc++ installs through fork.
+    LIBCXX_INFO_REGISTRY.preload()
+    previous = signal.signal(signal.SIGUSR1, self._toggle_pause)
+    done = queue.Queue()
+    measured = {}
+    try:
+      with multiprocessing.Pool(processes, initializer=_ignore_pause_signal) as pool, \
+           ResultSink() as sink, tqdm.tqdm(total=len(pending)) as pbar:
+        limit = 2 * processes
+        inflight = 0
+        while pending or inflight:
+          while pending and inflight < limit and not self.paused:
+            entry, plan = pending.pop()
+            pool.apply_async(run_sweep_chunk, (plan, self._next_runs(entry, plan)),
+                             callback=lambda r, e=entry: done.put((e, r, None)),
+                             error_callback=lambda E, e=entry: done.put((e, None, E)))
+            inflight += 1
+          try:
+            entry, res, error = done.get(timeout=0.5)
+          except queue.Empty:
+            continue
+          inflight -= 1
+          if error is not None:
+            rich.print(f'Sweep entry {entry.job} {entry.digest} failed: {error}')
+            self.errors.append(error)
+            pbar.update(1)
+            continue
+          job, res = res
+          if self._finish_chunk(entry, job, res, measured, sink):
+            pending.append((entry, self.plans[(entry.job, entry.digest)]))
+          else:
+            pbar.update(1)
+    finally:
+      signal.signal(signal.SIGUSR1, previous)
+    if self.errors:
+      raise self.errors[0]
+    self._mark_finished()
+
+  def _mark_finished(self):
+    self.manifest.finished = datetime.datetime.now()
+    self.manifest.save()
+
+
+def run_sweep(jobs, name=SWEEP_NAME, rerun_repeatable=RERUN_REPEATABLE, processes=None):
+  Sweep(jobs, name, rerun_repeatable).run(processes)
@@ -4,9 +4,13 @@ from pathlib import Path
 from pydantic import BaseModel, Field, RootModel
 from typing import Union, Optional, Any, Annotated, Literal
 from libcxx.config import LIBCXX_VERSIONS_ROOT, LIBCXX_INPUTS_ROOT, LLVM_PROJECT_ROOT
+from libcxx.header_index import HEADER_INDEX, PathTrie
 import copy
+import functools
 from enum import Enum
 import subprocess
+import threading
+import hashlib
 
 CLANG_VERSIONED_RE = re.compile('clang-(?P<MAJOR>\d{1,2})(?P<MINOR>\.\d)(?P<PATCHLEVEL>\.\d)?')
 CLANG_TRUNK_RE = re.compile('clang-trunk-(?P<YEAR>\d\d\d\d)(?P<MONTH>\d\d)(?P<DAY>\d\d)')
@@ -205,20 +209,13 @@ class LibcxxVersion(str, Enum):
     root = Path(root).absolute()
     key = None
     if self.value == 'trunk':
-      bits = list(root.glob('trunk-*'))
-      def sort_trunk(x):
-        x = x.name
-        parts = x.split('-')
-        assert len(parts) == 2
-        return int(parts[1])
-      bits.sort(key=sort_trunk)
-      key = bits[-1]
+      key = LIBCXX_INFO_REGISTRY.latest_trunk(root)
     else:
       key = self.value
     p = Path(root / key / 'info.json')
     if not p.is_file():
       raise RuntimeError('Failed to find file: %s' % p)
-    return LibcxxInfo.create_from_path(p)
+    return LIBCXX_INFO_REGISTRY.load(p)
 
   def _to_tuple(self):
     if self.value == 'trunk':
@@ -604,48 +601,38 @@ class LibcxxInfo(BaseModel):
   def has_version(self):
     return isinstance(self.identifier, Version)
 
+  def header_trees(self):
+    """(include directory, its TreeIndex) for each include directory, see libcxx.header_index."""
+    return [(p, HEADER_INDEX.tree(p)) for p in self.abs_include_paths() if p.is_dir()]
+
   def find_header(self, filename):
-    for i in self.include_paths:
-      full_i = self.path / i
-      assert full_i.is_dir()
-      possible = full_i / filename
-      if possible.is_file():
-        return possible
+    rel = os.path.normpath(filename)
+    for root, tree in self.header_trees():
+      if rel in tree.files:
+        return root / filename
     return None
 
   def is_libcxx_path(self, p):
     return Path(p).is_relative_to(self.path) or self.is_libcxx_header(p)
 
-  def is_libcxx_header(self, p):
-
-    p = Path(p).absolute()
-    abs_includes = [Path(self.path, ii) for ii in self.include_paths]
-    return any([p.is_relative_to(a) for a in abs_includes])
+  @functools.cached_property
+  def include_trie(self):
+    return PathTrie(self.abs_include_paths())
 
+  def is_libcxx_header(self, p):
+    return self.include_trie.lookup(p) is not None
 
   def get_headers(self):
-    headers = []
-    for i in self.abs_include_paths():
-      headers += [h.absolute() for h in Path(i).rglob('*') if h.is_file() and '_LIBCPP' in h.read_text()]
-    return list(set(headers))
+    return [(root / rel).absolute() for root, tree in self.header_trees()
+            for rel, e in tree.files.items() if e.is_libcxx]
 
   def absolute_header_path(self, i):
-    for a in self.abs_include_paths():
-      test_p = a / i
-      if test_p.is_file():
-        return test_p
-    return Path(i)
+    return self.find_header(i) or Path(i)
 
   def relative_header_path(self, i):
-    assert self.is_libcxx_header(i)
-    p = Path(i).absolute()
-    abs_includes = [Path(self.path, ii) for ii in self.include_paths]
-    for ii in abs_includes:
-      test_p = ii / p
-      if test_p.is_relative_to(ii):
-        return test_p.relative_to(ii)
-    assert Path(i).name == i
-    return Path(i)
+    found = self.include_trie.lookup(i)
+    assert found is not None
+    return found[1]
 
   def include_flags(self, include_flag='-cxx-isystem', root=None):
     if root is None:
@@ -737,6 +724,63 @@ class LibcxxInfo(BaseModel):
 
 
 
+class LibcxxInfoRegistry:
+  """
+  A process-wide cache of LibcxxInfo objects loaded from info.json files.
+
+  An entry is reused until the (mtime, size) of its info.json changes, and the
+  newest trunk-* directory is re-globbed only when the versions root changes.
+  The returned objects are shared and must be treated as read-only. Loading
+  them before forking shares them with the workers.
+  """
+  def __init__(self):
+    self._lock = threading.RLock()
+    self._infos = {}
+    self._trunks = {}
+
+  @staticmethod
+  def _stamp(p):
+    st = os.stat(p)
+    return (st.st_mtime_ns, st.st_size)
+
+  def load(self, info_path):
+    p = Path(info_path).absolute()
+    stamp = self._stamp(p)
+    with self._lock:
+      if (hit := self._infos.get(p)) and hit[0] == stamp:
+        return hit[1]
+    info = LibcxxInfo.create_from_path(p)
+    with self._lock:
+      self._infos[p] = (stamp, info)
+    return info
+
+  def latest_trunk(self, root):
+    root = Path(root).absolute()
+    stamp = self._stamp(root)
+    with self._lock:
+      if (hit := self._trunks.get(root)) and hit[0] == stamp:
+        return hit[1]
+    bits = list(root.glob('trunk-*'))
+    def sort_trunk(x):
+      x = x.name
+      parts = x.split('-')
+      assert len(parts) == 2
+      return int(parts[1])
+    bits.sort(key=sort_trunk)
+    with self._lock:
+      self._trunks[root] = (stamp, bits[-1])
+    return bits[-1]
+
+  def preload(self, versions=None):
+    for v in versions or LibcxxVersion:
+      try:
+        v.load()
+      except (RuntimeError, AssertionError):
+        pass
+
+LIBCXX_INFO_REGISTRY = LibcxxInfoRegistry()
+
+
 class CompilerInfo(BaseModel):
   path : Path = Field(default_factory=lambda: Path(shutil.which('clang++')))
   id: str = Field(default=None)
@@ -912,6 +956,70 @@ class OptimizerOpts(Enum):
   def pathkey(self):
     return self.value.replace('-', '')
 
+LOCAL_INCLUDE_RE = re.compile(r'^\s*#\s*include\s*"(?P<NAME>[^"]+)"', re.MULTILINE)
+
+
+class InputDigestCache:
+  """
+  The content digest of a test input and of every header it transitively
+  includes with `#include "..."` from its own directory or inputs/include.
+
+  Digests are computed once per process and recomputed only when the mtime or
+  size of one of the files they cover changes.
+  """
+  def __init__(self, include_dirs=(LIBCXX_INPUTS_ROOT / 'include',)):
+    self.include_dirs = [Path(d) for d in include_dirs]
+    self._digests = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _stamp(p):
+    st = p.stat()
+    return (st.st_mtime_ns, st.st_size)
+
+  def _resolve(self, name, including_file):
+    for d in [including_file.parent] + self.include_dirs:
+      if (d / name).is_file():
+        return (d / name).resolve()
+    return None
+
+  def dependencies(self, path):
+    """The input file followed by its transitive local includes, in a stable order."""
+    path = Path(path).resolve()
+    seen = [path]
+    for p in seen:
+      for m in LOCAL_INCLUDE_RE.finditer(p.read_text()):
+        dep = self._resolve(m['NAME'], p)
+        if dep is not None and dep not in seen:
+          seen.append(dep)
+    return seen
+
+  def _compute(self, path):
+    deps = self.dependencies(path)
+    h = hashlib.sha256()
+    for d in deps:
+      h.update(str(d.relative_to(LIBCXX_INPUTS_ROOT) if d.is_relative_to(LIBCXX_INPUTS_ROOT) else d).encode('utf-8'))
+      h.update(b'\0')
+      h.update(d.read_bytes())
+      h.update(b'\0')
+    return [(d, self._stamp(d)) for d in deps], h.hexdigest()
+
+  def digest(self, path):
+    path = Path(path)
+    with self._lock:
+      entry = self._digests.get(path)
+      try:
+        if entry is not None and all(self._stamp(d) == st for d, st in entry[0]):
+          return entry[1]
+      except FileNotFoundError:
+        pass
+      entry = self._digests[path] = self._compute(path)
+      return entry[1]
+
+
+INPUT_DIGESTS = InputDigestCache()
+
+
 class TestInputs(str, Enum):
   vector = 'instantiation/vector.cpp'
   shared_ptr = 'instantiation/shared_ptr.cpp'
@@ -923,8 +1031,16 @@ class TestInputs(str, Enum):
   def pathkey(self):
     return self.value
 
-  def __hash__(self):
-    return hash(self.path().read_text())
+  def digest(self):
+    """The content digest of the input and its local includes, see InputDigestCache."""
+    return INPUT_DIGESTS.digest(self.path())
+
+  def dependencies(self):
+    return INPUT_DIGESTS.dependencies(self.path())
+
+  # Hash by name, like the str the enum compares equal to. Content changes are
+  # tracked by digest(), which is stored with every result.
+  __hash__ = str.__hash__
 
 
 class TimeWindowSize(Enum):
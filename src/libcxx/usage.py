@@ -0,0 +1,68 @@
+"""
+What running the jobs costs.
+
+The runners call LibcxxJob.run_measured() or arun_measured(), which add up the
+rusage of every child process a job starts (see libcxx.utils.ChildUsage). The
+ResultSink records that usage in the JobUsage table, in the same transaction
+that stores the result. There is one row per run, or per chunk of samples for
+a repeatable job.
+
+  python -m libcxx.usage [--since 2024-01-31]
+
+shows which job types dominate the machine time of a collection.
+"""
+import argparse
+import datetime
+
+import peewee as pw
+import rich
+from rich.table import Table
+
+import libcxx.db as db
+from libcxx.db import LibcxxDBModel
+
+
+class JobUsage(LibcxxDBModel):
+  job = pw.TextField(index=True)
+  digest = pw.IntegerField()
+  created = pw.DateTimeField(default=datetime.datetime.now)
+  wall = pw.FloatField()
+  utime = pw.FloatField()
+  stime = pw.FloatField()
+  maxrss_kb = pw.IntegerField()
+  majflt = pw.IntegerField()
+  minflt = pw.IntegerField()
+  children = pw.IntegerField()
+
+
+def record_usage(job, usage):
+  JobUsage.create(job=job.job_name(), digest=job.key.digest(), **usage._asdict())
+
+
+def summarize(since=None):
+  """Per job type: (job, runs, children, wall, cpu, peak maxrss_kb, majflt, minflt), most CPU first."""
+  cpu = pw.fn.SUM(JobUsage.utime + JobUsage.stime)
+  query = JobUsage.select(JobUsage.job, pw.fn.COUNT(JobUsage.id), pw.fn.SUM(JobUsage.children),
+                          pw.fn.SUM(JobUsage.wall), cpu, pw.fn.MAX(JobUsage.maxrss_kb),
+                          pw.fn.SUM(JobUsage.majflt), pw.fn.SUM(JobUsage.minflt))
+  if since is not None:
+    query = query.where(JobUsage.created >= since)
+  return list(query.group_by(JobUsage.job).order_by(cpu.desc()).tuples())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Show the machine time used by each job type')
+  parser.add_argument('--since', type=datetime.datetime.fromisoformat, default=None)
+  args = parser.parse_args()
+  db.init_db(readonly=True)
+  if not JobUsage.table_exists():
+    rich.print('No usage has been recorded')
+  else:
+    rows = summarize(args.since)
+    total_cpu = sum([r[4] for r in rows]) or 1.0
+    table = Table('job', 'runs', 'children', 'wall (s)', 'cpu (s)', 'cpu %', 'peak rss (MB)',
+                  'major faults', 'minor faults')
+    for job, runs, children, wall, cpu, maxrss, majflt, minflt in rows:
+      table.add_row(job, str(runs), str(children), '%.1f' % wall, '%.1f' % cpu,
+                    '%.1f' % (100 * cpu / total_cpu), '%.1f' % (maxrss / 1024), str(majflt), str(minflt))
+    rich.print(table)
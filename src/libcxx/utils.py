@@ -1,6 +1,100 @@
 import subprocess
 import asyncio
 import shlex
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from typing import NamedTuple
+
+# The CPUs the current job was scheduled on, or None to leave affinity alone.
+CPU_AFFINITY = contextvars.ContextVar('CPU_AFFINITY', default=None)
+
+def pinned(cmd):
+  """Prefix cmd with taskset when the running job was pinned by the scheduler."""
+  cpus = CPU_AFFINITY.get()
+  if not cpus:
+    return list(cmd)
+  return ['taskset', '-c', ','.join([str(c) for c in sorted(cpus)])] + list(cmd)
+
+
+class ChildUsage(NamedTuple):
+  """
+  The resources used by child processes, as reported by os.wait4(). A child's
+  usage includes the descendants it waited for (the compiler under `sh -c` or
+  `perf stat`). Adding usages sums everything but maxrss_kb, which is the peak.
+  """
+  wall: float = 0.0
+  utime: float = 0.0
+  stime: float = 0.0
+  maxrss_kb: int = 0
+  majflt: int = 0
+  minflt: int = 0
+  children: int = 0
+
+  @staticmethod
+  def from_rusage(ru, wall):
+    return ChildUsage(wall, ru.ru_utime, ru.ru_stime, ru.ru_maxrss, ru.ru_majflt, ru.ru_minflt, 1)
+
+  def combine(self, other):
+    return ChildUsage(self.wall + other.wall, self.utime + other.utime, self.stime + other.stime,
+                      max(self.maxrss_kb, other.maxrss_kb), self.majflt + other.majflt,
+                      self.minflt + other.minflt, self.children + other.children)
+
+  @property
+  def cpu(self):
+    return self.utime + self.stime
+
+
+# The innermost UsageMeter, see measure_usage().
+USAGE_METER = contextvars.ContextVar('USAGE_METER', default=None)
+
+class UsageMeter:
+  def __init__(self, parent=None):
+    self.parent = parent
+    self.total = ChildUsage()
+    self._lock = threading.Lock()
+
+  def add(self, usage):
+    with self._lock:
+      self.total = self.total.combine(usage)
+    if self.parent is not None:
+      self.parent.add(usage)
+
+@contextlib.contextmanager
+def measure_usage():
+  """
+  Add up the usage of every child reaped by wait() in this context (and in the
+  threads asyncio.to_thread starts from it). Meters nest: a child is counted
+  in every enclosing meter.
+  """
+  meter = UsageMeter(USAGE_METER.get())
+  token = USAGE_METER.set(meter)
+  try:
+    yield meter
+  finally:
+    USAGE_METER.reset(token)
+
+def wait(proc, started):
+  """
+  Reap the Popen proc with os.wait4 and return its ChildUsage; Popen.wait()
+  would throw the rusage away. started is the time.monotonic() of the spawn.
+  """
+  _, status, ru = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  usage = ChildUsage.from_rusage(ru, time.monotonic() - started)
+  if (meter := USAGE_METER.get()) is not None:
+    meter.add(usage)
+  return usage
+
+def _communicate(cmd, shell, stdin=None):
+  started = time.monotonic()
+  proc = subprocess.Popen(cmd, shell=shell, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  with proc:
+    out = proc.stdout.read()
+    wait(proc, started)
+  return proc.returncode, out.decode('utf-8').strip()
 
 async def arun(cmd, check=True, shell=False, verbose=False):
   def vprint(*args):
@@ -10,26 +104,25 @@ async def arun(cmd, check=True, shell=False, verbose=False):
     if isinstance(cmd, list):
       cmd = shlex.join(cmd)
     vprint(cmd)
-    proc = await asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if CPU_AFFINITY.get():
+      cmd = shlex.join(pinned(['sh', '-c', cmd]))
   else:
     if isinstance(cmd, str):
       cmd = shlex.split(cmd)
     vprint(cmd)
-    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  out, _ = await proc.communicate()
-  out = out.decode('utf-8').strip()
-  if check and proc.returncode != 0:
-    raise RuntimeError("Command {cmd} failed with code {proc.returncode}\nstdout:\n{stdout}\n")
-  return proc.returncode, out
-
-def run(cmd, check=True, shell=False, verbose=False):
+    cmd = pinned(cmd)
+  # asyncio's child watcher reaps with waitpid(), so wait for the child in a thread instead.
+  returncode, out = await asyncio.to_thread(_communicate, cmd, shell)
+  if check and returncode != 0:
+    raise RuntimeError(f"Command {cmd} failed with code {returncode}\nstdout:\n{out}\n")
+  return returncode, out
+
+def run(cmd, check=True, shell=False, verbose=False, stdin=None):
   if shell and isinstance(cmd, list):
     cmd = ' '.join(cmd)
   if verbose:
     print(cmd)
-  proc = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-  out, _ = proc.communicate()
-  out = out.decode('utf-8').strip()
-  if check and proc.returncode != 0:
-    raise RuntimeError(f"Command {cmd} failed with code {proc.returncode}\nstdout:\n{out}\n")
-  return proc.returncode, out
+  returncode, out = _communicate(cmd, shell, stdin)
+  if check and returncode != 0:
+    raise RuntimeError(f"Command {cmd} failed with code {returncode}\nstdout:\n{out}\n")
+  return returncode, out
@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+
+@pytest.fixture
+def results_db(tmp_path):
+  """A fresh results database, closed again after the test."""
+  import libcxx.jobs
+  import libcxx.db as db
+  db.init_db(tmp_path / 'results.db')
+  yield db.DATABASE
+  db.DATABASE.close()
+
+
+@pytest.fixture
+def open_db():
+  """open_db(path) opens the results database at path, closing the one open before."""
+  import libcxx.jobs
+  import libcxx.db as db
+  def open_db(path):
+    db.DATABASE.close()
+    db.init_db(path)
+  yield open_db
+  db.DATABASE.close()
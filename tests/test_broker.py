@@ -0,0 +1,59 @@
+from libcxx.broker import Broker, Lease
+from libcxx.db import DBDataPoint
+from libcxx.jobs import IncludeSizeJob
+from libcxx.sink import ResultSink
+
+
+def broker(tmp_path, n=1, max_attempts=2):
+  plans = list(IncludeSizeJob.plan())[:n]
+  return Broker(plans, str(tmp_path / 'broker.sock'), authkey='test', max_attempts=max_attempts)
+
+
+def output(lines=3):
+  return IncludeSizeJob.Output(line_count=lines, size_in_bytes=4).model_dump_json()
+
+
+def test_result_is_stored_with_the_worker_fingerprint(results_db, tmp_path):
+  b = broker(tmp_path)
+  kind, lease_id, _, _ = b._grant('w')
+  assert kind == 'job'
+  with ResultSink() as sink:
+    assert b._complete(lease_id, 'w', output(), [1.0, 0.5, 0.1, 100, 0, 10, 1], 'worker-fp', sink) == ('ok',)
+  row = DBDataPoint.get()
+  assert row.fingerprint == 'worker-fp' and row.value.line_count == 3
+  assert b._finished.is_set()
+  assert b._grant('w') == ('done',)
+
+
+def test_malformed_result_is_a_failed_attempt(results_db, tmp_path):
+  b = broker(tmp_path)
+  with ResultSink() as sink:
+    for attempt in (1, 2):
+      kind, lease_id, _, _ = b._grant('w')
+      assert b._complete(lease_id, 'w', '{"line_count": "many"}', None, None, sink) == ('ok',)
+      assert Lease.get().attempts == attempt
+  assert DBDataPoint.select().count() == 0
+  assert Lease.get().done and len(b.failed) == 1
+  assert b._finished.is_set()
+
+
+def test_jobs_that_lose_their_worker_are_given_up(results_db, tmp_path):
+  b = broker(tmp_path, n=2)
+  for _ in range(2):
+    assert b._grant('w')[0] == 'job'
+    assert b._grant('w')[0] == 'job'
+    b._release('w')
+  assert b.remaining() == 0 and len(b.failed) == 2
+  assert b._finished.is_set()
+  assert b._grant('w') == ('done',)
+
+
+def test_a_new_session_hands_out_failed_jobs_again(results_db, tmp_path):
+  b = broker(tmp_path, max_attempts=1)
+  b._grant('w')
+  b._release('w')
+  assert b.remaining() == 0
+  resumed = Broker(list(IncludeSizeJob.plan())[:1], str(tmp_path / 'broker.sock'), authkey='test',
+                   resume=True)
+  assert resumed.remaining() == 0
+  assert broker(tmp_path, max_attempts=1).remaining() == 1
@@ -0,0 +1,56 @@
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+from libcxx import cache
+from libcxx.header_index import HeaderIndex
+from libcxx.types import Standard
+
+
+def fake_libcxx(root):
+  include = root / 'include' / 'c++' / 'v1'
+  include.mkdir(parents=True)
+  (include / 'vector').write_text('#define _LIBCPP_VECTOR\n')
+  return SimpleNamespace(path=root, include_paths=[Path('include/c++/v1')],
+                         abs_include_paths=lambda: [include],
+                         include_flags=lambda: ['-cxx-isystem', str(include)])
+
+
+def test_preprocess_key_changes_with_the_headers(tmp_path, monkeypatch):
+  libcxx = fake_libcxx(tmp_path / 'libcxx')
+  src = tmp_path / 'input.cpp'
+  src.write_text('#include <vector>\n')
+  def key():
+    # A new process computes the header digests afresh.
+    monkeypatch.setattr(cache, 'HEADER_TREE_DIGESTS',
+                        cache.HeaderTreeDigests(HeaderIndex(root=tmp_path / 'index')))
+    return cache._preprocess_key(sys.executable, libcxx, Standard.Cpp20, src, ())
+  first = key()
+  assert key() == first
+  (libcxx.abs_include_paths()[0] / 'vector').write_text('#define _LIBCPP_VECTOR 2\n')
+  assert key() != first
+
+
+def baseline_count(out):
+  # IncludeSizeJob.postprocess_output before the counter replaced it.
+  out = out.decode('utf-8').strip()
+  lines = [l for l in out.splitlines() if l.strip() and not l.strip().startswith('#')]
+  return len(lines), len(out)
+
+
+def test_preprocessed_counter_matches_baseline_under_random_chunking():
+  rng = random.Random(0)
+  pieces = ['int x;', '# 1 "a.h"', '#pragma once', ' ', '\t', '\n', '\r\n', '\r', '\x0c', '\x85',
+            '\u2028', 'é', '€', '𝄞', 'a', '#']
+  for _ in range(500):
+    out = ''.join(rng.choice(pieces) for _ in range(rng.randrange(40))).encode('utf-8')
+    counter = cache.PreprocessedCounter()
+    i = 0
+    while i < len(out):
+      n = rng.randrange(1, 8)
+      counter.feed(out[i:i + n])
+      i += n
+    counter.finish()
+    assert (counter.line_count, counter.size_in_bytes) == baseline_count(out), out
+    assert cache.count_preprocessed(out) == baseline_count(out), out
@@ -0,0 +1,133 @@
+import pytest
+
+from libcxx import columnar
+from libcxx.db import DBDataPoint
+from libcxx.columnar import _flatten, _unflatten
+from libcxx.jobs import IncludeSizeJob, CompilerMetricsJob
+from libcxx.jobs.compiler_metrics import CompilerMetrics, PerfCounters
+
+
+def metrics(usec, instructions=None):
+  m = CompilerMetrics.create_empty()
+  m.total_execution_time.microseconds = usec
+  if instructions is not None:
+    m.perf = PerfCounters(instructions=instructions)
+  return m
+
+
+def first_key(job_type):
+  plan = next(iter(job_type.plan()))
+  return job_type.create_key(**plan.key_kwargs())
+
+
+def test_flatten_names_the_leaves_by_path():
+  columns = {c: (path, f.null) for c, path, f in _flatten(CompilerMetrics)}
+  assert columns['total_execution_time_microseconds'] == (('total_execution_time', 'microseconds'), False)
+  # Everything under an Optional model is nullable.
+  assert columns['perf_instructions'] == (('perf', 'instructions'), True)
+
+
+def test_unflatten_skips_null_columns():
+  columns = _flatten(CompilerMetrics)
+  row = type('Row', (), {c: None for c, _, _ in columns})()
+  row.filename = 'clang++'
+  row.total_execution_time_microseconds = 7
+  assert _unflatten(columns, row) == {'filename': 'clang++', 'total_execution_time': {'microseconds': 7}}
+
+
+def test_schema_of_a_list_output_has_a_runs_table():
+  assert columnar.schema_for(IncludeSizeJob).list_field is None
+  schema = columnar.schema_for(CompilerMetricsJob)
+  assert schema.list_field == 'runs'
+  assert 'total_execution_time_microseconds' in [c for c, _, _ in schema.run_columns]
+
+
+def test_store_and_load_round_trip(results_db):
+  key = first_key(IncludeSizeJob)
+  schema = columnar.schema_for(IncludeSizeJob)
+  out = IncludeSizeJob.Output(line_count=10, size_in_bytes=20)
+  schema.store(key, out)
+  assert schema.load(IncludeSizeJob.Output, key) == out
+  schema.store(key, IncludeSizeJob.Output(line_count=11, size_in_bytes=20))
+  assert schema.load(IncludeSizeJob.Output, key).line_count == 11
+  assert schema.result_model.select().count() == 1
+
+
+def test_runs_append_and_load_since(results_db):
+  key = first_key(CompilerMetricsJob)
+  schema = columnar.schema_for(CompilerMetricsJob)
+  first = CompilerMetricsJob.Output(hash_value=0, runs=[metrics(1), metrics(2, instructions=5)])
+  schema.store(key, first)
+  assert schema.load(CompilerMetricsJob.Output, key) == first
+  since = schema.next_run_id()
+  schema.store(key, CompilerMetricsJob.Output(hash_value=0, runs=[metrics(3)]), append=True)
+  loaded = schema.load(CompilerMetricsJob.Output, key)
+  assert [r.total_execution_time.microseconds for r in loaded.runs] == [1, 2, 3]
+  assert loaded.runs[1].perf.instructions == 5 and loaded.runs[0].perf is None
+  assert [r.total_execution_time.microseconds
+          for r in schema.load(CompilerMetricsJob.Output, key, since=since).runs] == [3]
+  schema.store(key, CompilerMetricsJob.Output(hash_value=0, runs=[metrics(4)]))
+  assert len(schema.load(CompilerMetricsJob.Output, key).runs) == 1
+
+
+def test_migrate_keeps_appended_runs(results_db):
+  job = next(iter(CompilerMetricsJob.plan())).materialize()
+  job.db_store(CompilerMetricsJob.Output(hash_value=0, runs=[metrics(i) for i in range(4)]))
+  job.db_store(CompilerMetricsJob.Output(hash_value=0, runs=[metrics(i) for i in range(2)]))
+  assert len(job.db_get()) == 6
+  columnar.migrate()
+  columnar.migrate()
+  assert len(job.db_get()) == 6
+
+
+def test_migrate_copies_inline_rows(results_db):
+  plan = next(iter(IncludeSizeJob.plan()))
+  key = IncludeSizeJob.create_key(**plan.key_kwargs())
+  out = IncludeSizeJob.Output(line_count=10, size_in_bytes=20)
+  DBDataPoint.create(job=IncludeSizeJob.job_name(), digest=key.digest(), key=key, value=out)
+  schema = columnar.schema_for(IncludeSizeJob)
+  assert schema.load(IncludeSizeJob.Output, key) is None
+  columnar.migrate()
+  columnar.migrate()
+  assert schema.load(IncludeSizeJob.Output, key) == out
+  assert schema.result_model.select().count() == 1
+
+
+def reference_percentile(values, q):
+  values = sorted(values)
+  pos = (len(values) - 1) * q / 100
+  lo = int(pos)
+  hi = min(lo + 1, len(values) - 1)
+  return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def test_percentile_over_the_runs_table(results_db):
+  schema = columnar.schema_for(CompilerMetricsJob)
+  plans = list(CompilerMetricsJob.plan())[:3]
+  keys = [CompilerMetricsJob.create_key(**p.key_kwargs()) for p in plans]
+  samples = [[5, 1, 9, 3, 7, 2, 8], [4], [10, 30, 20]]
+  for key, times in zip(keys, samples):
+    runs = [metrics(t, instructions=t * 100 if t % 2 else None) for t in times]
+    schema.store(key, CompilerMetricsJob.Output(hash_value=0, runs=runs))
+  group = lambda key: (key.header.value,)
+  for q in (0, 25, 50, 90, 100):
+    res = schema.percentile('total_execution_time_microseconds', q, group_by=['header'])
+    assert res == {group(k): pytest.approx(reference_percentile(t, q)) for k, t in zip(keys, samples)}
+  # NULL samples are ignored, and a group without samples has no percentile.
+  res = schema.percentile('perf_instructions', 50, group_by=['header'])
+  assert res == {group(keys[0]): 500, group(keys[1]): None, group(keys[2]): None}
+  res = schema.percentile('total_execution_time_microseconds', 50, group_by=['header'],
+                          where={'header': keys[2].header})
+  assert res == {group(keys[2]): 20}
+
+
+def test_columns_missing_from_older_tables_are_null(results_db):
+  schema = columnar.schema_for(CompilerMetricsJob)
+  key = first_key(CompilerMetricsJob)
+  schema.store(key, CompilerMetricsJob.Output(hash_value=0, runs=[metrics(1), metrics(3)]))
+  table = schema.run_model._meta.table_name
+  results_db.execute_sql(f'ALTER TABLE {table} DROP COLUMN perf_instructions')
+  group = (key.header.value,)
+  assert schema.aggregate('perf_instructions', group_by=['header']) == {group: None}
+  assert schema.percentile('perf_instructions', 50, group_by=['header']) == {group: None}
+  assert schema.aggregate('total_execution_time_microseconds', group_by=['header']) == {group: 2}
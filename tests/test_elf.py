@@ -0,0 +1,76 @@
+import shutil
+import subprocess
+
+import pytest
+
+from libcxx.elf import ElfFile, ElfError, Section, Symbol, demangle, find_demangler
+from libcxx.jobs.binary_sections import section_sizes, read_objects, SECTION_GROUPS
+
+
+SOURCE = '''
+int counter = 1;
+extern const char message[] = "hello";
+namespace ns { int twice(int x) { return counter += 2 * x; } }
+'''
+
+
+@pytest.fixture
+def object_file(tmp_path):
+  if shutil.which('g++') is None:
+    pytest.skip('needs g++')
+  src = tmp_path / 'a.cpp'
+  src.write_text(SOURCE)
+  out = tmp_path / 'a.o'
+  subprocess.run(['g++', '-c', '-O1', '-g', str(src), '-o', str(out)], check=True)
+  return out
+
+
+def test_sections_and_symbols(object_file):
+  with ElfFile(object_file) as elf:
+    assert elf.file_size == object_file.stat().st_size
+    names = [s.name for s in elf.sections]
+    assert '.text' in names and '.symtab' in names
+    symbols = {s.name: s for s in elf.symbols()}
+  assert set(symbols) == {'counter', 'message', '_ZN2ns5twiceEi'}
+  assert names[symbols['_ZN2ns5twiceEi'].section].startswith('.text')
+  assert symbols['counter'].size == 4 and symbols['message'].size == 6
+
+
+def test_read_objects_groups_bytes(object_file):
+  res = read_objects([object_file], top_n=2)[0]
+  assert res.file_bytes == object_file.stat().st_size
+  assert res.text_bytes > 0 and res.debug_bytes > 0
+  assert res.file_bytes == sum([getattr(res, g + '_bytes') for g in list(SECTION_GROUPS) + ['other']])
+  assert len(res.symbols) == 2
+  if find_demangler() is not None:
+    assert 'ns::twice(int)' in [s.name for s in read_objects([object_file], top_n=3)[0].symbols]
+
+
+def test_not_elf(tmp_path):
+  p = tmp_path / 'x.o'
+  p.write_bytes(b'not an object file at all' * 4)
+  with pytest.raises(ElfError):
+    ElfFile(p)
+
+
+def test_truncated(object_file, tmp_path):
+  p = tmp_path / 'truncated.o'
+  p.write_bytes(object_file.read_bytes()[:0x30])
+  with pytest.raises(ElfError):
+    ElfFile(p)
+
+
+def test_section_sizes_skips_bad_section_indices():
+  sections = [Section('', 0, 0, 0, 0), Section('.text', 1, 64, 16, 0)]
+  symbols = [Symbol('f', 1, 0, 8), Symbol('g', 1, 0, 8), Symbol('h', 7, 0, 4)]
+  res = section_sizes(100, sections, symbols, 10, {'f': 'f', 'g': 'g', 'h': 'h'})
+  # g aliases f, h is in no section.
+  assert [(s.name, s.group, s.bytes) for s in res.symbols] == [('f', 'text', 8)]
+  assert res.text_bytes == 16 and res.other_bytes == 84
+
+
+@pytest.mark.skipif(find_demangler() is None, reason='needs llvm-cxxfilt or c++filt')
+def test_demangle():
+  assert demangle(['_ZN2ns5twiceEi', 'main', '_ZN2ns5twiceEi']) == \
+      {'_ZN2ns5twiceEi': 'ns::twice(int)', 'main': 'main'}
+  assert demangle([]) == {}
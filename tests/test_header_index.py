@@ -0,0 +1,41 @@
+import os
+from pathlib import Path
+
+from libcxx.header_index import HeaderIndex, PathTrie
+
+
+def test_path_trie_finds_the_deepest_root():
+  trie = PathTrie(['/opt/libcxx/16/include', '/opt/libcxx/16/include/c++/v1', '/usr/include'])
+  assert trie.lookup('/opt/libcxx/16/include/c++/v1/vector') == \
+      (Path('/opt/libcxx/16/include/c++/v1'), Path('vector'))
+  assert trie.lookup('/opt/libcxx/16/include/stdio.h') == \
+      (Path('/opt/libcxx/16/include'), Path('stdio.h'))
+  assert trie.lookup('/usr/include') == (Path('/usr/include'), Path('.'))
+
+
+def test_path_trie_matches_whole_components():
+  trie = PathTrie(['/usr/include'])
+  assert trie.lookup('/usr/include2/x.h') is None
+  assert trie.lookup('/usr') is None
+  assert trie.lookup('/opt/x.h') is None
+
+
+def test_walk_lists_files_once_through_symlink_loops(tmp_path):
+  (tmp_path / 'a' / 'b').mkdir(parents=True)
+  (tmp_path / 'a' / 'b' / 'f.h').write_text('x')
+  os.symlink('../..', tmp_path / 'a' / 'b' / 'up')
+  os.symlink('a', tmp_path / 'alias')
+  assert [rel for rel, _ in HeaderIndex._walk(str(tmp_path))] == [os.path.join('a', 'b', 'f.h')]
+
+
+def test_refresh_rereads_changed_files(tmp_path):
+  tree = tmp_path / 'include'
+  tree.mkdir()
+  (tree / 'vector').write_text('#define _LIBCPP_VECTOR\n')
+  (tree / 'stdio.h').write_text('int printf(const char*, ...);\n')
+  index = HeaderIndex(root=tmp_path / 'index')
+  first = index.refresh(tree)
+  assert first.headers() == [tree.resolve() / 'vector']
+  assert HeaderIndex(root=tmp_path / 'index').refresh(tree).digest() == first.digest()
+  (tree / 'stdio.h').write_text('int puts(const char*);\n')
+  assert HeaderIndex(root=tmp_path / 'index').refresh(tree).digest() != first.digest()
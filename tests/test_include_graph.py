@@ -0,0 +1,63 @@
+import io
+import shutil
+import subprocess
+
+import pytest
+
+from libcxx.jobs.include_graph import read_include_tree, is_internal_header, TU_NAME
+
+
+CLANG_OUTPUT = '''\
+# 1 "/tmp/input.cpp"
+# 1 "<built-in>" 1
+# 1 "<built-in>" 3
+# 400 "<built-in>" 3
+# 1 "<command line>" 1
+# 1 "<built-in>" 2
+# 1 "/tmp/input.cpp" 2
+# 1 "/inc/vector" 1 3
+namespace std {
+# 1 "/inc/__config" 1 3
+
+struct config;
+# 3 "/inc/vector" 2 3
+template <class T> class vector;
+}
+# 2 "/tmp/input.cpp" 2
+int main() {
+}
+'''
+
+
+def summary(files):
+  return [(f.path, f.includer, f.lines, f.total_lines) for f in files]
+
+
+def test_read_include_tree_attributes_lines():
+  files = read_include_tree(io.StringIO(CLANG_OUTPUT), rename=lambda p: p.removeprefix('/inc/'))
+  assert summary(files) == [
+      (TU_NAME, -1, 2, 6),
+      ('vector', 0, 3, 4),
+      ('__config', 1, 1, 1),
+  ]
+
+
+@pytest.mark.skipif(shutil.which('g++') is None, reason='needs g++')
+def test_read_include_tree_of_gcc_output(tmp_path):
+  (tmp_path / 'a.h').write_text('#pragma once\n#include "b.h"\nint a();\n')
+  (tmp_path / 'b.h').write_text('#pragma once\nint b();\nint b2();\n')
+  (tmp_path / 'input.cpp').write_text('#include "a.h"\n#include "b.h"\nint main() {\n}\n')
+  out = subprocess.run(['g++', '-E', '-nostdinc', '-I', str(tmp_path), str(tmp_path / 'input.cpp')],
+                       check=True, capture_output=True, text=True).stdout
+  files = read_include_tree(io.StringIO(out), rename=lambda p: p.removeprefix(str(tmp_path) + '/'))
+  assert summary(files) == [
+      (TU_NAME, -1, 2, 5),
+      ('a.h', 0, 1, 3),
+      ('b.h', 1, 2, 2),
+  ]
+
+
+def test_is_internal_header():
+  assert is_internal_header('__algorithm/find.h')
+  assert is_internal_header('__config')
+  assert not is_internal_header('vector')
@@ -0,0 +1,25 @@
+from libcxx.db import key_digest, DBDataPoint
+from libcxx.jobs import IncludeSizeJob
+
+
+def test_key_digest_is_a_stable_signed_64_bit_int():
+  d = key_digest('IncludeSizeJob', ['16.0.0', 'c++20', 'vector'])
+  assert d == key_digest('IncludeSizeJob', ('16.0.0', 'c++20', 'vector'))
+  assert -2**63 <= d < 2**63
+
+
+def test_key_digest_depends_on_job_values_and_order():
+  d = key_digest('IncludeSizeJob', ['16.0.0', 'c++20', 'vector'])
+  assert d != key_digest('StdSymbolsJob', ['16.0.0', 'c++20', 'vector'])
+  assert d != key_digest('IncludeSizeJob', ['16.0.0', 'c++20', 'map'])
+  assert d != key_digest('IncludeSizeJob', ['c++20', '16.0.0', 'vector'])
+
+
+def test_stored_rows_are_found_by_digest(results_db):
+  plan = list(IncludeSizeJob.plan())[0]
+  job = plan.materialize()
+  job.db_store(IncludeSizeJob.Output(line_count=3, size_in_bytes=4))
+  assert plan.db_key() == (job.job_name(), job.key.digest())
+  row = DBDataPoint.get(job=job.job_name(), digest=job.key.digest())
+  assert row.value.line_count == 3
+  assert job.db_get().size_in_bytes == 4
@@ -0,0 +1,58 @@
+from libcxx import columnar
+from libcxx.db import DBDataPoint
+from libcxx.jobs import IncludeSizeJob, CompilerMetricsJob
+from libcxx.jobs.compiler_metrics import CompilerMetrics
+from libcxx.merge import merge
+
+
+def metrics_job():
+  return next(iter(CompilerMetricsJob.plan())).materialize()
+
+
+def size_jobs():
+  return [p.materialize() for p in list(IncludeSizeJob.plan())[:2]]
+
+
+def add_runs(n):
+  job = metrics_job()
+  job.db_store(CompilerMetricsJob.Output(hash_value=0, runs=[CompilerMetrics.create_empty() for _ in range(n)]))
+
+
+def runs_in_output():
+  return len(columnar.load(metrics_job()).runs)
+
+
+def test_merging_again_only_adds_new_runs(tmp_path, open_db):
+  a, b, out = tmp_path / 'a.db', tmp_path / 'b.db', tmp_path / 'out.db'
+  open_db(a)
+  add_runs(3)
+  for i, job in enumerate(size_jobs()):
+    job.db_store(IncludeSizeJob.Output(line_count=i, size_in_bytes=1))
+  open_db(b)
+  add_runs(2)
+  size_jobs()[0].db_store(IncludeSizeJob.Output(line_count=0, size_in_bytes=1))
+
+  open_db(out)
+  assert merge([a, b]) == []
+  assert runs_in_output() == 5
+  assert DBDataPoint.select().count() == 3
+  assert merge([a, b]) == []
+  assert runs_in_output() == 5
+
+  open_db(a)
+  add_runs(4)
+  open_db(out)
+  assert merge([b, a]) == []
+  assert runs_in_output() == 9
+
+
+def test_differing_values_are_conflicts(tmp_path, open_db):
+  a, b, out = tmp_path / 'a.db', tmp_path / 'b.db', tmp_path / 'out.db'
+  for path, lines in ((a, 1), (b, 2)):
+    open_db(path)
+    size_jobs()[0].db_store(IncludeSizeJob.Output(line_count=lines, size_in_bytes=1))
+  open_db(out)
+  conflicts = merge([a, b])
+  assert [(c.reason, c.source) for c in conflicts] == [('value', str(b))]
+  # The first value is kept.
+  assert size_jobs()[0].db_get().line_count == 1
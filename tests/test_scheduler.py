@@ -0,0 +1,79 @@
+import asyncio
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+from libcxx.scheduler import JobScheduler
+
+
+class FakeJob:
+  def __init__(self, name, cost=1, memory_mb=1, exclusive=False):
+    self.name = name
+    self._meta = SimpleNamespace(cost=cost, memory_mb=memory_mb, exclusive=exclusive)
+
+  def meta(self):
+    return self._meta
+
+
+def run_jobs(scheduler, batches):
+  """Start each batch of jobs after the previous one is admitted or queued.
+  Returns, in admission order, the jobs running when each job was admitted
+  and the CPUs it was given."""
+  seen = {}
+  running = set()
+
+  async def one(job):
+    async with scheduler.reserve(job) as cpus:
+      running.add(job.name)
+      seen[job.name] = (set(running), cpus)
+      await asyncio.sleep(0.02)
+      running.discard(job.name)
+
+  async def main():
+    tasks = []
+    for batch in batches:
+      tasks += [asyncio.create_task(one(j)) for j in batch]
+      await asyncio.sleep(0.005)
+    await asyncio.gather(*tasks)
+    assert scheduler.used == 0 and scheduler.used_memory_mb == 0
+
+  asyncio.run(main())
+  return seen
+
+
+def test_cost_limits_concurrency():
+  seen = run_jobs(JobScheduler(cpus=[0, 1], memory_mb=1000, isolate=0),
+                  [[FakeJob('a%d' % i) for i in range(4)]])
+  assert max(len(s) for s, _ in seen.values()) == 2
+  # A job larger than the machine still runs, alone.
+  seen = run_jobs(JobScheduler(cpus=[0, 1], memory_mb=1000, isolate=0),
+                  [[FakeJob('a')], [FakeJob('big', cost=8)]])
+  assert seen['big'][0] == {'big'}
+
+
+def test_memory_limits_concurrency():
+  seen = run_jobs(JobScheduler(cpus=[0, 1, 2, 3], memory_mb=100, isolate=0),
+                  [[FakeJob('a%d' % i, memory_mb=60) for i in range(3)]])
+  assert all(len(s) == 1 for s, _ in seen.values())
+
+
+def test_exclusive_job_runs_alone_and_is_not_starved():
+  seen = run_jobs(JobScheduler(cpus=[0, 1, 2, 3], memory_mb=1000, isolate=0),
+                  [[FakeJob('a%d' % i) for i in range(3)],
+                   [FakeJob('ex', exclusive=True)],
+                   [FakeJob('b%d' % i) for i in range(3)]])
+  assert seen['ex'][0] == {'ex'}
+  # Jobs submitted while the exclusive job waited are admitted after it.
+  order = list(seen)
+  assert all(order.index('ex') < order.index('b%d' % i) for i in range(3))
+
+
+@pytest.mark.skipif(shutil.which('taskset') is None, reason='taskset not found')
+def test_isolated_cpus_are_pinned():
+  seen = run_jobs(JobScheduler(cpus=[0, 1, 2, 3], memory_mb=1000, isolate=2),
+                  [[FakeJob('ex%d' % i, exclusive=True) for i in range(3)] + [FakeJob('a')]])
+  assert seen['a'][1] == {0, 1}
+  assert {frozenset(seen['ex%d' % i][1]) for i in range(2)} == {frozenset([2]), frozenset([3])}
+  # The third exclusive job waits for a free isolated CPU.
+  assert len([n for n in seen['ex2'][0] if n.startswith('ex')]) <= 2
@@ -0,0 +1,36 @@
+from collections import Counter
+
+import pytest
+
+from libcxx.job import LibcxxJob
+from libcxx.jobs import BinarySizeJob, BinarySectionsJob
+from libcxx.shard import Shard
+
+
+def test_parse():
+  assert Shard.parse('1/4') == Shard(1, 4)
+  with pytest.raises(ValueError):
+    Shard.parse('4/4')
+  with pytest.raises(ValueError):
+    Shard.parse('1')
+
+
+def test_shards_cover_every_plan_once():
+  plans = LibcxxJob.all_plans(shard=None)
+  seen = Counter()
+  for i in range(4):
+    seen.update([p.db_key() for p in Shard(i, 4).select(plans)])
+  assert set(seen) == set([p.db_key() for p in plans])
+  assert set(seen.values()) == {1}
+
+
+def test_upstream_plans_go_to_their_consumer_shard():
+  plans = list(BinarySizeJob.plan()) + list(BinarySectionsJob.plan())
+  shards = {}
+  for i in range(4):
+    for p in Shard(i, 4).select(plans):
+      shards[p.db_key()] = i
+  for p in BinarySectionsJob.plan():
+    assert shards[p.dependencies()['object'].plan.db_key()] == shards[p.db_key()]
+  # The consumers themselves are still spread over every shard.
+  assert set(shards.values()) == {0, 1, 2, 3}
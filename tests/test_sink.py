@@ -0,0 +1,33 @@
+import pytest
+
+from libcxx.db import DBDataPoint
+from libcxx.jobs import IncludeSizeJob
+from libcxx.sink import ResultSink
+
+
+def jobs(n):
+  return [p.materialize() for p in list(IncludeSizeJob.plan())[:n]]
+
+
+def test_sink_stores_every_result_in_batches(results_db):
+  with ResultSink(batch_size=3, flush_interval=0.01) as sink:
+    for i, job in enumerate(jobs(7)):
+      sink.put(job, IncludeSizeJob.Output(line_count=i, size_in_bytes=1))
+  assert sink.stored == 7
+  assert sorted([r.value.line_count for r in DBDataPoint.select()]) == list(range(7))
+
+
+def test_one_failing_item_does_not_lose_its_batch(results_db):
+  stored = []
+  def fail():
+    raise RuntimeError('boom')
+  sink = ResultSink(batch_size=10, flush_interval=60)
+  for i, job in enumerate(jobs(5)):
+    then = fail if i == 2 else (lambda i=i: stored.append(i))
+    sink.put(job, IncludeSizeJob.Output(line_count=i, size_in_bytes=1), then)
+  with pytest.raises(RuntimeError, match='boom'):
+    sink.close()
+  assert sink.stored == 4 and len(sink.errors) == 1
+  # The failing item is rolled back with its then(), the others are committed.
+  assert sorted([r.value.line_count for r in DBDataPoint.select()]) == [0, 1, 3, 4]
+  assert 2 not in stored
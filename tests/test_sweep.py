@@ -0,0 +1,52 @@
+from libcxx import columnar
+from libcxx.jobs import IncludeSizeJob, CompilerMetricsJob
+from libcxx.jobs.compiler_metrics import CompilerMetrics
+from libcxx.sweep import Sweep, SweepEntry
+
+
+def size_plans(n):
+  return list(IncludeSizeJob.plan())[:n]
+
+
+def fake_size_run(self):
+  return IncludeSizeJob.Output(line_count=7, size_in_bytes=1)
+
+
+def fake_metrics_run(self, runs=None):
+  return CompilerMetricsJob.Output(hash_value=0, runs=[CompilerMetrics.create_empty() for _ in range(runs)])
+
+
+def test_sweep_runs_every_key_once(results_db, monkeypatch):
+  monkeypatch.setattr(IncludeSizeJob, 'run', fake_size_run)
+  monkeypatch.setattr(CompilerMetricsJob, 'run', fake_metrics_run)
+  monkeypatch.setattr(CompilerMetricsJob.Meta, 'runs_per_repeat', 5)
+  monkeypatch.setattr(CompilerMetricsJob.Meta, 'runs_per_chunk', 2, raising=False)
+  metrics = list(CompilerMetricsJob.plan())[:2]
+  Sweep(size_plans(4) + metrics, name='t').run(processes=2)
+  assert all([p.materialize().db_get().line_count == 7 for p in size_plans(4)])
+  # Chunks of 2 stop at the target of 5 samples.
+  assert [len(columnar.load(p.materialize()).runs) for p in metrics] == [5, 5]
+  assert Sweep(size_plans(4), name='t').pending() == []
+
+
+def test_resume_adds_new_keys_and_restarts_changed_ones(results_db):
+  sweep = Sweep(size_plans(3), name='t')
+  assert len(sweep.pending()) == 3
+  entries = list(SweepEntry.select().order_by(SweepEntry.id))
+  SweepEntry.update(done=True, completed=1).where(SweepEntry.id == entries[0].id).execute()
+  SweepEntry.update(fingerprint='old', completed=1).where(SweepEntry.id == entries[1].id).execute()
+
+  resumed = Sweep(size_plans(5), name='t')
+  pending = {(e.job, e.digest): e for e, _ in resumed.pending()}
+  assert len(pending) == 4
+  assert (entries[0].job, entries[0].digest) not in pending
+  restarted = pending[(entries[1].job, entries[1].digest)]
+  assert restarted.completed == 0 and restarted.fingerprint != 'old'
+
+
+def test_finished_sweep_starts_over(results_db):
+  sweep = Sweep(size_plans(2), name='t')
+  SweepEntry.update(done=True).execute()
+  sweep.run()
+  assert sweep.manifest.finished is not None
+  assert len(Sweep(size_plans(2), name='t').pending()) == 2
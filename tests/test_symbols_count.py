@@ -0,0 +1,20 @@
+import shutil
+
+import pytest
+
+from libcxx.jobs import StdSymbolsJob
+from libcxx.jobs.symbols_count import check_symbol_counts
+from libcxx.types import STLHeader
+
+
+@pytest.mark.skipif(shutil.which('clang++') is None or shutil.which('clang-query') is None,
+                    reason='needs clang++ and clang-query')
+def test_preprocessed_tu_has_the_symbols_of_the_source():
+  kwargs = next(iter(StdSymbolsJob.plan())).key_kwargs()
+  assert check_symbol_counts(kwargs['libcxx'], kwargs['standard'],
+                             [STLHeader.vector, STLHeader.string]) == []
+
+
+def test_postprocess_output_reads_the_match_count():
+  job = next(iter(StdSymbolsJob.plan())).materialize()
+  assert job.postprocess_output('Match #1:\n...\n1234 matches.\n').symbol_count == 1234
@@ -0,0 +1,51 @@
+import io
+import json
+
+import pytest
+
+from libcxx.jobs.time_trace import iter_trace_events, summarize_trace
+
+
+def trace(events):
+  return json.dumps({'traceEvents': events, 'beginningOfTime': 0}, indent=1)
+
+
+def event(name, ts, dur, detail='', tid=1):
+  return {'ph': 'X', 'pid': 1, 'tid': tid, 'ts': ts, 'dur': dur, 'name': name, 'args': {'detail': detail}}
+
+
+def test_iter_trace_events_across_chunks():
+  events = [event('Source', i * 10, 5, 'h%d.h' % i) for i in range(50)]
+  for chunk_size in (1, 7, 1 << 20):
+    assert list(iter_trace_events(io.StringIO(trace(events)), chunk_size=chunk_size)) == events
+
+
+def test_iter_trace_events_empty_and_missing():
+  assert list(iter_trace_events(io.StringIO('{"traceEvents": []}'), chunk_size=3)) == []
+  with pytest.raises(ValueError):
+    list(iter_trace_events(io.StringIO('{"other": []}')))
+
+
+def test_summarize_trace_self_times():
+  events = [
+      event('Source', 0, 100, '/inc/vector'),
+      event('Source', 10, 30, '/inc/__algorithm/find.h'),
+      event('Source', 50, 20, '/inc/__algorithm/find.h'),
+      event('InstantiateClass', 200, 40, 'std::vector<int>'),
+      {'ph': 'X', 'pid': 1, 'tid': 0, 'ts': 0, 'dur': 500, 'name': 'Total Source', 'args': {}},
+      {'ph': 'X', 'pid': 1, 'tid': 0, 'ts': 0, 'dur': 900, 'name': 'Total ExecuteCompiler', 'args': {}},
+  ]
+  summary = summarize_trace(io.StringIO(trace(events)), top_n=10, rename=lambda n: n.removeprefix('/inc/'))
+  assert summary.source_usec == 500 and summary.execute_compiler_usec == 900
+  spots = {(h.kind, h.name): (h.count, h.self_usec, h.total_usec) for h in summary.hot_spots}
+  # vector is not charged for the headers it includes.
+  assert spots[('Source', 'vector')] == (1, 50, 100)
+  assert spots[('Source', '__algorithm/find.h')] == (2, 50, 50)
+  assert spots[('InstantiateClass', 'std::vector<int>')] == (1, 40, 40)
+
+
+def test_summarize_trace_keeps_top_n_per_kind():
+  events = [event('Source', i * 10, i + 1, 'h%d.h' % i) for i in range(5)] + \
+      [event('InstantiateFunction', 100 + i * 10, 1, 'f%d' % i) for i in range(3)]
+  summary = summarize_trace(io.StringIO(trace(events)), top_n=2)
+  assert [h.name for h in summary.hot_spots] == ['h4.h', 'h3.h', 'f0', 'f1']